@@ -0,0 +1,60 @@
+"""
+Compares Remailer throughput with and without the SMTP connection pool.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_remailer --messages 500 --pool-size 4
+"""
+import argparse
+import asyncio
+import time
+from io import StringIO
+
+import config
+
+from benchmarks.smtp_stub import SMTPStub
+from src.remailer import Remailer
+
+MESSAGE = "From: a@example.com\nTo: b@example.com\nSubject: benchmark\n\nHello\n"
+
+
+async def run(port: int, messages: int, concurrency: int, pool_size: int) -> float:
+    remailer = Remailer(config.Config(StringIO(
+        f"smtp_host: '127.0.0.1'\nsmtp_port: {port}\nsmtp_pool_size: {pool_size}\nsmtp_pool_max_messages: 0"
+    )))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send() -> None:
+        async with semaphore:
+            await remailer.sendmail(["b@example.com"], MESSAGE, "a@example.com")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send() for _ in range(messages)))
+    elapsed = time.perf_counter() - start
+
+    await remailer.close()
+
+    return elapsed
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(prog="bench_remailer")
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--pool-size", type=int, default=4)
+    parser.add_argument("--greeting-delay", type=float, default=0.002,
+                        help="Seconds the stand-in waits before greeting, to model network latency")
+    args = parser.parse_args()
+
+    stub = SMTPStub(args.greeting_delay)
+    port = await stub.start()
+
+    for label, pool_size in (("per-message", 0), ("pooled", args.pool_size)):
+        stub.connections = 0
+        elapsed = await run(port, args.messages, args.pool_size, pool_size)
+        print(f"{label:>12}: {args.messages / elapsed:8.1f} msg/s over {stub.connections} connections")
+
+    await stub.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
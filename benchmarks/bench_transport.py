@@ -0,0 +1,137 @@
+"""
+Compares the latency of milter round trips over loopback TCP and a UNIX
+socket.
+
+Each message is modelled as a number of small request/response exchanges,
+one for each milter phase that waits on a response, against a stand-in
+that answers each request immediately. The stand-in is served by the same
+listeners as the milter, in a separate process.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_transport --messages 2000 --phases 6
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import statistics
+import tempfile
+import time
+
+import anyio
+
+from src.milter.listener import create_unix_socket_listener
+
+# A milter packet is a 4 byte length followed by a command byte and its data
+REQUEST = b"\x00\x00\x00\x20M" + b"<sender@example.com>\x00".ljust(31, b"\x00")
+RESPONSE = b"\x00\x00\x00\x01c"
+
+
+async def respond(stream) -> None:
+    async with stream:
+        try:
+            while True:
+                request = await stream.receive(len(REQUEST))
+                # A request may arrive in parts
+                while len(request) < len(REQUEST):
+                    request += await stream.receive(len(REQUEST) - len(request))
+
+                await stream.send(RESPONSE)
+        except (anyio.EndOfStream, anyio.BrokenResourceError):
+            pass
+
+
+async def connect_unix(path: str) -> anyio.abc.SocketStream:
+    """
+    Connects over the event loop's transports, as `anyio.connect_unix` reads
+    through slower readiness polling that the MTA would not be paying for.
+    """
+    client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client_socket.connect(path)
+
+    return await anyio.abc.SocketStream.from_socket(client_socket)
+
+
+async def measure(connect, messages: int, phases: int) -> list[float]:
+    timings = []
+
+    async with await connect() as stream:
+        for _ in range(messages):
+            start = time.perf_counter()
+
+            for _ in range(phases):
+                await stream.send(REQUEST)
+                await stream.receive(len(RESPONSE))
+
+            timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def report(label: str, timings: list[float]) -> None:
+    timings = sorted(timings)
+    p99 = timings[int(len(timings) * 0.99)]
+
+    print(
+        f"{label:>6}: mean {statistics.mean(timings) * 1e6:7.1f} us, "
+        f"median {statistics.median(timings) * 1e6:7.1f} us, p99 {p99 * 1e6:7.1f} us per message"
+    )
+
+
+async def serve(port: int, path: str, ready) -> None:
+    tcp_listener = await anyio.create_tcp_listener(local_host="127.0.0.1", local_port=port)
+    unix_listener = await create_unix_socket_listener(path)
+
+    ready.set()
+
+    async with anyio.create_task_group() as tasks:
+        tasks.start_soon(tcp_listener.serve, respond)
+        tasks.start_soon(unix_listener.serve, respond)
+
+
+def run_server(port: int, path: str, ready) -> None:
+    anyio.run(serve, port, path, ready)
+
+
+async def run_clients(port: int, path: str, messages: int, phases: int) -> None:
+    for (label, connect) in (
+        ("tcp", lambda: anyio.connect_tcp("127.0.0.1", port)),
+        ("unix", lambda: connect_unix(path)),
+    ):
+        # Warm up before measuring
+        await measure(connect, 100, phases)
+        report(label, await measure(connect, messages, phases))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="bench_transport")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--phases", type=int, default=6,
+                        help="Round trips per message, eg MAIL, DATA, end of headers and end of message")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "milter.sock")
+
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+
+        # The stand-in runs in its own process, as the MTA would
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=run_server, args=(port, path, ready), daemon=True)
+        server.start()
+
+        try:
+            if not ready.wait(10):
+                raise RuntimeError("The stand-in did not start")
+
+            anyio.run(run_clients, port, path, args.messages, args.phases)
+        finally:
+            server.terminate()
+            server.join()
+
+
+if __name__ == "__main__":
+    main()
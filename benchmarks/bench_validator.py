@@ -0,0 +1,105 @@
+"""
+Compares the throughput of signing and verifying challenge tokens, setting
+up the HMAC key for every hash against copying the state worked out once for
+each key.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_validator --keys 2
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import tempfile
+import time
+from pathlib import Path
+
+from src.validator import Validator
+
+
+class PreviousValidator(Validator):
+    """
+    The previous approach: the HMAC key is set up again for every hash, with
+    a single key.
+    """
+
+    def hash(self, message_bytes: bytes) -> str:
+        digest = hmac.new(self.hash_key, message_bytes, hashlib.sha224).digest()
+        return base64.urlsafe_b64encode(digest).strip(b"=").decode()
+
+    def validate_hash(self, sender: str, recipient: str, reference: str, hash: str) -> bool:
+        return self.make_hash(sender, recipient, reference) == hash
+
+
+def make_validator(directory: str, keys: int) -> Validator:
+    """
+    Makes a keyring of `keys` keys, each replaced an hour after the last so
+    that all of them are within the grace period.
+    """
+    now = time.time()
+    keyring = []
+
+    for index in range(keys):
+        key_file = Path(directory) / f"key-{index}"
+        key_file.write_bytes(f"secret key {index}".encode() * 4)
+        keyring.append({"file": str(key_file), "since": now - 3600 * (keys - index)})
+
+    return Validator({"key_file": keyring, "key_grace_period": 3600 * keys})
+
+
+def run(operation, tokens: int, repeats: int) -> float:
+    """
+    Returns the best CPU time of the repeats, to reduce the noise from
+    anything else running.
+    """
+    timings = []
+
+    for _ in range(repeats):
+        start = time.process_time()
+
+        for index in range(tokens):
+            operation(index)
+
+        timings.append(time.process_time() - start)
+
+    return min(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="bench_validator")
+    parser.add_argument("--keys", type=int, default=1, help="The number of keys in the keyring")
+    parser.add_argument("--tokens", type=int, default=50000)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        validator = make_validator(directory, args.keys)
+        previous = PreviousValidator({"key_file": str(Path(directory) / "key-0")})
+    recipient = "list@example.com"
+
+    def sender(index: int) -> str:
+        return f"sender-{index}@example.org"
+
+    # Tokens signed with the oldest key, the worst case for the keyring
+    signed = [previous.make_hash(sender(index), recipient, f"ref{index}") for index in range(args.tokens)]
+
+    assert validator.validate_hash(sender(0), recipient, "ref0", signed[0])
+
+    operations = []
+
+    for (name, subject) in (("previous", previous), ("keyring", validator)):
+        operations.extend([
+            (f"{name} sign", lambda index, subject=subject: subject.make_hash(sender(index), recipient, f"ref{index}")),
+            (f"{name} verify", lambda index, subject=subject: subject.validate_hash(
+                sender(index), recipient, f"ref{index}", signed[index]
+            )),
+        ])
+
+    for label, operation in operations:
+        elapsed = run(operation, args.tokens, args.repeats)
+        print(f"{label:>17}: {args.tokens / elapsed:10.0f} tokens/s CPU with {args.keys} keys")
+
+
+if __name__ == "__main__":
+    main()
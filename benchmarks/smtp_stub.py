@@ -0,0 +1,59 @@
+"""
+A minimal SMTP server that accepts and discards everything, used as a local
+stand-in for the MTA when benchmarking.
+"""
+import asyncio
+
+
+class SMTPStub:
+    def __init__(self, greeting_delay: float = 0) -> None:
+        self.greeting_delay = greeting_delay
+        self.connections = 0
+        self.messages = 0
+        self.server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+
+        # Stands in for the network round trips of a real connection.
+        if self.greeting_delay:
+            await asyncio.sleep(self.greeting_delay)
+
+        writer.write(b"220 stub ESMTP\r\n")
+
+        try:
+            while line := await reader.readline():
+                command = line[:4].upper()
+
+                if command == b"EHLO":
+                    writer.write(b"250-stub\r\n250 8BITMIME\r\n")
+                elif command == b"DATA":
+                    writer.write(b"354 go ahead\r\n")
+                    await writer.drain()
+                    while (await reader.readline()) != b".\r\n":
+                        pass
+                    self.messages += 1
+                    writer.write(b"250 queued\r\n")
+                elif command == b"QUIT":
+                    writer.write(b"221 bye\r\n")
+                    await writer.drain()
+                    break
+                else:
+                    writer.write(b"250 OK\r\n")
+
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """
+        Starts the server and returns the port it is listening on.
+        """
+        self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        self.server.close()
+        await self.server.wait_closed()
@@ -0,0 +1,44 @@
+import argparse
+import logging
+
+from anyio import run
+import config
+
+from src.outbox import Outbox
+from src.remailer import Remailer
+
+logger = logging.getLogger(__name__)
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        prog="outbox_worker",
+        description="Sends the challenges and released messages queued in the outbox"
+    )
+    parser.add_argument("-c", "--config-file", default="/etc/postconfirm.cfg", type=argparse.FileType())
+    parser.add_argument("-w", "--workers", type=int, help="Number of workers to run")
+    parser.add_argument("--once", action='store_true', help="Send a single batch and exit")
+
+    args = parser.parse_args()
+
+    # Load the configuration
+    app_config = config.Config(args.config_file)
+
+    # Set up the root logger
+    logging.basicConfig(level=app_config.get('log.level', logging.WARNING))
+
+    remailer = Remailer(app_config)
+    outbox = Outbox(app_config)
+
+    try:
+        if args.once:
+            count = await outbox.process_batch(remailer)
+            logger.info("Processed %(count)d outbox entries", {"count": count})
+        else:
+            await outbox.run(remailer, args.workers or max(outbox.workers, 1))
+    finally:
+        await remailer.close()
+
+
+if __name__ == "__main__":
+    run(main)
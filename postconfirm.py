@@ -1,19 +1,23 @@
 import argparse
-import logging
-from logging.handlers import TimedRotatingFileHandler
+import atexit
+import time
 
-
-from anyio import create_tcp_listener, run
+from anyio import create_task_group, run
 import config
 
-from src.milter import handle
-from src.remailer import Remailer
-from src.validator import Validator
-from src.challenge import init_handlers as init_challenge_handlers
+from src.lifecycle import Lifecycle, build_services, report_startup, run_warm_up
+from src.log import configure_logging
+from src.metrics import StatusServer, metrics_route, registry
+from src.metrics.collectors import register_service_metrics
+from src.metrics.health import HealthMonitor
+from src.milter import create_milter_listener, handle
+from src.tracing import configure_tracing
 
 from src import services
 
 async def main():
+    started = time.monotonic()
+
     parser = argparse.ArgumentParser(
         prog="postconfirm",
         description="Milter handler for confirming that emails come from valid email addresses"
@@ -26,53 +30,51 @@ async def main():
     # Load the configuration
     app_config = config.Config(args.config_file)
 
-    log_line_format = (
-        "{asctime} postconfirm/postconfirm[{process}]: {message} [{filename}:{lineno}]"
-    )
-    log_date_format = "%b %d %H:%M:%S"
-    log_rotate_period = "D"
-    log_rotate_interval = 1
-    log_rotate_keep = 5
-    log_filename = app_config.get(
-        "log.filename", "/var/log/postconfirm/postconfirm.log"
-    )
-    log_level = app_config.get("log.level", logging.INFO)
+    # Log through a background thread, flushing it on exit
+    log_listener = configure_logging(app_config)
+    atexit.register(log_listener.stop)
 
-    logging.basicConfig(
-        level=log_level, style="{", datefmt=log_date_format, format=log_line_format
-    )
+    # Set up a services registry
+    services.swap(build_services(app_config))
 
-    logging.getLogger("kilter.service").disabled = True
+    register_service_metrics(services)
 
-    logger = logging.getLogger()
-    logger.setLevel(log_level)
-    file_handler = TimedRotatingFileHandler(
-        log_filename,
-        when=log_rotate_period,
-        interval=log_rotate_interval,
-        backupCount=log_rotate_keep,
-    )
+    tracer = configure_tracing(app_config)
 
-    file_formatter = logging.Formatter(
-        style="{", datefmt=log_date_format, fmt=log_line_format
-    )
+    lifecycle = Lifecycle(args.config_file.name, app_config)
 
-    file_handler.setFormatter(file_formatter)
-    logger.addHandler(file_handler)
+    health = None
 
-    #logger = logging.LoggerAdapter(logger)
+    async with create_task_group() as tasks:
+        # Start the status endpoints, and the health checks behind them. It
+        # is not ready until the milter listener is bound.
+        status_port = app_config.get("status_port")
+        if status_port:
+            health = HealthMonitor(app_config)
+            health.starting = True
+            lifecycle.on_drain = health.start_draining
+            status_server = StatusServer({"/metrics": metrics_route(registry), **health.routes()})
+            tasks.start_soon(health.run)
+            tasks.start_soon(status_server.serve, int(status_port))
 
-    # Set up a services registry
-    services["app_config"] = app_config
-    services["remailer"] = Remailer(app_config)
-    services["validator"] = Validator(app_config)
+        # Export any traces
+        if tracer:
+            tasks.start_soon(tracer.run)
+
+        # Open the pools and fill the caches before accepting connections
+        await run_warm_up(services.current, app_config.get("warmup.hot_senders"))
+
+        # Serve until drained, reloading on SIGHUP. The outbox workers are
+        # run alongside each generation of the services.
+        listener = await create_milter_listener(app_config, args.port)
+
+        report_startup(started)
+        if health:
+            health.starting = False
 
-    init_challenge_handlers(services)
+        await lifecycle.serve(listener, handle)
 
-    # Start the listener
-    listen_port = args.port or app_config.get("milter_port", 1999)
-    listener = await create_tcp_listener(local_port=listen_port)
-    await listener.serve(handle)
+        tasks.cancel_scope.cancel()
 
 if __name__ == "__main__":
     run(main)
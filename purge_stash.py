@@ -103,6 +103,47 @@ def main():
                         {"sender": sender}
                     )
 
+                    cursor.execute(
+                        """
+                        DELETE FROM
+                            sender_refs
+                        WHERE
+                            sender=%(sender)s
+                        """,
+                        {"sender": sender}
+                    )
+
+            # Finally, outbox entries that were abandoned after their last
+            # attempt are kept for inspection only until they expire too.
+
+            cursor.execute(
+                """
+                SELECT
+                    count(*)
+                FROM
+                    outbox
+                WHERE
+                    next_attempt IS NULL
+                    AND created < date_subtract(now(), %(interval)s::interval)
+                """,
+                {"interval": ttl}
+            )
+
+            (abandoned,) = cursor.fetchone()
+            logger.debug("Removing %(count)d abandoned outbox entries", {"count": abandoned})
+
+            if not args.dry_run and abandoned:
+                cursor.execute(
+                    """
+                    DELETE FROM
+                        outbox
+                    WHERE
+                        next_attempt IS NULL
+                        AND created < date_subtract(now(), %(interval)s::interval)
+                    """,
+                    {"interval": ttl}
+                )
+
             connection.commit()
 
 
@@ -0,0 +1,26 @@
+-- Sender references are kept one per row so that they can be added
+-- atomically and checked with an indexed lookup.
+CREATE TABLE sender_refs (
+  sender VARCHAR(255) NOT NULL,
+  ref VARCHAR(255) NOT NULL,
+  PRIMARY KEY (sender, ref),
+  created TIMESTAMP WITH TIME ZONE DEFAULT now()
+);
+
+-- Move the existing references across. These are either a JSON array or a
+-- single bare reference.
+INSERT INTO sender_refs (sender, ref)
+  SELECT sender, jsonb_array_elements_text(ref::jsonb)
+    FROM senders
+    WHERE ref LIKE '[%'
+  ON CONFLICT DO NOTHING;
+
+INSERT INTO sender_refs (sender, ref)
+  SELECT sender, ref
+    FROM senders
+    WHERE ref IS NOT NULL AND ref <> '' AND ref NOT LIKE '[%'
+  ON CONFLICT DO NOTHING;
+
+UPDATE senders SET ref = NULL WHERE ref IS NOT NULL;
+
+UPDATE config SET value = '3' WHERE name = 'schema';
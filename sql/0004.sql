@@ -0,0 +1,16 @@
+-- Outbound mail is queued here, in the same transaction as the change that
+-- caused it, and sent by the outbox workers.
+CREATE TABLE outbox (
+  id BIGSERIAL,
+  created TIMESTAMP WITH TIME ZONE DEFAULT now(),
+  sender VARCHAR(255),
+  recipients TEXT,
+  message TEXT,
+  attempts INTEGER DEFAULT 0,
+  next_attempt TIMESTAMP WITH TIME ZONE DEFAULT now(),
+  PRIMARY KEY (id)
+);
+
+CREATE INDEX outbox_next_attempt ON outbox (next_attempt);
+
+UPDATE config SET value = '4' WHERE name = 'schema';
@@ -0,0 +1,5 @@
+-- Records when a sender was last sent a challenge, so that repeated
+-- challenges can be suppressed across all replicas.
+ALTER TABLE senders ADD COLUMN challenged TIMESTAMP WITH TIME ZONE;
+
+UPDATE config SET value = '5' WHERE name = 'schema';
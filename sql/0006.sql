@@ -0,0 +1,17 @@
+-- With sender_keys.lowercase set the keys are lowercase, and senders are
+-- matched ignoring case so that rows stored before it was set are still
+-- found.
+CREATE INDEX senders_lower_sender ON senders (lower(sender));
+CREATE INDEX senders_static_lower_sender ON senders_static (lower(sender));
+CREATE INDEX sender_refs_lower_sender ON sender_refs (lower(sender));
+CREATE INDEX stash_lower_sender ON stash (lower(sender));
+CREATE INDEX stash_static_lower_sender ON stash_static (lower(sender));
+CREATE INDEX never_allow_lower_email ON never_allow (lower(email));
+
+-- Stashed messages are held under the sender's key, so the envelope sender
+-- they came from is kept to release them from. It is null where it is the
+-- key, and for messages stashed before this.
+ALTER TABLE stash ADD COLUMN envelope_sender VARCHAR(255);
+ALTER TABLE stash_static ADD COLUMN envelope_sender VARCHAR(255);
+
+UPDATE config SET value = '6' WHERE name = 'schema';
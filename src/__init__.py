@@ -1 +1,75 @@
-services = {}
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator, Optional
+
+
+class Generation(dict):
+    """
+    A set of services built from one load of the configuration, along with
+    the number of sessions using it.
+    """
+
+    sessions = 0
+
+
+class Services(MutableMapping):
+    """
+    The registry of shared services, eg the remailer and the validator.
+
+    The services are held as a generation, which is replaced as a whole when
+    the configuration is reloaded. A session pins the generation that is
+    current when it starts, and sees those services throughout even if it is
+    replaced part way through. Anything else sees the current generation.
+    """
+
+    def __init__(self) -> None:
+        self.current = Generation()
+        self.pinned: ContextVar[Optional[Generation]] = ContextVar("services", default=None)
+
+    def _active(self) -> Generation:
+        pinned = self.pinned.get()
+
+        return self.current if pinned is None else pinned
+
+    def __getitem__(self, key: str) -> Any:
+        return self._active()[key]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._active()[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        del self._active()[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._active())
+
+    def __len__(self) -> int:
+        return len(self._active())
+
+    def swap(self, generation: Generation) -> Generation:
+        """
+        Makes `generation` current, and returns the one it replaces.
+        """
+        (previous, self.current) = (self.current, generation)
+
+        return previous
+
+    @contextmanager
+    def pin(self, generation: Optional[Generation] = None) -> Iterator[Generation]:
+        """
+        Pins the current generation, or the one given, for the duration of
+        the block.
+        """
+        generation = self.current if generation is None else generation
+        generation.sessions += 1
+        token = self.pinned.set(generation)
+
+        try:
+            yield generation
+        finally:
+            self.pinned.reset(token)
+            generation.sessions -= 1
+
+
+services = Services()
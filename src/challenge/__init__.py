@@ -1,14 +1,25 @@
-from .challenge import Challenge
+from src import services
+
+from .challenge import Challenge, look_up_challenges
 from .handlers import handlers, init_handlers
 from .typing import Action
 
 __all__ = [
     "get_challenge",
+    "get_challenges",
     "Challenge",
     "init_handlers",
     "Action"
 ]
 
 
+def get_handlers() -> list:
+    return services.get("challenge_handlers", handlers)
+
+
 def get_challenge(email: str) -> Challenge:
-    return Challenge(email, handlers)
+    return Challenge(email, get_handlers())
+
+
+def get_challenges(emails: list[str]) -> list[Challenge]:
+    return look_up_challenges(emails, get_handlers())
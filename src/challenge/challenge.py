@@ -1,5 +1,8 @@
 import logging
-import re
+from typing import Callable, Iterable, Optional
+
+from src.rules import get_matcher
+from src.tracing import span
 
 from .typing import Action
 
@@ -59,17 +62,60 @@ class Challenge:
 
     def _look_up_action(self) -> None:
         for handler in self.handlers:
-            action = handler.get_action(self.email)
-
-            if not action:
-                for (pattern, pattern_action) in handler.get_patterns():
-                    logger.debug("Handling pattern %(pattern)s which would result in %(pattern_action)s", {
-                        "pattern": pattern,
-                        "pattern_action": pattern_action
-                    })
-                    if re.fullmatch(pattern, self.email, re.IGNORECASE) is not None:
-                        action = pattern_action
-                        break
-
-            if action:
-                self._update_action(action)
+            with span("challenge_handler", {"handler": type(handler).__name__, "emails": 1}):
+                self._apply_handler_action(handler.get_action(self.email), handler.get_patterns)
+
+    def _apply_handler_action(self, action: Optional[Action], get_patterns: Callable[[], Iterable]) -> None:
+        """
+        Applies the result of a single handler. If the handler had no exact
+        match then its patterns are tried instead.
+        """
+        if not action:
+            matcher = get_matcher()
+
+            for (pattern, pattern_action) in get_patterns():
+                logger.debug("Handling pattern %(pattern)s which would result in %(pattern_action)s", {
+                    "pattern": pattern,
+                    "pattern_action": pattern_action
+                })
+                if matcher.fullmatch(pattern, self.email):
+                    action = pattern_action
+                    break
+
+        if action:
+            self._update_action(action)
+
+
+def look_up_challenges(emails: list[str], handlers: list) -> list[Challenge]:
+    """
+    Creates and hydrates the challenges for a list of emails together.
+
+    Handlers that provide `get_actions` resolve all the emails in one lookup,
+    others fall back to a lookup per email. The patterns are only retrieved
+    once per handler, and only if needed.
+    """
+    challenges = [Challenge(email, handlers) for email in emails]
+    unique_emails = list(dict.fromkeys(emails))
+
+    for handler in handlers:
+        with span("challenge_handler", {"handler": type(handler).__name__, "emails": len(unique_emails)}):
+            if hasattr(handler, "get_actions"):
+                actions = handler.get_actions(unique_emails)
+            else:
+                actions = {email: handler.get_action(email) for email in unique_emails}
+
+            patterns = None
+
+            def get_patterns() -> list:
+                nonlocal patterns
+                if patterns is None:
+                    patterns = list(handler.get_patterns() or [])
+                return patterns
+
+            for challenge in challenges:
+                challenge._apply_handler_action(actions.get(challenge.email), get_patterns)
+
+    for challenge in challenges:
+        challenge.hydrated = True
+
+    return challenges
@@ -4,6 +4,7 @@ from typing import Optional, Iterable
 from config import Config
 
 from src.db import get_db_pool
+from src.rules import most_specific, parent_domains
 
 from .typing import Action
 
@@ -15,11 +16,17 @@ class HandlerInternal:
     def __init__(self, app_config: Config) -> None:
         self.app_config = app_config
 
+    def warm_up(self) -> None:
+        """
+        Opens the database pool used for lookups.
+        """
+        get_db_pool(self.app_config["db"], "db", read_only=True)
+
     def get_action(self, email: str) -> Optional[Action]:
         """
         Return any action for the given challenge email
         """
-        with get_db_pool(self.app_config["db"], "db").connection() as connection:
+        with get_db_pool(self.app_config["db"], "db", read_only=True).connection() as connection:
             with connection.cursor() as cursor:
                 cursor.execute(
                     """
@@ -36,13 +43,76 @@ class HandlerInternal:
                 if result:
                     return result[0]
 
+                # Failing that, the most specific domain rule is used
+                cursor.execute(
+                    """
+                    SELECT
+                        action_to_take
+                        FROM challenges
+                        WHERE challenge = ANY(%(domains)s) AND challenge_type='D'
+                        ORDER BY length(challenge) DESC
+                        LIMIT 1
+                    """,
+                    {"domains": parent_domains(email)}
+                )
+
+                result = cursor.fetchone()
+
+                if result:
+                    return result[0]
+
         return None
 
+    def get_actions(self, emails: list[str]) -> dict[str, Action]:
+        """
+        Return any actions for the given challenge emails, in one lookup
+        """
+        if not emails:
+            return {}
+
+        with get_db_pool(self.app_config["db"], "db", read_only=True).connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT
+                        challenge, action_to_take
+                        FROM challenges
+                        WHERE challenge = ANY(%(challenges)s) AND challenge_type='E'
+                    """,
+                    {"challenges": emails}
+                )
+
+                actions = {challenge: action for (challenge, action) in cursor.fetchall()}
+
+                # The domain rules for the rest are looked up together
+                unmatched = [email for email in emails if email not in actions]
+
+                if unmatched:
+                    cursor.execute(
+                        """
+                        SELECT
+                            challenge, action_to_take
+                            FROM challenges
+                            WHERE challenge = ANY(%(domains)s) AND challenge_type='D'
+                        """,
+                        {"domains": list({domain for email in unmatched for domain in parent_domains(email)})}
+                    )
+
+                    domain_actions = dict(cursor.fetchall())
+
+                    for email in unmatched:
+                        action = most_specific(email, domain_actions)
+
+                        if action:
+                            actions[email] = action
+
+                return actions
+
     def get_patterns(self) -> Iterable[tuple[str, str]]:
         """
         Returns any pattern-type actions
         """
-        with get_db_pool(self.app_config["db"], "db").connection() as connection:
+        with get_db_pool(self.app_config["db"], "db", read_only=True).connection() as connection:
             with connection.cursor() as cursor:
                 cursor.execute(
                     """
@@ -26,6 +26,12 @@ class HandlerQuery:
         """
         return email.split('@', maxsplit=1)
 
+    def warm_up(self) -> None:
+        """
+        Opens the database pool used for lookups.
+        """
+        get_db_pool(self._get_db_config(), self._get_name(), read_only=True)
+
     def get_action(self, email: str) -> Optional[Action]:
         """
         Return any action for the given challenge email
@@ -38,7 +44,7 @@ class HandlerQuery:
         (local_part, domain) = self._split_email(email)
 
         try:
-            with get_db_pool(self._get_db_config(), self._get_name()).connection() as connection:
+            with get_db_pool(self._get_db_config(), self._get_name(), read_only=True).connection() as connection:
                 with connection.cursor() as cursor:
                     cursor.execute(
                         self.handler_config["action_query"],
@@ -63,6 +69,60 @@ class HandlerQuery:
 
         return None
 
+    def get_actions(self, emails: list[str]) -> dict[str, Action]:
+        """
+        Return any actions for the given challenge emails.
+
+        If a `batch_action_query` is configured then all the emails are looked
+        up in a single query, with the `local_parts` and `domains` query
+        parameters being arrays. Each row should be the local part, domain and
+        action. Otherwise each email is looked up with the `action_query`.
+        """
+
+        if "batch_action_query" not in self.handler_config:
+            return {email: self.get_action(email) for email in emails}
+
+        if not emails:
+            return {}
+
+        split_emails = [self._split_email(email) for email in emails]
+
+        # The database may return the parts in a different case, eg if it
+        # stores them lowercase, so they are matched ignoring case.
+        emails_by_parts = {
+            (local_part.lower(), domain.lower()): email for (email, (local_part, domain)) in zip(emails, split_emails)
+        }
+
+        try:
+            with get_db_pool(self._get_db_config(), self._get_name(), read_only=True).connection() as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        self.handler_config["batch_action_query"],
+                        {
+                            "local_parts": [local_part for (local_part, _) in split_emails],
+                            "domains": [domain for (_, domain) in split_emails],
+                        }
+                    )
+
+                    actions = {}
+
+                    for (local_part, domain, action) in cursor.fetchall():
+                        email = emails_by_parts.get((local_part.lower(), domain.lower()))
+
+                        # Only the first result is used for each email
+                        if email and email not in actions:
+                            actions[email] = action
+
+                    return actions
+
+        except Exception as e:
+            logger.error("Failed to execute batch action query for %(name)s: %(reason)s", {
+                "name": self._get_name(),
+                "reason": str(e)
+            })
+
+        return {}
+
     def get_patterns(self) -> Iterable[tuple[str, str]]:
         """
         Returns any pattern-type actions
@@ -73,7 +133,7 @@ class HandlerQuery:
             return []
 
         try:
-            with get_db_pool(self._get_db_config(), self._get_name()).connection() as connection:
+            with get_db_pool(self._get_db_config(), self._get_name(), read_only=True).connection() as connection:
                 with connection.cursor() as cursor:
                     cursor.execute(
                         self.handler_config["pattern_query"],
@@ -5,12 +5,18 @@ handlers = []
 
 
 def init_handlers(services) -> None:
+    """
+    Creates the challenge handlers from the `challenges` configuration. They
+    are built afresh each time, so that a reloaded configuration replaces
+    them rather than adding to them.
+    """
     app_config = services["app_config"]
+    configured = []
 
     for challenge_config in app_config.get("challenges", [{}]):
         if "type" not in challenge_config or challenge_config["type"] == "internal":
-            handlers.append(HandlerInternal(app_config))
+            configured.append(HandlerInternal(app_config))
         elif challenge_config["type"] == "query":
-            handlers.append(HandlerQuery(challenge_config))
+            configured.append(HandlerQuery(challenge_config))
 
-    services["challenge_handlers"] = handlers
+    services["challenge_handlers"] = configured
@@ -1,37 +1,303 @@
 import logging
+import threading
+import time
+from itertools import count
 from typing import Optional
 
 import psycopg
 from psycopg_pool import ConnectionPool
 
+from src.tracing import is_tracing, span
+
 
 logger = logging.getLogger(__name__)
 
 
 pool_cache: dict[str, ConnectionPool] = {}
 
+# Replica pools are tracked separately as each entry also records the last
+# known replication lag, and when it was measured.
+replica_cache: dict[str, list[dict]] = {}
 
-def get_db_pool(config_fragment: dict, cache_key: Optional[str] = None) -> ConnectionPool:
-    global pool_cache
+replica_counter = count()
 
-    if not cache_key or cache_key not in pool_cache:
-        try:
-            pool = ConnectionPool(kwargs={
-                    "dbname": config_fragment.get("name", "postconfirm"),
-                    "user": config_fragment.get("user", "postconfirm"),
-                    "password": config_fragment.get("password", None),
-                    "host": config_fragment.get("host", "localhost"),
-                    "port": config_fragment.get("port", 5432)
-            })
-        except psycopg.OperationalError as e:
-            print(f"The error '{e}' occurred")
-            raise e
-
-        pool.open(wait=True)
+# Lookups may run in worker threads, so pool creation is serialised to avoid
+# creating duplicate pools.
+pool_lock = threading.RLock()
+
+CONNECTION_KEYS = ["name", "user", "password", "host", "port"]
+
+# How long, in seconds, before a replica that could not be opened is tried
+# again, unless configured with `replica_retry_interval`.
+REPLICA_RETRY_INTERVAL = 60
+
+# How long, in seconds, to wait for a replica's connections when opening it,
+# unless configured with `replica_open_timeout`. Lookups use the primary
+# while a replica is being opened, so this only bounds the caller opening it.
+REPLICA_OPEN_TIMEOUT = 5
+
+# How long, in seconds, to wait for the primary's connections when opening it.
+OPEN_TIMEOUT = 30
+
+
+class TracedCursor(psycopg.Cursor):
+    """
+    A cursor that records each statement as a span of the current trace.
+    """
+
+    def _span(self, query):
+        if not is_tracing():
+            return span("sql")
+
+        return span("sql", {
+            "db.system": "postgresql",
+            "db.name": self.connection.info.dbname,
+            "server.address": self.connection.info.host,
+            "db.statement": query if isinstance(query, (str, bytes)) else query.as_string(self),
+        })
+
+    def execute(self, query, params=None, **kwargs):
+        with self._span(query):
+            return super().execute(query, params, **kwargs)
+
+    def executemany(self, query, params_seq, **kwargs):
+        with self._span(query):
+            return super().executemany(query, params_seq, **kwargs)
+
+
+def _make_pool(config_fragment: dict, timeout: float = OPEN_TIMEOUT) -> ConnectionPool:
+    try:
+        pool = ConnectionPool(kwargs={
+                "dbname": config_fragment.get("name", "postconfirm"),
+                "user": config_fragment.get("user", "postconfirm"),
+                "password": config_fragment.get("password", None),
+                "host": config_fragment.get("host", "localhost"),
+                "port": config_fragment.get("port", 5432),
+                "cursor_factory": TracedCursor,
+        }, open=False)
+    except psycopg.OperationalError as e:
+        logger.error("Unable to create the pool for %(host)s: %(reason)s", {
+            "host": config_fragment.get("host", "localhost"),
+            "reason": str(e)
+        })
+        raise e
+
+    try:
+        pool.open(wait=True, timeout=timeout)
+    except Exception:
+        # Stop the pool's workers, which would otherwise keep trying to connect
+        pool.close()
+        raise
+
+    return pool
 
-        if cache_key:
-            pool_cache[cache_key] = pool
 
-        return pool
+def _replica_config(config_fragment: dict, replica_fragment: dict) -> dict:
+    """
+    Builds the configuration for a replica. Any connection details that are
+    not given for the replica are taken from the primary.
+    """
+    return {
+        key: replica_fragment.get(key, config_fragment.get(key))
+        for key in CONNECTION_KEYS
+        if key in replica_fragment or key in config_fragment
+    }
+
+
+def _claim_replica(replica: dict, retry_interval: float) -> bool:
+    """
+    Returns whether the caller should open the replica's pool, marking it as
+    being opened if so. This is called with the `pool_lock` held, so that only
+    one caller opens each replica. A replica that could not be opened is not
+    tried again for `retry_interval` seconds.
+    """
+    if replica["pool"] is not None or replica["opening"]:
+        return False
+
+    if replica["failed"] is not None and time.monotonic() - replica["failed"] < retry_interval:
+        return False
+
+    replica["opening"] = True
+
+    return True
+
+
+def _open_replica(replica: dict, timeout: float) -> None:
+    """
+    Opens the pool for a replica claimed with `_claim_replica`. This is called
+    without the `pool_lock` held, so that other lookups carry on using the
+    primary, or the other replicas, while the connections are made.
+    """
+    try:
+        pool = _make_pool(replica["config"], timeout)
+        failed = None
+    except Exception as e:
+        logger.warning("Unable to open the pool for replica %(host)s, using the primary: %(reason)s", {
+            "host": replica["host"],
+            "reason": str(e)
+        })
+        pool = None
+        failed = time.monotonic()
+
+    with pool_lock:
+        replica.update({"pool": pool, "failed": failed, "opening": False})
+
+
+def _get_replicas(config_fragment: dict, cache_key: Optional[str]) -> list[dict]:
+    if cache_key and cache_key in replica_cache:
+        replicas = replica_cache[cache_key]
     else:
+        replicas = [
+            {
+                "config": _replica_config(config_fragment, replica_fragment),
+                "pool": None,
+                "opening": False,
+                "failed": None,
+                "host": replica_fragment.get("host", config_fragment.get("host", "localhost")),
+                "lag": None,
+                "checked": None,
+            }
+            for replica_fragment in config_fragment.get("replicas", [])
+        ]
+
+        if cache_key:
+            replica_cache[cache_key] = replicas
+
+    return replicas
+
+
+def _replica_lag(replica: dict, check_interval: float) -> Optional[float]:
+    """
+    Returns the replication lag of the replica in seconds, or None if it could
+    not be determined. The value is only re-measured every `check_interval`
+    seconds.
+    """
+    now = time.monotonic()
+
+    if replica["checked"] is not None and now - replica["checked"] < check_interval:
+        return replica["lag"]
+
+    try:
+        with replica["pool"].connection() as connection:
+            with connection.cursor() as cursor:
+                # An idle primary never replays anything, so a replica that is
+                # fully caught up is treated as having no lag.
+                cursor.execute(
+                    """
+                    SELECT
+                        CASE
+                            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+                        END
+                    """
+                )
+                result = cursor.fetchone()
+                lag = float(result[0]) if result and result[0] is not None else None
+    except Exception as e:
+        logger.warning("Unable to determine replication lag for %(host)s: %(reason)s", {
+            "host": replica["host"],
+            "reason": str(e)
+        })
+        lag = None
+
+    replica["lag"] = lag
+    replica["checked"] = now
+
+    return lag
+
+
+def _get_replica_pool(config_fragment: dict, cache_key: Optional[str]) -> Optional[ConnectionPool]:
+    """
+    Returns the pool for a usable replica, chosen round-robin. A replica is
+    usable if its pool could be opened and its replication lag is within
+    `max_replica_lag` seconds. If `max_replica_lag` is not configured then
+    lag is not checked.
+    """
+    retry_interval = float(config_fragment.get("replica_retry_interval", REPLICA_RETRY_INTERVAL))
+    open_timeout = float(config_fragment.get("replica_open_timeout", REPLICA_OPEN_TIMEOUT))
+
+    with pool_lock:
+        replicas = _get_replicas(config_fragment, cache_key)
+        claimed = [replica for replica in replicas if _claim_replica(replica, retry_interval)]
+
+    for replica in claimed:
+        _open_replica(replica, open_timeout)
+
+    replicas = [replica for replica in replicas if replica["pool"] is not None]
+
+    if not replicas:
+        if config_fragment.get("replicas"):
+            logger.info("No replica could be opened, falling back to the primary")
+
+        return None
+
+    max_lag = config_fragment.get("max_replica_lag", None)
+    check_interval = float(config_fragment.get("replica_lag_interval", 5))
+
+    start = next(replica_counter)
+
+    for offset in range(len(replicas)):
+        replica = replicas[(start + offset) % len(replicas)]
+
+        if max_lag is None:
+            return replica["pool"]
+
+        lag = _replica_lag(replica, check_interval)
+
+        if lag is not None and lag <= float(max_lag):
+            return replica["pool"]
+
+        logger.debug("Skipping replica %(host)s with lag %(lag)s", {
+            "host": replica["host"],
+            "lag": lag
+        })
+
+    logger.info("No replica within the permitted lag, falling back to the primary")
+
+    return None
+
+
+def get_db_pool(config_fragment: dict, cache_key: Optional[str] = None, read_only: bool = False) -> ConnectionPool:
+    """
+    Returns a connection pool for the configured database.
+
+    If `read_only` is set and the configuration has `replicas` then a pool for
+    one of the replicas will be returned instead, as long as it is not lagging
+    too far behind the primary.
+    """
+    global pool_cache
+
+    if read_only and config_fragment.get("replicas"):
+        replica_pool = _get_replica_pool(config_fragment, cache_key)
+
+        if replica_pool:
+            return replica_pool
+
+    if cache_key and cache_key in pool_cache:
         return pool_cache[cache_key]
+
+    with pool_lock:
+        if not cache_key or cache_key not in pool_cache:
+            pool = _make_pool(config_fragment)
+
+            if cache_key:
+                pool_cache[cache_key] = pool
+
+            return pool
+        else:
+            return pool_cache[cache_key]
+
+
+def get_pools() -> dict[str, ConnectionPool]:
+    """
+    Returns the open connection pools, by name. The pools of replicas are
+    named after their database and host, eg `default:replica1`.
+    """
+    pools = dict(pool_cache)
+
+    for (name, replicas) in list(replica_cache.items()):
+        for replica in replicas:
+            if replica["pool"] is not None:
+                pools[f"{name}:{replica['host']}"] = replica["pool"]
+
+    return pools
@@ -0,0 +1,10 @@
+from .lifecycle import Lifecycle, build_services
+from .warmup import report_startup, run_warm_up, warm_up
+
+__all__ = [
+    "Lifecycle",
+    "build_services",
+    "report_startup",
+    "run_warm_up",
+    "warm_up",
+]
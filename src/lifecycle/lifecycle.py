@@ -0,0 +1,207 @@
+import logging
+import signal
+from typing import Callable, Optional
+
+import anyio
+import config
+from anyio.abc import Listener, TaskGroup
+from config import Config
+
+from src import Generation, Services, services as default_services
+from src.challenge import init_handlers as init_challenge_handlers
+from src.outbox import Outbox
+from src.remailer import Remailer
+from src.rules import make_matcher
+from src.sender import make_sender_keys
+from src.templates import TemplateCache
+from src.validator import Validator
+
+from .warmup import run_warm_up
+
+logger = logging.getLogger(__name__)
+
+# How often a retired generation is checked for sessions still using it
+RETIRE_POLL_INTERVAL = 0.5
+
+
+def build_services(app_config: Config) -> Generation:
+    """
+    Builds a generation of the services from the configuration.
+    """
+    outbox = Outbox(app_config)
+    generation = Generation(
+        app_config=app_config,
+        remailer=Remailer(app_config, outbox=outbox),
+        validator=Validator(app_config),
+        outbox=outbox,
+        templates=TemplateCache(float(app_config.get("mail_template_check_interval", 5))),
+        patterns=make_matcher(app_config),
+        sender_keys=make_sender_keys(app_config),
+        # Filled on first use, from this generation's configuration
+        sender_handlers={},
+        header_drop_matchers={},
+    )
+
+    init_challenge_handlers(generation)
+
+    return generation
+
+
+class Lifecycle:
+    """
+    Serves milter sessions, and handles the signals that control the service:
+
+    * SIGHUP reloads the configuration, and rebuilds the services from it.
+    Sessions that are in flight finish with the services they started with,
+    which are then closed.
+    * SIGTERM (or SIGINT) drains the service: no further connections are
+    accepted, and the sessions in flight are given up to
+    `shutdown.drain_timeout` seconds to finish. A second signal stops it
+    immediately.
+
+    The listener, status endpoints, database pools and logging are kept
+    across reloads, so changes to their settings need a restart.
+    """
+
+    def __init__(
+        self,
+        config_path: str,
+        app_config: Config,
+        services: Services = default_services,
+        on_drain: Optional[Callable[[], None]] = None,
+    ) -> None:
+        self.config_path = config_path
+        self.services = services
+        self.on_drain = on_drain
+        self.drain_timeout = float(app_config.get("shutdown.drain_timeout", 25))
+
+        self.tasks: Optional[TaskGroup] = None
+        self.accepting: Optional[anyio.CancelScope] = None
+        self.sessions: Optional[TaskGroup] = None
+        self.draining = False
+        self.workers_done: dict[int, anyio.Event] = {}
+
+    def load_config(self) -> Config:
+        return config.Config(self.config_path)
+
+    async def run_outbox(self, generation: Generation) -> None:
+        """
+        Runs the outbox workers for a generation, until they are stopped.
+        They run even if the outbox is not enabled, to send the mail that
+        is queued when it would wait too long for the rate limits.
+        """
+        done = self.workers_done.setdefault(id(generation), anyio.Event())
+
+        try:
+            outbox = generation["outbox"]
+
+            if outbox.workers:
+                await outbox.run(generation["remailer"])
+        finally:
+            done.set()
+
+    async def retire(self, generation: Generation) -> None:
+        """
+        Closes a generation's services once nothing is using them.
+        """
+        generation["outbox"].stop()
+
+        while generation.sessions:
+            await anyio.sleep(RETIRE_POLL_INTERVAL)
+
+        done = self.workers_done.pop(id(generation), None)
+
+        if done:
+            await done.wait()
+
+        await generation["remailer"].close()
+
+        logger.debug("Retired the previous services")
+
+    async def reload(self) -> bool:
+        """
+        Reloads the configuration and replaces the services. If either
+        fails then the current services are kept. Returns whether the
+        services were replaced.
+
+        The new services are warmed up before they replace the current ones.
+        """
+        try:
+            app_config = self.load_config()
+            generation = build_services(app_config)
+        except Exception as e:
+            logger.error("Unable to reload the configuration, keeping the current one: %(reason)s", {
+                "reason": str(e)
+            })
+            return False
+
+        await run_warm_up(generation)
+
+        self.tasks.start_soon(self.run_outbox, generation)
+
+        previous = self.services.swap(generation)
+
+        logging.getLogger().setLevel(app_config.get("log.level", logging.INFO))
+
+        self.tasks.start_soon(self.retire, previous)
+
+        logger.info("Reloaded the configuration from %(path)s", {"path": self.config_path})
+
+        return True
+
+    def drain(self) -> None:
+        """
+        Stops accepting connections, and gives the sessions in flight until
+        the drain timeout to finish.
+        """
+        if self.draining:
+            logger.warning("Stopping without waiting for the sessions in flight")
+            self.sessions.cancel_scope.cancel()
+            return
+
+        logger.info("Draining, waiting up to %(timeout)ss for the sessions in flight", {
+            "timeout": self.drain_timeout
+        })
+
+        self.draining = True
+
+        if self.on_drain:
+            self.on_drain()
+
+        self.accepting.cancel()
+        self.sessions.cancel_scope.deadline = anyio.current_time() + self.drain_timeout
+
+    async def handle_signals(self) -> None:
+        with anyio.open_signal_receiver(signal.SIGHUP, signal.SIGTERM, signal.SIGINT) as signals:
+            async for signum in signals:
+                if signum == signal.SIGHUP:
+                    await self.reload()
+                else:
+                    self.drain()
+
+    async def serve(self, listener: Listener, handler: Callable) -> None:
+        """
+        Serves the milter on the listener until drained.
+        """
+        async with anyio.create_task_group() as tasks:
+            self.tasks = tasks
+
+            tasks.start_soon(self.handle_signals)
+            tasks.start_soon(self.run_outbox, self.services.current)
+
+            async with anyio.create_task_group() as sessions:
+                self.sessions = sessions
+
+                with anyio.CancelScope() as accepting:
+                    self.accepting = accepting
+                    await listener.serve(handler, task_group=sessions)
+
+                # Connections are refused whilst the sessions drain
+                await listener.aclose()
+
+            logger.info("Sessions drained, stopping")
+
+            with anyio.move_on_after(self.drain_timeout):
+                await self.retire(self.services.current)
+
+            tasks.cancel_scope.cancel()
@@ -0,0 +1,158 @@
+import logging
+import re
+import time
+from typing import Callable, Iterable, Optional
+
+import anyio
+
+from src import Generation, services
+from src.metrics import Gauge, registry
+from src.sender import get_default_handler, get_sender
+from src.templates import template_paths
+
+logger = logging.getLogger(__name__)
+
+startup_seconds = registry.register(Gauge(
+    "postconfirm_startup_seconds", "Time from starting until milter connections were accepted"
+))
+warmup_seconds = registry.register(Gauge(
+    "postconfirm_warmup_seconds", "Time taken by each step of the warm-up", ["step"]
+))
+
+
+def _handlers(generation: Generation) -> list:
+    return [*generation.get("challenge_handlers", []), get_default_handler()]
+
+
+def open_pools(generation: Generation) -> None:
+    """
+    Opens the database pools used by the handlers, which fills each of them
+    to its minimum size.
+    """
+    for handler in _handlers(generation):
+        if hasattr(handler, "warm_up"):
+            handler.warm_up()
+
+
+def compile_patterns(generation: Generation) -> None:
+    """
+    Compiles and lints the handlers' patterns, so that the first lookups do
+    not have to and any hazardous patterns are reported at start.
+    """
+    for handler in _handlers(generation):
+        for pattern in handler.get_patterns() or []:
+            try:
+                generation["patterns"].compile(pattern[0])
+            except re.error as e:
+                logger.warning("Unable to compile the pattern %(pattern)s: %(reason)s", {
+                    "pattern": pattern[0],
+                    "reason": str(e),
+                })
+
+
+def load_templates(generation: Generation) -> None:
+    """
+    Parses the challenge templates, including any variants.
+    """
+    for path in template_paths(generation["app_config"]):
+        generation["templates"].get(path)
+
+
+def read_hot_senders(path: str, limit: int) -> list[str]:
+    """
+    Reads up to `limit` addresses, one per line, ignoring blank lines and
+    comments.
+    """
+    senders = []
+
+    with open(path, "r") as senders_file:
+        for line in senders_file:
+            sender = line.strip()
+
+            if sender and not sender.startswith("#"):
+                senders.append(sender)
+
+                if len(senders) >= limit:
+                    break
+
+    return senders
+
+
+def replay_senders(senders: Iterable[str]) -> None:
+    """
+    Looks up each of the senders, so that their rows are in the database's
+    caches before their mail arrives.
+    """
+    for sender in senders:
+        get_sender(sender).look_up_action_data()
+
+
+def _step(name: str, func: Callable[[], None]) -> bool:
+    start = time.perf_counter()
+
+    try:
+        func()
+    except Exception as e:
+        logger.warning("Warm-up step %(step)s failed: %(reason)s", {"step": name, "reason": str(e)})
+        return False
+    finally:
+        warmup_seconds.set(time.perf_counter() - start, step=name)
+
+    return True
+
+
+def warm_up(generation: Generation, hot_senders: Optional[str] = None) -> bool:
+    """
+    Prepares a generation of the services for milter sessions. A step that
+    fails is logged and skipped, as the sessions will do the same work
+    lazily. Returns whether every step succeeded.
+
+    The generation is pinned throughout, as on reload it is warmed up before
+    it becomes current.
+    """
+    app_config = generation["app_config"]
+    limit = int(app_config.get("warmup.hot_senders_limit", 1000))
+
+    steps = [
+        ("pools", lambda: open_pools(generation)),
+        ("patterns", lambda: compile_patterns(generation)),
+        ("templates", lambda: load_templates(generation)),
+    ]
+
+    if hot_senders:
+        steps.append(("hot_senders", lambda: replay_senders(read_hot_senders(hot_senders, limit))))
+
+    with services.pin(generation):
+        return all([_step(name, func) for (name, func) in steps])
+
+
+async def run_warm_up(generation: Generation, hot_senders: Optional[str] = None) -> bool:
+    """
+    Warms up a generation in a worker thread, giving up on it after
+    `warmup.timeout` seconds so that a slow database cannot hold up startup
+    indefinitely.
+    """
+    timeout = float(generation["app_config"].get("warmup.timeout", 30))
+    start = time.perf_counter()
+
+    with anyio.move_on_after(timeout):
+        warmed_up = await anyio.to_thread.run_sync(warm_up, generation, hot_senders, abandon_on_cancel=True)
+
+        logger.info("Warmed up in %(elapsed).3fs", {"elapsed": time.perf_counter() - start})
+
+        return warmed_up
+
+    logger.warning("Warm-up did not finish within %(timeout)ss, continuing without it", {"timeout": timeout})
+
+    return False
+
+
+def report_startup(started: float) -> None:
+    """
+    Records the time since `started`, from `time.monotonic()`, as the
+    startup time.
+    """
+    elapsed = time.monotonic() - started
+    startup_seconds.set(elapsed)
+
+    logger.info("Accepting milter connections after %(elapsed).3fs", {"elapsed": elapsed})
@@ -0,0 +1,6 @@
+from .log import JSONFormatter, configure_logging
+
+__all__ = [
+    "JSONFormatter",
+    "configure_logging",
+]
@@ -0,0 +1,96 @@
+import json
+import logging
+import queue
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+from config import Config
+
+LOG_LINE_FORMAT = "{asctime} postconfirm/postconfirm[{process}]: {message} [{filename}:{lineno}]"
+LOG_DATE_FORMAT = "%b %d %H:%M:%S"
+LOG_ROTATE_PERIOD = "D"
+LOG_ROTATE_INTERVAL = 1
+LOG_ROTATE_KEEP = 5
+
+# The fields given to the outcome of each session, which every JSON line
+# has so that they can be relied on when searching.
+SESSION_FIELDS = ("queue_id", "sender", "verdict", "stages")
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats each record as a line of JSON, with the session fields set to
+    null where the record has none.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "message": record.getMessage(),
+        }
+
+        for field in SESSION_FIELDS:
+            entry[field] = getattr(record, field, None)
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        entry["source"] = f"{record.filename}:{record.lineno}"
+
+        return json.dumps(entry, default=str)
+
+
+def make_formatter(log_format: str) -> logging.Formatter:
+    if log_format == "json":
+        return JSONFormatter()
+
+    if log_format != "text":
+        raise ValueError(f"Unknown log format {log_format}")
+
+    return logging.Formatter(style="{", datefmt=LOG_DATE_FORMAT, fmt=LOG_LINE_FORMAT)
+
+
+def configure_logging(app_config: Config) -> QueueListener:
+    """
+    Sets up the root logger to hand each record to a queue, which is written
+    out to stderr and the log file by a background thread. This keeps the
+    file writes, and their rollover, off the event loop.
+
+    The listener is returned started, and should be stopped on exit so that
+    the queue is flushed.
+    """
+    log_level = app_config.get("log.level", logging.INFO)
+    log_filename = app_config.get("log.filename", "/var/log/postconfirm/postconfirm.log")
+    formatter = make_formatter(str(app_config.get("log.format", "text")))
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(formatter)
+
+    file_handler = TimedRotatingFileHandler(
+        log_filename,
+        when=LOG_ROTATE_PERIOD,
+        interval=LOG_ROTATE_INTERVAL,
+        backupCount=LOG_ROTATE_KEEP,
+    )
+    file_handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, stream_handler, file_handler, respect_handler_level=True)
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(log_level)
+
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+
+    root_logger.addHandler(QueueHandler(log_queue))
+
+    logging.getLogger("kilter.service").disabled = True
+
+    listener.start()
+
+    return listener
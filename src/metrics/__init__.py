@@ -0,0 +1,12 @@
+from .metrics import Counter, Gauge, Histogram, Registry, registry
+from .server import StatusServer, metrics_route
+
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "Registry",
+    "registry",
+    "StatusServer",
+    "metrics_route",
+]
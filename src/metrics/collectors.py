@@ -0,0 +1,85 @@
+from src.db import db
+from src.tracing import tracer
+
+from .metrics import Counter, Gauge, Registry, registry as default_registry
+
+# The psycopg_pool statistics that are exposed, and the state they are
+# labelled with.
+DB_POOL_STATS = {"pool_size": "size", "pool_available": "available", "requests_waiting": "waiting"}
+
+
+def collect_db_pools() -> dict[tuple[str, str], int]:
+    values = {}
+
+    for (name, pool) in db.get_pools().items():
+        stats = pool.get_stats()
+
+        for (stat, state) in DB_POOL_STATS.items():
+            values[(name, state)] = stats.get(stat, 0)
+
+    return values
+
+
+def collect_replica_lag() -> dict[tuple[str], float]:
+    return {
+        (replica["host"],): replica["lag"]
+        for replicas in db.replica_cache.values()
+        for replica in replicas
+    }
+
+
+def register_service_metrics(services: dict, registry: Registry = default_registry) -> None:
+    """
+    Registers the metrics that are read from the services, their pools and
+    statistics when the metrics are rendered.
+    """
+    def smtp_pool() -> dict[tuple[str], int]:
+        pool = getattr(services.get("remailer"), "pool", None)
+
+        if not pool:
+            return {}
+
+        return {("size",): pool.size, ("in_use",): pool.in_use, ("idle",): len(pool.idle)}
+
+    def smtp_limits(stat: str) -> dict[tuple[str], float]:
+        limiter = getattr(services.get("remailer"), "limiter", None)
+
+        if not limiter:
+            return {}
+
+        return {(domain,): stats[stat] for (domain, stats) in limiter.stats().items()}
+
+    metrics = [
+        Gauge(
+            "postconfirm_db_pool_connections", "Database pool connections, by pool and state",
+            ["pool", "state"], collect=collect_db_pools
+        ),
+        Gauge(
+            "postconfirm_db_replica_lag_seconds", "The last measured replication lag of each replica",
+            ["host"], collect=collect_replica_lag
+        ),
+        Gauge(
+            "postconfirm_smtp_pool_connections", "SMTP pool sessions, by state",
+            ["state"], collect=smtp_pool
+        ),
+        Gauge(
+            "postconfirm_smtp_limit_waiting", "Outbound messages waiting on a rate limit, by domain (* is global)",
+            ["domain"], collect=lambda: smtp_limits("waiting")
+        ),
+        Counter(
+            "postconfirm_smtp_limit_sent_total", "Outbound messages sent through a rate limit, by domain",
+            ["domain"], collect=lambda: smtp_limits("sent")
+        ),
+        Gauge(
+            "postconfirm_smtp_limit_wait_max_seconds", "The longest wait on a rate limit, by domain",
+            ["domain"], collect=lambda: smtp_limits("max_wait")
+        ),
+        Counter(
+            "postconfirm_trace_spans_total", "Trace spans, by whether they were exported or dropped",
+            ["result"], collect=lambda: {("exported",): tracer.exported, ("dropped",): tracer.dropped}
+        ),
+    ]
+
+    for metric in metrics:
+        registry.unregister(metric.name)
+        registry.register(metric)
@@ -0,0 +1,163 @@
+import logging
+import time
+from typing import Optional
+
+import anyio
+from config import Config
+
+from src.db import db
+from src.milter.processor import sessions_in_flight
+
+from .metrics import Gauge, Registry, registry as default_registry
+from .server import Route
+
+logger = logging.getLogger(__name__)
+
+# Lookups queue briefly for a connection in any burst, so readiness only
+# fails once more than this many are waiting on one pool, unless configured
+# with `health.max_db_waiting`.
+MAX_DB_WAITING = 5
+
+
+class HealthMonitor:
+    """
+    Works out whether postconfirm is alive, and whether it is ready for more
+    milter sessions, for the liveness and readiness probes.
+
+    It is alive as long as the event loop keeps up: a heartbeat task measures
+    how late the loop wakes it, which is the time any session would have
+    been kept waiting.
+
+    It is ready unless any of these are true:
+
+    * it is still starting, before accepting milter connections
+    * it is draining, before shutting down
+    * `health.max_sessions` or more sessions are in flight
+    * more than `health.max_db_waiting` lookups are waiting on a connection
+    from any database pool, including those of the replicas
+    * the SMTP server could not be reached at the last check
+
+    The thresholds should be set below the point of overload, so that new
+    sessions go elsewhere before the ones in flight slow down.
+    """
+
+    def __init__(self, app_config: Config, registry: Registry = default_registry) -> None:
+        max_sessions = app_config.get("health.max_sessions")
+
+        self.max_sessions = int(max_sessions) if max_sessions else None
+        self.max_db_waiting = int(app_config.get("health.max_db_waiting", MAX_DB_WAITING))
+        self.max_loop_lag = float(app_config.get("health.max_loop_lag", 5))
+        self.loop_interval = float(app_config.get("health.loop_interval", 1))
+        self.smtp_check_interval = float(app_config.get("health.smtp_check_interval", 10))
+        self.smtp_timeout = float(app_config.get("health.smtp_timeout", 3))
+        self.smtp_host = app_config.get("smtp_host", "localhost")
+        self.smtp_port = int(app_config.get("smtp_port", 25))
+
+        self.loop_lag = 0.0
+        self.last_beat = time.monotonic()
+        self.smtp_reachable: Optional[bool] = None
+        self.starting = False
+        self.draining = False
+
+        metrics = [
+            Gauge(
+                "postconfirm_event_loop_lag_seconds", "How late the event loop last woke the heartbeat",
+                collect=lambda: self.loop_lag
+            ),
+            Gauge(
+                "postconfirm_ready", "Whether the readiness checks pass",
+                collect=lambda: 0 if self.readiness() else 1
+            ),
+        ]
+
+        for metric in metrics:
+            registry.unregister(metric.name)
+            registry.register(metric)
+
+    def start_draining(self) -> None:
+        """
+        Marks postconfirm as not ready, as it is about to stop.
+        """
+        self.draining = True
+
+    def liveness(self) -> list[str]:
+        """
+        Returns the reasons that postconfirm is not alive, if any.
+        """
+        stalled = time.monotonic() - self.last_beat - self.loop_interval
+        lag = max(self.loop_lag, stalled)
+
+        if lag > self.max_loop_lag:
+            return [f"event loop lag of {lag:.3f}s"]
+
+        return []
+
+    def readiness(self) -> list[str]:
+        """
+        Returns the reasons that postconfirm is not ready, if any.
+        """
+        failures = self.liveness()
+
+        if self.starting:
+            failures.append("starting")
+
+        if self.draining:
+            failures.append("draining")
+
+        in_flight = sessions_in_flight.get()
+
+        if self.max_sessions and in_flight >= self.max_sessions:
+            failures.append(f"{in_flight:.0f} sessions in flight")
+
+        for (name, pool) in db.get_pools().items():
+            waiting = pool.get_stats().get("requests_waiting", 0)
+
+            if waiting > self.max_db_waiting:
+                failures.append(f"{waiting} lookups waiting for the {name} database")
+
+        if self.smtp_reachable is False:
+            failures.append(f"SMTP server {self.smtp_host}:{self.smtp_port} unreachable")
+
+        return failures
+
+    async def check_smtp(self) -> bool:
+        try:
+            with anyio.fail_after(self.smtp_timeout):
+                stream = await anyio.connect_tcp(self.smtp_host, self.smtp_port)
+                await stream.aclose()
+        except (OSError, TimeoutError) as e:
+            logger.warning("Unable to reach the SMTP server: %(reason)s", {"reason": str(e) or type(e).__name__})
+            return False
+
+        return True
+
+    async def watch_loop(self) -> None:
+        while True:
+            start = time.monotonic()
+            await anyio.sleep(self.loop_interval)
+            self.last_beat = time.monotonic()
+            self.loop_lag = max(0.0, self.last_beat - start - self.loop_interval)
+
+    async def watch_smtp(self) -> None:
+        while True:
+            self.smtp_reachable = await self.check_smtp()
+            await anyio.sleep(self.smtp_check_interval)
+
+    async def run(self) -> None:
+        async with anyio.create_task_group() as tasks:
+            tasks.start_soon(self.watch_loop)
+            tasks.start_soon(self.watch_smtp)
+
+    def _route(self, check) -> Route:
+        async def route() -> tuple[int, str, str]:
+            failures = check()
+
+            if failures:
+                return (503, "text/plain", "".join(f"{failure}\n" for failure in failures))
+
+            return (200, "text/plain", "ok\n")
+
+        return route
+
+    def routes(self) -> dict[str, Route]:
+        return {"/healthz": self._route(self.liveness), "/readyz": self._route(self.readiness)}
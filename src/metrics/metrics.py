@@ -0,0 +1,214 @@
+import math
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Optional, Sequence
+
+# Latency buckets, in seconds, from a millisecond to ten seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Sample = tuple[str, dict[str, str], float]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def _format_sample(name: str, labels: dict[str, str], value: float) -> str:
+    if labels:
+        label_text = ",".join(f'{key}="{_escape(label)}"' for (key, label) in labels.items())
+        return f"{name}{{{label_text}}} {_format_value(value)}"
+
+    return f"{name} {_format_value(value)}"
+
+
+class Metric(ABC):
+    """
+    A named metric, with values for each combination of its labels.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes the labels {', '.join(self.labels) or 'none'}")
+
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _labels(self, key: tuple[str, ...]) -> dict[str, str]:
+        return dict(zip(self.labels, key))
+
+    @abstractmethod
+    def samples(self) -> Iterable[Sample]:
+        pass
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        lines.extend(_format_sample(name, labels, value) for (name, labels, value) in self.samples())
+
+        return "\n".join(lines)
+
+
+class Value(Metric):
+    """
+    A metric with a single value for each combination of its labels.
+
+    Instead of being updated, the values can be taken from `collect` when the
+    metrics are rendered. It returns the value, or a dict of the values
+    keyed by a tuple of their labels. Values of None are left out.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: Sequence[str] = (),
+        collect: Optional[Callable[[], object]] = None,
+    ) -> None:
+        super().__init__(name, description, labels)
+        self.values: dict[tuple[str, ...], float] = {}
+        self.collect = collect
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterable[Sample]:
+        if self.collect:
+            collected = self.collect()
+
+            if not isinstance(collected, dict):
+                collected = {(): collected}
+
+            values = {tuple(str(label) for label in key): value for (key, value) in collected.items()}
+        else:
+            values = self.values
+
+        for (key, value) in values.items():
+            if value is not None:
+                yield (self.name, self._labels(key), value)
+
+
+class Counter(Value):
+    """
+    A count that only goes up.
+    """
+
+    type = "counter"
+
+
+class Gauge(Value):
+    """
+    A value that can go up and down.
+    """
+
+    type = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """
+    The distribution of observed values, eg latencies in seconds.
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self, name: str, description: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> None:
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.counts: dict[tuple[str, ...], list[int]] = {}
+        self.sums: dict[tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+
+        if key not in self.counts:
+            self.counts[key] = [0] * len(self.buckets)
+            self.sums[key] = 0.0
+
+        counts = self.counts[key]
+
+        for (index, bound) in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+
+        self.sums[key] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """
+        Observes the time taken by the block, including if it raises.
+        """
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterable[Sample]:
+        for (key, counts) in self.counts.items():
+            labels = self._labels(key)
+            cumulative = 0
+
+            for (bound, count) in zip(self.buckets, counts):
+                cumulative += count
+                yield (f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, cumulative)
+
+            yield (f"{self.name}_sum", labels, self.sums[key])
+            yield (f"{self.name}_count", labels, cumulative)
+
+
+class Registry:
+    """
+    The metrics to expose, rendered in the Prometheus text format.
+    """
+
+    def __init__(self) -> None:
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"A metric called {metric.name} is already registered")
+
+        self.metrics[metric.name] = metric
+
+        return metric
+
+    def unregister(self, name: str) -> None:
+        self.metrics.pop(name, None)
+
+    def render(self) -> str:
+        return "".join(f"{metric.render()}\n" for metric in self.metrics.values())
+
+
+registry = Registry()
@@ -0,0 +1,102 @@
+import logging
+from typing import Awaitable, Callable, Optional
+
+import anyio
+from anyio.abc import ByteStream
+
+from .metrics import Registry
+
+logger = logging.getLogger(__name__)
+
+# A route returns the status code, content type and body of the response
+Route = Callable[[], Awaitable[tuple[int, str, str]]]
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 503: "Service Unavailable"}
+
+MAX_REQUEST_SIZE = 8192
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def metrics_route(registry: Registry) -> Route:
+    """
+    Returns a route that renders the metrics in the registry.
+    """
+    async def route() -> tuple[int, str, str]:
+        return (200, METRICS_CONTENT_TYPE, registry.render())
+
+    return route
+
+
+class StatusServer:
+    """
+    A minimal HTTP server for the metrics and health endpoints.
+
+    Only GET (and HEAD) requests for the registered paths are answered, and
+    each connection serves a single request. This is meant for scrapers and
+    probes on a separate port, not for general use.
+    """
+
+    def __init__(self, routes: Optional[dict[str, Route]] = None, timeout: float = 5) -> None:
+        self.routes: dict[str, Route] = dict(routes or {})
+        self.timeout = timeout
+
+    def add_route(self, path: str, route: Route) -> None:
+        self.routes[path] = route
+
+    async def read_request(self, stream: ByteStream) -> bytes:
+        request = b""
+
+        while b"\r\n\r\n" not in request and b"\n\n" not in request:
+            if len(request) > MAX_REQUEST_SIZE:
+                break
+
+            request += await stream.receive()
+
+        return request
+
+    async def respond(self, request: bytes) -> tuple[int, str, str, bool]:
+        try:
+            (method, target, _) = request.split(b"\n", 1)[0].decode("ascii").strip().split(" ")
+        except (UnicodeDecodeError, ValueError):
+            return (400, "text/plain", "Bad request\n", False)
+
+        if method not in ("GET", "HEAD"):
+            return (405, "text/plain", "Method not allowed\n", False)
+
+        route = self.routes.get(target.split("?", 1)[0])
+
+        if not route:
+            return (404, "text/plain", "Not found\n", False)
+
+        (status, content_type, body) = await route()
+
+        return (status, content_type, body, method == "HEAD")
+
+    async def handle(self, stream: ByteStream) -> None:
+        async with stream:
+            try:
+                with anyio.fail_after(self.timeout):
+                    request = await self.read_request(stream)
+                    (status, content_type, body, head_only) = await self.respond(request)
+
+                    payload = body.encode()
+                    headers = (
+                        f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                        f"Content-Type: {content_type}\r\n"
+                        f"Content-Length: {len(payload)}\r\n"
+                        "Connection: close\r\n\r\n"
+                    ).encode()
+
+                    await stream.send(headers if head_only else headers + payload)
+            except (anyio.EndOfStream, anyio.BrokenResourceError, TimeoutError):
+                pass
+            except Exception as e:
+                logger.warning("Status request failed: %(reason)s", {"reason": str(e)})
+
+    async def serve(self, port: int) -> None:
+        listener = await anyio.create_tcp_listener(local_port=port)
+
+        logger.info("Serving status endpoints on port %(port)s", {"port": port})
+
+        await listener.serve(self.handle)
@@ -1,5 +1,7 @@
+from .listener import create_milter_listener
 from .processor import handle
 
 __all__ = [
+    "create_milter_listener",
     "handle"
 ]
@@ -0,0 +1,106 @@
+from email.header import decode_header, make_header
+from typing import Iterable, Iterator, Optional
+
+# The headers that postconfirm makes decisions on. Only these are decoded as
+# they stream past.
+INSPECTED_HEADERS = frozenset(["subject", "message-id", "precedence", "auto-submitted", "content-language"])
+
+# Header names seen so far, mapped to their lowercased form if they are
+# inspected or an empty string if not. Mail mostly uses a small set of names,
+# so this avoids lowercasing and checking each one for every message.
+NAME_CACHE_SIZE = 4096
+name_cache: dict[str, str] = {}
+
+
+def _inspected_key(name: str) -> str:
+    key = name.lower()
+    key = key if key in INSPECTED_HEADERS else ""
+
+    if len(name_cache) < NAME_CACHE_SIZE:
+        name_cache[name] = key
+
+    return key
+
+
+class MessageHeaders:
+    """
+    The headers of a message, as collected from the milter session.
+
+    Every header is kept as raw bytes, in order, so the message can be
+    reformed for stashing. Only the inspected headers are decoded, and they
+    are indexed by their lowercased name so they can be looked up without
+    scanning the list.
+
+    Iterating gives the `(name, value)` pairs with the values decoded, in the
+    same form as a list of headers.
+    """
+
+    def __init__(self, raw: Optional[list[tuple[str, bytes]]] = None) -> None:
+        """
+        The headers can be given as a list of `(name, value)` pairs, which is
+        then owned by this instance.
+        """
+        self.raw: list[tuple[str, bytes]] = raw if raw is not None else []
+        self.values: dict[str, list[str]] = {}
+
+        self._index(self.raw)
+
+    @classmethod
+    def from_list(cls, headers: list[tuple[str, str]]) -> "MessageHeaders":
+        return cls([(name, value.encode()) for (name, value) in headers])
+
+    def add(self, name: str, value: bytes) -> None:
+        header = (name, value)
+
+        self.raw.append(header)
+        self._index([header])
+
+    def _index(self, headers: Iterable[tuple[str, bytes]]) -> None:
+        values = self.values
+        cached_key = name_cache.get
+
+        for (name, value) in headers:
+            key = cached_key(name)
+
+            if key is None:
+                key = _inspected_key(name)
+
+            if key:
+                values.setdefault(key, []).append(value.decode())
+
+    def get(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        """
+        Returns the first value of an inspected header.
+        """
+        values = self.values.get(name.lower())
+
+        return values[0] if values else default
+
+    def get_all(self, name: str) -> list[str]:
+        """
+        Returns all the values of an inspected header.
+        """
+        return self.values.get(name.lower(), [])
+
+    def get_subject(self) -> str:
+        """
+        Returns the subject with any encoded words decoded, or an empty
+        string if there is none.
+        """
+        subject = self.get("subject", "").lstrip()
+
+        # Only RFC 2047 encoded words need decoding
+        if "=?" not in subject:
+            return subject
+
+        try:
+            return str(make_header(decode_header(subject)))
+        except (ValueError, UnicodeDecodeError):
+            return subject
+
+    def __iter__(self) -> Iterator[tuple[str, str]]:
+        for (name, value) in self.raw:
+            yield (name, value.decode())
+
+    def __len__(self) -> int:
+        return len(self.raw)
@@ -0,0 +1,125 @@
+import grp
+import logging
+import os
+import socket
+import stat
+from typing import Any, Callable, Mapping, Optional
+
+from anyio import ClosedResourceError, create_task_group, create_tcp_listener, wait_readable
+from anyio.abc import Listener, SocketAttribute, SocketStream, TaskGroup
+from anyio.streams.stapled import MultiListener
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class UnixSocketListener(Listener[SocketStream]):
+    """
+    Accepts connections on a bound UNIX stream socket.
+
+    anyio's own UNIX listener reads through its own readiness polling, which
+    on asyncio costs more per round trip than loopback TCP. The connections
+    accepted here are wrapped in the event loop's transports instead, like
+    TCP connections are.
+    """
+
+    def __init__(self, raw_socket: socket.socket) -> None:
+        raw_socket.setblocking(False)
+        self.raw_socket = raw_socket
+        self.closed = False
+
+    @property
+    def extra_attributes(self) -> Mapping[Any, Callable[[], Any]]:
+        return {
+            SocketAttribute.family: lambda: self.raw_socket.family,
+            SocketAttribute.local_address: lambda: self.raw_socket.getsockname(),
+            SocketAttribute.raw_socket: lambda: self.raw_socket,
+        }
+
+    async def accept(self) -> SocketStream:
+        while True:
+            try:
+                (client_socket, _) = self.raw_socket.accept()
+            except BlockingIOError:
+                await wait_readable(self.raw_socket)
+                continue
+            except OSError:
+                if self.closed:
+                    raise ClosedResourceError from None
+                raise
+
+            return await SocketStream.from_socket(client_socket)
+
+    async def serve(self, handler: Callable[[SocketStream], Any], task_group: Optional[TaskGroup] = None) -> None:
+        if task_group is None:
+            async with create_task_group() as task_group:
+                await self.serve(handler, task_group)
+            return
+
+        while True:
+            stream = await self.accept()
+            task_group.start_soon(handler, stream)
+
+    async def aclose(self) -> None:
+        self.closed = True
+        self.raw_socket.close()
+
+
+async def create_unix_socket_listener(path: str, mode: int = 0o660, group: Optional[str] = None) -> Listener:
+    """
+    Listens on a UNIX stream socket at `path`, with the given permissions
+    and group so that the MTA can connect to it.
+
+    A socket left behind by an earlier run is removed first, but any other
+    kind of file is left alone.
+    """
+    try:
+        if stat.S_ISSOCK(os.lstat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+    raw_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        raw_socket.bind(path)
+        os.chmod(path, mode)
+
+        if group:
+            os.chown(path, -1, grp.getgrnam(group).gr_gid)
+
+        raw_socket.listen()
+    except BaseException:
+        raw_socket.close()
+        raise
+
+    return UnixSocketListener(raw_socket)
+
+
+async def create_milter_listener(app_config: Config, port: Optional[int] = None) -> Listener:
+    """
+    Creates the listener for milter connections.
+
+    If `milter_socket` is set then the milter listens on that UNIX socket,
+    and also on TCP only if a port is given or `milter_port` is set.
+    Otherwise it listens on TCP, on `milter_port` (defaulting to 1999).
+    """
+    listeners = []
+
+    socket_path = app_config.get("milter_socket")
+    tcp_port = port or app_config.get("milter_port")
+
+    if socket_path:
+        mode = int(str(app_config.get("milter_socket_mode", "660")), 8)
+        group = app_config.get("milter_socket_group")
+
+        listeners.append(await create_unix_socket_listener(socket_path, mode, group))
+        logger.info("Listening on %(path)s", {"path": socket_path})
+    elif not tcp_port:
+        tcp_port = 1999
+
+    if tcp_port:
+        listeners.append(await create_tcp_listener(local_port=int(tcp_port)))
+        logger.info("Listening on port %(port)s", {"port": tcp_port})
+
+    return listeners[0] if len(listeners) == 1 else MultiListener(listeners)
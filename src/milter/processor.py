@@ -1,17 +1,26 @@
+import functools
 import logging
 import random
 import re
 import string
-from email.header import decode_header, make_header
-from typing import Optional, Union
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Iterator, Optional, Union
 
-import chevron
 from kilter.protocol import Accept, Discard, Reject
 from kilter.service import Runner, Session
+from kilter.service.options import AFTER, BEFORE, examine_body, examine_headers, examine_recipients, examine_sender
 
 from src import services
-from src.challenge import get_challenge
+from src.challenge import get_challenges
+from src.metrics import Counter, Gauge, Histogram, registry
+from src.milter.headers import MessageHeaders
 from src.sender import Sender, get_sender
+from src.singleflight import SingleFlight
+from src.templates import select_template, templates
+from src.tracing import set_attributes, span, start_trace
+from src.validator import SHORT_HASH_LENGTH
 
 logger = logging.getLogger(__name__)
 
@@ -20,16 +29,160 @@ LINE_SEP = "\n"
 
 IDENTIFIER_CHARS = string.ascii_letters + string.digits + '-'
 
+CHALLENGE_SUBJECT_RE = re.compile(r".*Confirm: (?P<token>(?P<recipient>.*?):(?P<messageref>.*?):(?P<hash>.*?))\s*$")
 
+# The tag of a VERP-style challenge address, see `get_challenge_address`
+CHALLENGE_TAG_RE = re.compile(rf"[a-z2-7]{{{SHORT_HASH_LENGTH}}}", re.IGNORECASE)
+
+# The longest local part allowed by RFC 5321
+MAX_LOCAL_PART_LENGTH = 64
+
+
+# The compiled header matchers are kept with the services, as they are built
+# from the configuration, falling back to these.
 header_drop_matchers = {}
 
+# Concurrent sessions for the same sender or recipients share their lookups.
+lookups = SingleFlight()
+
+verdicts = registry.register(Counter(
+    "postconfirm_verdicts_total", "Milter verdicts, by the path that reached them", ["verdict", "path"]
+))
+session_seconds = registry.register(Histogram(
+    "postconfirm_session_seconds", "Time from the start of a milter session to its verdict"
+))
+stage_seconds = registry.register(Histogram(
+    "postconfirm_stage_seconds", "Time spent in each stage of a milter session", ["stage"]
+))
+sessions_in_flight = registry.register(Gauge(
+    "postconfirm_sessions_in_flight", "Milter sessions that are waiting on a verdict"
+))
+challenges = registry.register(Counter(
+    "postconfirm_challenges_total", "Challenges, by whether they were sent or suppressed by the cooldown", ["result"]
+))
+challenges.inc(0, result="sent")
+challenges.inc(0, result="suppressed")
+
+# The ratio of coalesced lookups to lookups is the rate at which sessions were
+# spared a database lookup.
+registry.register(Counter(
+    "postconfirm_lookups_total", "Sender and recipient lookups made",
+    collect=lambda: lookups.stats()["lookups"]
+))
+registry.register(Counter(
+    "postconfirm_lookups_coalesced_total", "Lookups that shared the result of one already in flight",
+    collect=lambda: lookups.stats()["coalesced"]
+))
+registry.register(Gauge(
+    "postconfirm_lookups_in_flight", "Lookups in progress",
+    collect=lambda: lookups.stats()["in_flight"]
+))
+
+# The time spent in each stage of the current session, for its log line.
+stage_timings: ContextVar[Optional[dict[str, float]]] = ContextVar("stage_timings", default=None)
+
+
+def verdict(path: str, response: Union[Accept, Reject, Discard]) -> Union[Accept, Reject, Discard]:
+    """
+    Counts the response against the path through the handler that reached
+    it, and returns it.
+    """
+    verdict_name = type(response).__name__.lower()
+
+    verdicts.inc(verdict=verdict_name, path=path)
+    set_attributes({"postconfirm.verdict": verdict_name, "postconfirm.path": path})
+
+    return response
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Times a stage of the session, and traces it if the session is sampled.
+    """
+    start = time.perf_counter()
+
+    try:
+        with span(name):
+            yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, stage=name)
+
+        timings = stage_timings.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0) + elapsed
+
+
+def log_outcome(
+    queue_id: str, direction: str, outcome: str, sender: str, reason: str, sender_prefix: str = "", sampled: bool = False
+) -> None:
+    """
+    Logs the outcome of a session as "<queue id> <direction> <outcome>
+    <sender> - <reason>", with the queue id, sender, outcome and stage
+    timings also given as fields for structured logging.
+
+    The message is only formed if it is logged. Outcomes that are `sampled`
+    are high volume, and are only logged at the `log.sample_rate`.
+    """
+    if not logger.isEnabledFor(logging.INFO):
+        return
+
+    if sampled:
+        sample_rate = float(services["app_config"].get("log.sample_rate", 1))
+
+        if sample_rate < 1 and random.random() >= sample_rate:
+            return
+
+    timings = stage_timings.get()
+
+    logger.info(
+        "%(queue_id)s %(direction)s %(outcome)s %(sender_prefix)s%(sender)s - %(reason)s",
+        {
+            "queue_id": queue_id,
+            "direction": direction,
+            "outcome": outcome,
+            "sender_prefix": sender_prefix,
+            "sender": sender,
+            "reason": reason,
+        },
+        extra={
+            "queue_id": queue_id,
+            "sender": sender,
+            "verdict": outcome,
+            "stages": {name: round(elapsed, 6) for (name, elapsed) in timings.items()} if timings else {},
+        },
+    )
+
+
+def instrument_session(
+    handler: Callable[[Session], Awaitable[Union[Accept, Reject, Discard]]]
+) -> Callable[[Session], Awaitable[Union[Accept, Reject, Discard]]]:
+    """
+    Tracks the sessions in flight and the time each takes to reach a verdict,
+    and starts the trace of any sampled session. The session keeps the
+    services it starts with, even if they are reloaded.
+    """
+    @functools.wraps(handler)
+    async def instrumented(session: Session) -> Union[Accept, Reject, Discard]:
+        sessions_in_flight.inc()
+        stage_timings.set({})
+
+        try:
+            with services.pin(), session_seconds.time(), start_trace("milter_session"):
+                return await handler(session)
+        finally:
+            sessions_in_flight.dec()
+
+    return instrumented
+
 
 def recipient_requires_challenge(recipients: list) -> Union[False, list]:
-    challenges = [get_challenge(recipient) for recipient in recipients]
+    challenges = get_challenges(recipients)
     challengeable = filter(lambda challenge: challenge.get_action() == "challenge", challenges)
     to_challenge = list([challenge.get_email() for challenge in challengeable])
 
-    logger.debug(f"challenges {challenges}")
+    logger.debug("challenges %(challenges)s", {"challenges": challenges})
 
     if len(to_challenge):
         return to_challenge
@@ -37,22 +190,58 @@ def recipient_requires_challenge(recipients: list) -> Union[False, list]:
         return False
 
 
-def message_should_be_dropped(headers: list[dict]) -> bool:
-    if "Precedence" not in header_drop_matchers:
-        header_drop_matchers["Precedence"] = re.compile(
+async def resolve_challenge_recipients(recipients: list[str]) -> Union[False, list]:
+    """
+    As `recipient_requires_challenge`, coalesced with any identical lookup
+    in progress.
+    """
+    return await lookups.run(("challenges", tuple(recipients)), recipient_requires_challenge, recipients)
+
+
+async def resolve_sender_action(sender: Sender, use_primary: bool = False) -> str:
+    """
+    As `Sender.get_action`, coalesced with any lookup in progress for the
+    same sender.
+    """
+    if not sender.action:
+        action_data = await lookups.run(
+            ("sender", sender.get_email(), use_primary), sender.look_up_action_data, use_primary
+        )
+        sender.apply_action_data(action_data)
+
+    return sender.action
+
+
+async def resolve_never_allowed(sender: Sender) -> bool:
+    """
+    As `Sender.is_never_allowed`, coalesced with any lookup in progress for
+    the same sender.
+    """
+    return await lookups.run(("never_allow", sender.get_email()), sender.is_never_allowed)
+
+
+def message_should_be_dropped(headers: Union[MessageHeaders, list[dict]]) -> bool:
+    matchers = services.get("header_drop_matchers", header_drop_matchers)
+
+    if "Precedence" not in matchers:
+        matchers["Precedence"] = re.compile(
             services["app_config"].get("bulk_regex", r"(junk|list|bulk|auto_reply)")
         )
 
-    if "Auto-Submitted" not in header_drop_matchers:
-        header_drop_matchers["Auto-Submitted"] = re.compile(
+    if "Auto-Submitted" not in matchers:
+        matchers["Auto-Submitted"] = re.compile(
             services["app_config"].get("auto_submitted_regex", r"^auto-")
         )
 
+    if isinstance(headers, MessageHeaders):
+        # Only the headers that are matched on need to be looked at
+        headers = [(header, entry) for header in matchers for entry in headers.get_all(header)]
+
     for header, entry in headers:
-        if header in header_drop_matchers:
+        if header in matchers:
             trimmed_entry = entry.lstrip()
 
-            if header_drop_matchers[header].search(trimmed_entry):
+            if matchers[header].search(trimmed_entry):
                 logger.debug("Dropping: header {header} matched {entry}",
                              extra={"header": header, "entry": entry})
                 return True
@@ -74,6 +263,10 @@ def subject_is_challenge_response(subject: str) -> bool:
 def get_challenge_subject(sender_email: str, recipients: list[str], reference: str) -> str:
     token = services["validator"].get_token(sender_email, recipients[0], reference)
 
+    return format_challenge_subject(token)
+
+
+def format_challenge_subject(token: str) -> str:
     # This needs to add in the leading space.
     return f" Confirm: {token}"
 
@@ -86,47 +279,139 @@ def reform_email_text(headers: list, body_chunks: list) -> str:
     return f"{LINE_SEP.join(form_header(header) for header in headers)}{LINE_SEP}{LINE_SEP}{''.join(body_chunks)}"
 
 
-async def send_challenge(sender: Sender, subject: str, recipients: list[str], reference: str) -> None:
+def make_challenge_message(
+    sender: Sender, subject: str, recipients: list[str], reference: str, language: Optional[str] = None
+) -> str:
     """
-    Send the challenge email to the sender, with the reference
-    and then update the sender to indicate this.
+    Create the challenge email to the sender, with the reference.
+
+    The template is chosen by the challenged recipient's domain and the
+    language of the message, and is rendered from the parsed templates held
+    in memory.
     """
-    template_name = services["app_config"].get("mail_template", "/etc/postconfirm/confirm.email.mustache")
-    admin_address = services["app_config"].get("admin_address")
+    app_config = services["app_config"]
+    admin_address = app_config.get("admin_address")
 
     challenge_address = recipients[0]
 
-    with open(template_name, "r") as template:
-        message_text = chevron.render(template, {
-            "subject": subject,
-            "sender_address": sender.email,
-            "recipient_address": ", ".join(recipients),
-            "challenge_address": challenge_address,
-            "admin_address": admin_address,
-            "id": reference,
-            "full_ref": get_challenge_subject(sender.email, recipients, reference),
-        })
+    # The token is signed once, for both the subject and the body
+    token = services["validator"].get_token(sender.email, challenge_address, reference)
+    challenge_subject = format_challenge_subject(token)
+
+    template_name = select_template(app_config, challenge_address, language)
+
+    message_text = services.get("templates", templates).render(template_name, {
+        "subject": subject,
+        "sender_address": sender.address,
+        "recipient_address": ", ".join(recipients),
+        "challenge_address": challenge_address,
+        "admin_address": admin_address,
+        "id": reference,
+        "full_ref": challenge_subject,
+    })
+
+    headers = [
+        ("From", f" {challenge_address}"),
+        ("To", f" {sender.address}"),
+        ("Subject", challenge_subject),
+        ("Auto-Submitted", " auto-replied"),
+    ]
 
-        headers = [
-            ("From", f" {challenge_address}"),
-            ("To", f" {sender.email}"),
-            ("Subject", get_challenge_subject(sender.email, recipients, reference)),
-            ("Auto-Submitted", " auto-replied"),
-        ]
+    # Replies to a VERP-style address can be recognised from the envelope
+    verp_address = get_challenge_address(sender.email, reference)
+
+    if verp_address:
+        headers[0] = ("From", f' "{challenge_address}" <{verp_address}>')
+        headers.append(("Reply-To", f" {verp_address}"))
 
-        challenge_message = reform_email_text(headers, [message_text])
+    return reform_email_text(headers, [message_text])
+
+
+async def send_challenge(
+    sender: Sender, subject: str, recipients: list[str], reference: str, language: Optional[str] = None
+) -> None:
+    """
+    Send the challenge email to the sender, with the reference.
+    """
+    challenge_message = make_challenge_message(sender, subject, recipients, reference, language)
 
-        await services["remailer"].sendmail([sender.email], challenge_message)
+    await services["remailer"].sendmail([sender.address], challenge_message, in_session=True)
 
 
 def get_challenge_token_from_subject(subject: str) -> str:
     """
     Extracts the challenge token from the subject
     """
-    match = re.match(r".*Confirm: (?P<token>(?P<recipient>.*?):(?P<messageref>.*?):(?P<hash>.*?))\s*$", subject)
+    match = CHALLENGE_SUBJECT_RE.match(subject)
     return match["token"] if match else None
 
 
+def get_challenge_address(sender_email: str, reference: str) -> Optional[str]:
+    """
+    Returns the VERP-style address for the challenge, if
+    `challenge_verp_address` is configured.
+
+    The local part is tagged with a short hash of the sender and the
+    reference, eg `confirm+3kq7hzu2mbx5adfr@example.com`. A response from the
+    sender is validated against the sender's references, so the address does
+    not need to carry them, and stays within the 64 octets allowed for a local
+    part. If it would not then None is returned, and responses are only
+    recognised by their subject.
+    """
+    verp_address = services["app_config"].get("challenge_verp_address")
+
+    if not verp_address:
+        return None
+
+    (local_part, domain) = verp_address.rsplit("@", 1)
+    tagged_local_part = f"{local_part}+{services['validator'].make_short_hash(sender_email, reference)}"
+
+    if len(tagged_local_part) > MAX_LOCAL_PART_LENGTH:
+        logger.warning("The challenge_verp_address %(address)s is too long to be tagged", {"address": verp_address})
+        return None
+
+    return f"{tagged_local_part}@{domain}"
+
+
+def get_challenge_hash_from_address(address: str) -> Optional[str]:
+    """
+    Extracts the short hash from a VERP-style challenge address, as made by
+    `get_challenge_address`, if `challenge_verp_address` is configured.
+    """
+    verp_address = services["app_config"].get("challenge_verp_address")
+
+    if not verp_address or "@" not in address:
+        return None
+
+    (local_part, domain) = address.rsplit("@", 1)
+    (verp_local_part, verp_domain) = verp_address.rsplit("@", 1)
+
+    if domain.lower() != verp_domain.lower() or not local_part.startswith(f"{verp_local_part}+"):
+        return None
+
+    tag = local_part[len(verp_local_part) + 1:]
+
+    return tag.lower() if CHALLENGE_TAG_RE.fullmatch(tag) else None
+
+
+async def process_verp_response(
+    session: Session, sender: Sender, response_hash: str, queue_id: str
+) -> Union[Reject, Discard]:
+    """
+    Processes a response to a VERP-style challenge address. Automatic replies
+    to the challenge, eg out of office replies, are dropped as any other
+    bulk message is, so that they do not confirm the sender.
+    """
+    with stage("headers"):
+        (_, mail_headers) = await extract_headers(session)
+
+    if message_should_be_dropped(mail_headers):
+        log_outcome(queue_id, "outbound", "drop", sender.get_email(), "response matches droplist")
+        return verdict("bulk", Discard())
+
+    return await process_challenge_response(sender, response_hash, queue_id, short_hash=True)
+
+
 def cleanup_mail(email) -> str:
     matches = re.match(r'^(.*<)?([^>]*)(>.*)?$', email.strip())
 
@@ -136,35 +421,24 @@ def cleanup_mail(email) -> str:
         return email
 
 
-async def extract_headers(session: Session) -> tuple[Optional[str], list]:
+async def extract_headers(session: Session) -> tuple[str, MessageHeaders]:
     """
     Extracts the headers from the message/session.
 
     The subject is explicitly returned as the first parameter, if found.
-    All of the headers are then returned as a list.
+    All of the headers are then returned, with only those that are
+    inspected decoded.
     """
 
-    mail_headers = []
-    mail_subject = None
+    raw_headers = []
 
     async with session.headers as headers:
         async for header in headers:
-            value = header.value.decode()
-
-            if header.name.lower() == "subject":
-                mail_subject = value.lstrip()
-                if mail_subject:
-                    try:
-                        fixed_subject = str(make_header(decode_header(mail_subject)))
-                    except (ValueError, UnicodeDecodeError):
-                        fixed_subject = mail_subject
+            raw_headers.append((header.name, header.value))
 
-            mail_headers.append((header.name, value))
+    mail_headers = MessageHeaders(raw_headers)
 
-    try:
-        return (fixed_subject, mail_headers)
-    except NameError:
-        return ('', mail_headers)
+    return (mail_headers.get_subject(), mail_headers)
 
 
 async def extract_body(session: Session) -> list:
@@ -181,6 +455,7 @@ async def extract_body(session: Session) -> list:
 
     return mail_body
 
+
 async def extract_macros(session: Session) -> list:
     """
     Extracts the macros from the milter session.
@@ -205,8 +480,22 @@ async def extract_macros(session: Session) -> list:
     """
     return session.macros
 
-def extract_reference(mail_headers: list[dict]) -> str:
-    message_id = next((header[1] for header in mail_headers if header[0].lower() == "message-id"), None)
+
+def extract_language(mail_headers: Union[MessageHeaders, list[dict]]) -> Optional[str]:
+    """
+    Returns the message's `Content-Language`, if it has one.
+    """
+    if isinstance(mail_headers, MessageHeaders):
+        return mail_headers.get("content-language")
+
+    return next((header[1] for header in mail_headers if header[0].lower() == "content-language"), None)
+
+
+def extract_reference(mail_headers: Union[MessageHeaders, list[dict]]) -> str:
+    if isinstance(mail_headers, MessageHeaders):
+        message_id = mail_headers.get("message-id")
+    else:
+        message_id = next((header[1] for header in mail_headers if header[0].lower() == "message-id"), None)
 
     if message_id:
         matches = re.match(r"<?(.*?)@", message_id)
@@ -221,28 +510,134 @@ def extract_reference(mail_headers: list[dict]) -> str:
 async def release_messages(sender: Sender) -> None:
     """
     Releases the stashed messages relating to the sender.
+
+    If the outbox is enabled the messages are moved to it, to be sent by the
+    outbox workers. Otherwise they are sent together and removed from the
+    stash once they have been accepted. Any that fail are then moved to the
+    outbox, so that its workers retry them, as the sender has already been
+    accepted and nothing would release them again.
     """
 
-    for (recipients, message) in sender.unstash_messages():
-        logging.debug("Releasing message from %(sender)s to %(recipients)s", {
-            "sender": sender.get_email(),
+    if services["outbox"].enabled:
+        sender.queue_release()
+        services["outbox"].notify()
+        return
+
+    stashed = sender.get_stashed_messages()
+
+    for (_, recipients, _, envelope_sender) in stashed:
+        logger.debug("Releasing message from %(sender)s to %(recipients)s", {
+            "sender": envelope_sender,
             "recipients": ', '.join(recipients)
         })
-        await services["remailer"].sendmail(recipients, message, sender.get_email())
 
+    # Each message is sent from the envelope sender it came from, rather
+    # than the sender's key.
+    results = await services["remailer"].sendmail_many([
+        (recipients, message, envelope_sender) for (_, recipients, message, envelope_sender) in stashed
+    ], in_session=True)
+
+    released = [key for ((key, _, _, _), result) in zip(stashed, results) if result]
+
+    sender.remove_stashed_messages(released)
+
+    if len(released) < len(stashed):
+        logger.warning("Failed to release %(failed)d of %(total)d messages from %(sender)s, retrying from the outbox", {
+            "failed": len(stashed) - len(released),
+            "total": len(stashed),
+            "sender": sender.get_email()
+        })
+
+        sender.queue_release()
+        services["outbox"].notify()
+
+
+async def process_challenge_response(
+    sender: Sender, token: str, queue_id: str, short_hash: bool = False
+) -> Union[Reject, Discard]:
+    """
+    Processes a challenge response carrying the token, or the short hash
+    from a VERP-style challenge address if `short_hash` is set.
+
+    If the sender is being challenged and the token is valid then the sender
+    is accepted and their stashed messages released. With the outbox enabled
+    the messages are queued in the same transaction as the acceptance. An invalid token is
+    rejected, and the response is otherwise discarded.
+    """
+    mail_from = sender.get_email()
+
+    # The references were written by an earlier session so they have to come
+    # from the primary.
+    with stage("sender"):
+        action = await resolve_sender_action(sender, use_primary=True)
+
+    if action == "confirm":
+        if short_hash:
+            valid = services["validator"].validate_short_hash(sender.email, token, sender.get_refs())
+        else:
+            valid = services["validator"].validate_token(sender.email, token, sender.validate_ref)
+
+        if not valid:
+            # Reject the message
+            log_outcome(queue_id, "inbound", "invalid_response", mail_from, "message is response, but invalid")
+            return verdict("invalid_response", Reject())
+
+        if await resolve_never_allowed(sender):
+            log_outcome(queue_id, "inbound", "never_allow", mail_from, "sender is in never_allow list")
+            return verdict("response_never_allow", Discard())
 
+        log_outcome(queue_id, "inbound", "confirm", mail_from, "response is valid, confirming user")
+
+        # Mark the sender as valid, moving the messages to the outbox with it
+        # if it is enabled
+        outbox = services["outbox"]
+
+        if sender.accept(queue_release=outbox.enabled) is None:
+            logger.error("Failed to accept %(sender)s, leaving their messages stashed", {"sender": mail_from})
+            return verdict("confirm", Discard())
+
+        # Release the messages
+        with stage("release"):
+            if outbox.enabled:
+                outbox.notify()
+            else:
+                await release_messages(sender)
+
+        return verdict("confirm", Discard())
+
+    log_outcome(queue_id, "inbound", "response", mail_from, "response is valid, but not confirming user")
+
+    # Always discard the message at this stage
+    return verdict("response", Discard())
+
+
+# Only the stages that are used are negotiated with the MTA, and responses are
+# only awaited where a verdict can be given. Returning a verdict in reply to
+# DATA or the end of the headers means the headers or the body are never sent,
+# and kilter asks the MTA to skip the body when it is not being read.
 @Runner
+@examine_sender(can_respond=True)
+@examine_recipients()
+@examine_headers(can_respond=BEFORE | AFTER)
+@examine_body()
+@instrument_session
 async def handle(session: Session) -> Union[Accept, Reject, Discard]:
     """
     The milter processor for postconfirm.
 
     Decisions are made on the basis of where the message is going to and
     then who the sender is, since not all messages will be covered by the
-    challenge system. Bulk messages that would otherwise be challenged are
-    dropped. Once we know that at least one destination requires a
-    challenge the sender is examined. In the simple cases the action will
-    be either "accept", "reject", or "discard" and the appropriate
-    response can be sent immediately.
+    challenge system. Each decision is made at the earliest phase where the
+    outcome is certain, so the MTA is not asked for anything more than is
+    needed:
+
+    * after MAIL FROM, our own outbound challenges are accepted
+    * after RCPT TO, responses to a VERP-style challenge address are
+    handled, and mail without any recipient that requires a challenge is
+    accepted without the headers being sent
+    * after the headers, bulk mail is dropped and challenge responses are
+    handled, as is any sender with a settled action
+    * the body is only collected when the message has to be stashed
 
     If the sender is "unknown" then we start the challenge process, which
     includes stashing the mail and indicating that the original should be
@@ -258,114 +653,141 @@ async def handle(session: Session) -> Union[Accept, Reject, Discard]:
     other state then the response is simply discarded.
     """
 
-    # First we set up our Sender
-    mail_from = cleanup_mail(await session.envelope_from())
-    sender = get_sender(mail_from)
+    # MAIL FROM: set up our Sender
+    with stage("envelope"):
+        mail_from = cleanup_mail(await session.envelope_from())
+    macros = await extract_macros(session)
+    queue_id = macros.get('i', '-')
+    set_attributes({"postfix.queue_id": queue_id})
     remail_sender = services["app_config"].get("remail_sender")
 
-    # Then we can gather the recipients. The order is determined by the
-    # SMTP protocol.
-    mail_recipients = [
-        cleanup_mail(recipient) async for recipient in session.envelope_recipients()
-    ]
+    if mail_from == remail_sender:
+        log_outcome(queue_id, "outbound", "accept", mail_from, "message is outbound challege, accept", sampled=True)
+        return verdict("remail_sender", Accept())
+
+    sender = get_sender(mail_from)
+
+    # RCPT TO: gather the recipients. The order is determined by the SMTP
+    # protocol.
+    with stage("recipients"):
+        mail_recipients = [
+            cleanup_mail(recipient) async for recipient in session.envelope_recipients()
+        ]
 
-    challenge_recipients = recipient_requires_challenge(mail_recipients)
+    # A response to a VERP-style challenge address is known from the
+    # envelope alone. Any other challenge response is addressed to the
+    # recipient that was challenged, so without any such recipient there is
+    # nothing more to decide.
+    response_hash = next(filter(None, map(get_challenge_hash_from_address, mail_recipients)), None)
 
-    # In order to tell if this is a challenge response we need the
-    # subject, which means collecting all the headers.
+    if response_hash:
+        return await process_verp_response(session, sender, response_hash, queue_id)
 
-    (mail_subject, mail_headers) = await extract_headers(session)
+    with stage("recipient_resolution"):
+        challenge_recipients = await resolve_challenge_recipients(mail_recipients)
 
-    macros = await extract_macros(session)
+    if not challenge_recipients:
+        log_outcome(queue_id, "in-or-out", "allow", mail_from, "no challenge required", sender_prefix="from:", sampled=True)
+        return verdict("no_challenge", Accept())
+
+    # Headers: in order to tell if this is a challenge response we need the
+    # subject, and the bulk check needs the rest.
+    with stage("headers"):
+        (mail_subject, mail_headers) = await extract_headers(session)
 
     cleaned_subject = mail_subject.replace("\n", "").replace("\t", " ")
 
     is_challenge_response = subject_is_challenge_response(cleaned_subject)
 
-    should_drop = message_should_be_dropped(mail_headers)
+    if message_should_be_dropped(mail_headers):
+        log_outcome(queue_id, "outbound", "drop", mail_from, "message matches droplist")
+        return verdict("bulk", Discard())
 
-    # Now we can determine the course of action
-    #
-    if mail_from == remail_sender:
-        logger.info(f"{macros['i']} outbound accept {mail_from} - message is outbound challege, accept")
-        return Accept()
-    if challenge_recipients and should_drop:
-        logger.info(f"{macros['i']} outbound drop {mail_from} - message matches droplist")
-        return Discard()
-
-    elif challenge_recipients and not is_challenge_response:
-        # Process the sender
-        action = sender.get_action()
-
-        if action == "accept":
-            logger.info(f"{macros['i']} inbound accept {mail_from} - message is flagged, sender is marked for acceptance")
-            return Accept()
-        elif action == "reject":
-            logger.info(f"{macros['i']} inbound reject {mail_from} - message is flagged, sender is marked for rejecting")
-            return Reject()
-        elif action == "discard":
-            logger.info(f"{macros['i']} inbound discard {mail_from} - message is flagged, sender is marked for discarding")
-            return Discard()
-
-        if sender.is_never_allowed():
-            logger.info(
-                f"{macros['i']} inbound never_allow {mail_from} - message is flagged, sender is never allowed"
-            )
-            return Discard()
+    if is_challenge_response:
+        token = get_challenge_token_from_subject(cleaned_subject)
 
-        # The remaining options are "unknown" or "confirm". In both cases
-        # we need to stash the mail. That means completing the collection.
+        return await process_challenge_response(sender, token, queue_id)
 
-        mail_body = await extract_body(session)
+    # Process the sender
+    with stage("sender"):
+        action = await resolve_sender_action(sender)
 
-        mail_as_text = reform_email_text(mail_headers, mail_body)
+    if action == "accept":
+        log_outcome(
+            queue_id, "inbound", "accept", mail_from, "message is flagged, sender is marked for acceptance", sampled=True
+        )
+        return verdict("sender_accept", Accept())
+    elif action == "reject":
+        log_outcome(
+            queue_id, "inbound", "reject", mail_from, "message is flagged, sender is marked for rejecting"
+        )
+        return verdict("sender_reject", Reject())
+    elif action == "discard":
+        log_outcome(
+            queue_id, "inbound", "discard", mail_from, "message is flagged, sender is marked for discarding"
+        )
+        return verdict("sender_discard", Discard())
 
-        challenge_reference = extract_reference(mail_headers)
+    if await resolve_never_allowed(sender):
+        log_outcome(queue_id, "inbound", "never_allow", mail_from, "message is flagged, sender is never allowed")
+        return verdict("never_allow", Discard())
 
-        sender.stash_message(mail_as_text, mail_recipients, challenge_reference)
+    # Body: the remaining options are "unknown" or "confirm". In both cases
+    # we need to stash the mail. That means completing the collection.
 
-        actions_to_challenge = ["unknown", "expired"]
-        if services["app_config"].get("resend_confirmation", True):
-            actions_to_challenge.append("confirm")
+    with stage("body"):
+        mail_body = await extract_body(session)
 
-        if action in actions_to_challenge:
-            logger.info(f"{macros['i']} inbound challenge {mail_from} - sender requires challenge")
-            await send_challenge(sender, cleaned_subject, challenge_recipients, challenge_reference)
+    mail_as_text = reform_email_text(mail_headers, mail_body)
 
-        return Discard()
+    challenge_reference = extract_reference(mail_headers)
+    challenge_language = extract_language(mail_headers)
 
-    elif is_challenge_response:
-        # Process the response
-        action = sender.get_action()
+    actions_to_challenge = ["unknown", "expired"]
+    if services["app_config"].get("resend_confirmation", True):
+        actions_to_challenge.append("confirm")
 
-        if action == "confirm":
-            token = get_challenge_token_from_subject(cleaned_subject)
+    requires_challenge = action in actions_to_challenge
 
-            if not services["validator"].validate_token(sender.email, token, sender.get_refs()):
-                # Reject the message
-                logger.info(f"{macros['i']} inbound invalid_response {mail_from} - message is response, but invalid")
-                return Reject()
+    # Concurrent or repeated messages from the same sender share a
+    # single challenge within the cooldown.
+    challenge_cooldown = float(services["app_config"].get("challenge_cooldown", 0))
 
-            if sender.is_never_allowed():
-                logger.info(f"{macros['i']} inbound never_allow {mail_from} - sender is in never_allow list")
-                return Discard()
+    if requires_challenge and not sender.claim_challenge(challenge_cooldown):
+        challenges.inc(result="suppressed")
+        log_outcome(queue_id, "inbound", "challenge_suppressed", mail_from, "sender was challenged recently")
+        requires_challenge = False
 
-            logger.info(f"{macros['i']} inbound confirm {mail_from} - response is valid, confirming user")
+    if requires_challenge:
+        challenges.inc(result="sent")
 
-            # Mark the sender as valid
-            sender.clear_references()
-            sender.set_action("accept")
+    if requires_challenge and services["outbox"].enabled:
+        # The challenge is queued along with the stashed message.
+        challenge_message = make_challenge_message(
+            sender, cleaned_subject, challenge_recipients, challenge_reference, challenge_language
+        )
+
+        with stage("stash"):
+            sender.stash_message(
+                mail_as_text, mail_recipients, challenge_reference, outbound=[([sender.address], challenge_message, None)]
+            )
 
-            # Release the messages
-            await release_messages(sender)
+        log_outcome(queue_id, "inbound", "challenge", mail_from, "sender requires challenge")
+        services["outbox"].notify()
 
-        else:
-            logger.info(f"{macros['i']} inbound response {mail_from} - response is valid, but not confirming user")
+        return verdict("challenge", Discard())
 
-        # Always discard the message at this stage
-        return Discard()
+    with stage("stash"):
+        sender.stash_message(mail_as_text, mail_recipients, challenge_reference)
+
+    if requires_challenge:
+        log_outcome(queue_id, "inbound", "challenge", mail_from, "sender requires challenge")
+
+        with stage("challenge"):
+            await send_challenge(
+                sender, cleaned_subject, challenge_recipients, challenge_reference, challenge_language
+            )
 
-    # Anything else is just accepted
-    logger.info(f"{macros['i']} in-or-out allow from:{mail_from} - no challenge required")
-    return Accept()
+        return verdict("challenge", Discard())
 
+    return verdict("stash", Discard())
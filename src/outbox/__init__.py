@@ -0,0 +1,5 @@
+from .outbox import Outbox
+
+__all__ = [
+    "Outbox"
+]
@@ -0,0 +1,278 @@
+import json
+import logging
+from typing import Optional
+
+import anyio
+from config import Config
+
+from src.db import get_db_pool
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """
+    Sends the mail queued in the `outbox` table.
+
+    Challenges and released messages are written to the outbox in the same
+    transaction as the stash or sender change that caused them, so the milter
+    does not wait on SMTP and nothing is lost if sending fails. Workers then
+    claim batches of due entries, send them, and either remove them or
+    schedule a retry with an exponential backoff.
+
+    Mail that is sent directly, when the outbox is not enabled, is queued
+    here too if it would wait too long for the rate limits.
+
+    Configuration is via the `outbox` object:
+    * `enabled` (defaults to False) whether mail is queued rather than sent
+    directly
+    * `workers` (defaults to 1) the number of workers run within the milter,
+    whether or not the outbox is enabled. This can be 0 if
+    `outbox_worker.py` is run separately
+    * `poll_interval` (defaults to 5) seconds between checks for due entries
+    * `batch_size` (defaults to 10) the number of entries claimed at once
+    * `retry_delay` (defaults to 60) seconds before the first retry, which
+    doubles with each further attempt
+    * `max_attempts` (defaults to 10) attempts before an entry is abandoned.
+    Abandoned entries are kept, but not retried, until `purge_stash.py`
+    removes them
+    * `lease` (defaults to 600) seconds that a claim holds entries for. The
+    lease is renewed while the batch is being sent, so it only runs out if
+    the worker stops
+    """
+
+    def __init__(self, app_config: Config) -> None:
+        self.app_config = app_config
+
+        outbox_config = app_config.get("outbox", {}) or {}
+
+        self.enabled = str(outbox_config.get("enabled", False)).lower() in ["true", "1", "t", "y", "yes"]
+        self.workers = int(outbox_config.get("workers", 1))
+        self.poll_interval = float(outbox_config.get("poll_interval", 5))
+        self.batch_size = int(outbox_config.get("batch_size", 10))
+        self.retry_delay = float(outbox_config.get("retry_delay", 60))
+        self.max_attempts = int(outbox_config.get("max_attempts", 10))
+        self.lease = float(outbox_config.get("lease", 600))
+
+        self.wakeup: Optional[anyio.Event] = None
+        self.stopping = False
+
+    def notify(self) -> None:
+        """
+        Wakes the in-process workers, if any, as there is new work.
+        """
+        if self.wakeup:
+            self.wakeup.set()
+
+    def stop(self) -> None:
+        """
+        Asks the in-process workers to stop once they have finished their
+        current batch, so that nothing claimed is left to wait for its lease.
+        """
+        self.stopping = True
+        self.notify()
+
+    def queue(self, messages: list[tuple[list[str], str, Optional[str]]]) -> None:
+        """
+        Queues messages to be sent, each given as a tuple of the recipients,
+        the message and the sender.
+        """
+        with get_db_pool(self.app_config["db"], "db").connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.executemany(
+                    """
+                    INSERT INTO outbox
+                        (sender, recipients, message)
+                        VALUES
+                            (%(sender)s, %(recipients)s, %(message)s)
+                    """,
+                    [
+                        {"sender": sender, "recipients": json.dumps(recipients), "message": message}
+                        for (recipients, message, sender) in messages
+                    ]
+                )
+                connection.commit()
+
+    def claim(self) -> list[tuple[int, Optional[str], list[str], str, int]]:
+        """
+        Claims a batch of due entries.
+
+        The claim is made by pushing back the next attempt, so other workers
+        (including those on other replicas) will not pick the entries up
+        unless this worker fails to finish with them.
+        """
+        with get_db_pool(self.app_config["db"], "db").connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    UPDATE outbox
+                        SET next_attempt = now() + make_interval(secs => %(lease)s)
+                        WHERE id IN (
+                            SELECT id
+                                FROM outbox
+                                WHERE next_attempt <= now()
+                                ORDER BY id
+                                LIMIT %(batch_size)s
+                                FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING id, sender, recipients, message, attempts
+                    """,
+                    {"lease": self.lease, "batch_size": self.batch_size}
+                )
+                claimed = [
+                    (row_id, sender, json.loads(recipients), message, attempts)
+                    for (row_id, sender, recipients, message, attempts) in cursor.fetchall()
+                ]
+                connection.commit()
+
+                return claimed
+
+    def renew(self, row_ids: list[int]) -> None:
+        """
+        Extends the lease on the claimed entries.
+        """
+        with get_db_pool(self.app_config["db"], "db").connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    UPDATE outbox
+                        SET next_attempt = now() + make_interval(secs => %(lease)s)
+                        WHERE id = ANY(%(ids)s) AND next_attempt IS NOT NULL
+                    """,
+                    {"lease": self.lease, "ids": row_ids}
+                )
+                connection.commit()
+
+    async def _renew_lease(self, row_ids: list[int]) -> None:
+        """
+        Renews the lease on the claimed entries at half the lease time, until
+        cancelled.
+        """
+        while True:
+            await anyio.sleep(self.lease / 2)
+
+            try:
+                await anyio.to_thread.run_sync(self.renew, row_ids)
+            except Exception as e:
+                logger.warning("Unable to renew the outbox lease: %(reason)s", {"reason": str(e)})
+
+    def complete(self, row_ids: list[int]) -> None:
+        """
+        Removes the entries that have been sent.
+        """
+        if not row_ids:
+            return
+
+        with get_db_pool(self.app_config["db"], "db").connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM outbox WHERE id = ANY(%(ids)s)",
+                    {"ids": row_ids}
+                )
+                connection.commit()
+
+    def retry(self, entries: list[tuple[int, int]]) -> None:
+        """
+        Schedules a retry for each of the (id, attempts) entries, or abandons
+        the entry if it has used all its attempts.
+        """
+        if not entries:
+            return
+
+        with get_db_pool(self.app_config["db"], "db").connection() as connection:
+            with connection.cursor() as cursor:
+                for (row_id, attempts) in entries:
+                    attempts += 1
+
+                    if attempts >= self.max_attempts:
+                        logger.error("Abandoning outbox entry %(id)d after %(attempts)d attempts", {
+                            "id": row_id,
+                            "attempts": attempts
+                        })
+                        delay = None
+                    else:
+                        delay = self.retry_delay * 2 ** (attempts - 1)
+
+                    cursor.execute(
+                        """
+                        UPDATE outbox
+                            SET attempts = %(attempts)s,
+                                next_attempt = now() + make_interval(secs => %(delay)s)
+                            WHERE id = %(id)s
+                        """,
+                        {"id": row_id, "attempts": attempts, "delay": delay}
+                    )
+
+                connection.commit()
+
+    async def process_batch(self, remailer) -> int:
+        """
+        Claims and sends one batch of entries. Returns the number claimed.
+        """
+        claimed = await anyio.to_thread.run_sync(self.claim)
+
+        if not claimed:
+            return 0
+
+        # Sending can wait on the rate limits or a slow server, so the claim
+        # is kept until it is done.
+        async with anyio.create_task_group() as tasks:
+            tasks.start_soon(self._renew_lease, [row_id for (row_id, _, _, _, _) in claimed])
+
+            results = await remailer.sendmail_many([
+                (recipients, message, sender) for (_, sender, recipients, message, _) in claimed
+            ])
+
+            tasks.cancel_scope.cancel()
+
+        sent = []
+        failed = []
+
+        for ((row_id, _, _, _, attempts), result) in zip(claimed, results):
+            if result:
+                sent.append(row_id)
+            else:
+                failed.append((row_id, attempts))
+
+        await anyio.to_thread.run_sync(self.complete, sent)
+        await anyio.to_thread.run_sync(self.retry, failed)
+
+        logger.debug("Outbox batch sent %(sent)d and deferred %(failed)d", {
+            "sent": len(sent),
+            "failed": len(failed)
+        })
+
+        return len(claimed)
+
+    async def run_worker(self, remailer) -> None:
+        """
+        Processes the outbox until cancelled or stopped. A full batch is
+        followed immediately by another, otherwise the worker waits for the
+        poll interval or a notification.
+        """
+        if self.wakeup is None:
+            self.wakeup = anyio.Event()
+
+        while not self.stopping:
+            try:
+                claimed = await self.process_batch(remailer)
+            except Exception as e:
+                logger.error("Outbox worker failed: %(reason)s", {"reason": str(e)})
+                claimed = 0
+
+            if claimed >= self.batch_size or self.stopping:
+                continue
+
+            with anyio.move_on_after(self.poll_interval):
+                await self.wakeup.wait()
+
+            if self.wakeup.is_set():
+                self.wakeup = anyio.Event()
+
+    async def run(self, remailer, workers: Optional[int] = None) -> None:
+        """
+        Runs the workers until cancelled or stopped.
+        """
+        async with anyio.create_task_group() as tasks:
+            for _ in range(self.workers if workers is None else workers):
+                tasks.start_soon(self.run_worker, remailer)
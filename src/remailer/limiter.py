@@ -0,0 +1,214 @@
+import logging
+import time
+from collections import OrderedDict
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import anyio
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    A token bucket allowing `rate` sends per second, with bursts of up to
+    `burst`. Waiters are served in order.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None) -> None:
+        self.rate = rate
+        self.burst = burst if burst else max(rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = anyio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            self._refill()
+
+            while self.tokens < 1:
+                await anyio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+
+            self.tokens -= 1
+
+
+class Limit:
+    """
+    The rate and concurrency limits for a destination, along with the
+    statistics for the sends waiting on it.
+    """
+
+    def __init__(self, rate: Optional[float] = None, burst: Optional[float] = None,
+                 concurrency: Optional[int] = None) -> None:
+        self.bucket = TokenBucket(float(rate), burst and float(burst)) if rate else None
+        self.semaphore = anyio.Semaphore(int(concurrency)) if concurrency else None
+
+        # Sends waiting on or holding the limit
+        self.active = 0
+        self.waiting = 0
+        self.sent = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @classmethod
+    def from_config(cls, limit_config: Optional[dict]) -> "Limit":
+        limit_config = limit_config or {}
+
+        return cls(limit_config.get("rate"), limit_config.get("burst"), limit_config.get("concurrency"))
+
+    def is_limited(self) -> bool:
+        return self.bucket is not None or self.semaphore is not None
+
+    def record_wait(self, waited: float) -> None:
+        self.sent += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def stats(self) -> dict:
+        return {
+            "waiting": self.waiting,
+            "sent": self.sent,
+            "average_wait": self.total_wait / self.sent if self.sent else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+class DestinationLimiter:
+    """
+    Applies rate and concurrency limits to outbound mail, both globally and
+    for each recipient domain. Sends over a limit wait their turn rather than
+    being dropped.
+
+    The configuration takes the form:
+
+        smtp_rate_limits: {
+            global: { rate: 50, burst: 100, concurrency: 10 },
+            default: { rate: 5, concurrency: 2 },
+            domains: {
+                "example.com": { rate: 20, burst: 40, concurrency: 4 },
+            }
+        }
+
+    `rate` is in messages per second, and any setting that is not given is
+    not limited. `default` applies to each domain without its own entry.
+
+    A limit is kept for each domain that `default` has applied to, so that
+    its rate is carried over between messages. Only the `max_domains` most
+    recently used of these are kept (defaults to 1000), so that mail to many
+    different domains does not grow them without bound. Those in use are
+    always kept.
+
+    `max_session_wait` (defaults to 10) is the longest, in seconds, that mail
+    sent while the milter is handling a message waits for its limits. See
+    `limit`.
+    """
+
+    def __init__(self, limits_config: dict) -> None:
+        self.global_limit = Limit.from_config(limits_config.get("global"))
+        self.default_config = limits_config.get("default") or {}
+        self.domain_configs = {
+            domain.lower(): domain_config for (domain, domain_config) in (limits_config.get("domains") or {}).items()
+        }
+        self.max_domains = int(limits_config.get("max_domains", 1000))
+        self.max_session_wait = float(limits_config.get("max_session_wait", 10))
+
+        self.domain_limits: OrderedDict[str, Limit] = OrderedDict()
+
+    def _evict(self) -> None:
+        """
+        Removes the least recently used idle limits for domains without their
+        own entry, to make room for another within `max_domains`.
+        """
+        defaults = [domain for domain in self.domain_limits if domain not in self.domain_configs]
+        excess = len(defaults) + 1 - self.max_domains
+
+        for domain in defaults:
+            if excess <= 0:
+                break
+
+            if self.domain_limits[domain].active == 0:
+                del self.domain_limits[domain]
+                excess -= 1
+
+    def _get_limit(self, domain: str) -> Limit:
+        if domain in self.domain_limits:
+            self.domain_limits.move_to_end(domain)
+        else:
+            if domain not in self.domain_configs:
+                self._evict()
+
+            self.domain_limits[domain] = Limit.from_config(self.domain_configs.get(domain, self.default_config))
+
+        return self.domain_limits[domain]
+
+    @asynccontextmanager
+    async def limit(self, recipients: list[str], timeout: Optional[float] = None) -> AsyncIterator[None]:
+        """
+        Waits until a message to the recipients is within the limits for each
+        of their domains and globally, holding a concurrency slot for each
+        until the context exits.
+
+        If `timeout` is given then `TimeoutError` is raised if the wait takes
+        longer.
+        """
+        domains = sorted({recipient.rsplit("@", 1)[-1].lower() for recipient in recipients})
+
+        # The domains are always taken in the same order to avoid deadlocks,
+        # and the global limit last so that a busy domain does not hold it.
+        limits = [(domain, self._get_limit(domain)) for domain in domains]
+        limits = [entry for entry in limits if entry[1].is_limited()]
+        if self.global_limit.is_limited():
+            limits.append(("*", self.global_limit))
+
+        start = time.monotonic()
+
+        for (_, limit) in limits:
+            limit.active += 1
+            limit.waiting += 1
+
+        try:
+            async with AsyncExitStack() as stack:
+                try:
+                    with anyio.fail_after(timeout):
+                        for (_, limit) in limits:
+                            if limit.semaphore:
+                                await stack.enter_async_context(limit.semaphore)
+                            if limit.bucket:
+                                await limit.bucket.acquire()
+                finally:
+                    for (_, limit) in limits:
+                        limit.waiting -= 1
+
+                waited = time.monotonic() - start
+
+                for (_, limit) in limits:
+                    limit.record_wait(waited)
+
+                if limits and waited > 1:
+                    logger.debug("Outbound mail to %(domains)s waited %(waited).1fs for its limits", {
+                        "domains": ", ".join(domains),
+                        "waited": waited
+                    })
+
+                yield
+        finally:
+            for (_, limit) in limits:
+                limit.active -= 1
+
+    def stats(self) -> dict[str, dict]:
+        """
+        Returns the statistics for each domain that has been limited, with
+        the global statistics under "*".
+        """
+        stats = {domain: limit.stats() for (domain, limit) in self.domain_limits.items() if limit.is_limited()}
+
+        if self.global_limit.is_limited():
+            stats["*"] = self.global_limit.stats()
+
+        return stats
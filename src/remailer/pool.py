@@ -0,0 +1,146 @@
+import logging
+import time
+from typing import Awaitable, Callable
+
+import anyio
+from aiosmtplib import SMTP, SMTPTimeoutError
+
+logger = logging.getLogger(__name__)
+
+
+# Failures that indicate the connection itself has gone, rather than the
+# server refusing the transaction.
+CONNECTION_ERRORS = (ConnectionError, SMTPTimeoutError)
+
+
+class PooledConnection:
+    """
+    An SMTP connection held by the pool, along with its usage.
+    """
+
+    def __init__(self, smtp: SMTP) -> None:
+        self.smtp = smtp
+        self.messages = 0
+        self.last_used = time.monotonic()
+
+
+class SMTPPool:
+    """
+    A pool of long-lived SMTP sessions.
+
+    Connections are created on demand by the `connect` callable, which should
+    return a connected (and, if needed, authenticated) SMTP client. At most
+    `size` connections are in use at any time, with further sends waiting for
+    one to become free. An idle connection is reset with RSET before it is
+    reused, and is closed once it has been idle for `idle_timeout` seconds or
+    has sent `max_messages` messages.
+
+    If a reused connection turns out to have been dropped by the server then
+    the send is retried once on a fresh connection.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], Awaitable[SMTP]],
+        size: int = 1,
+        idle_timeout: float = 60,
+        max_messages: int = 100,
+    ) -> None:
+        self.connect = connect
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+
+        self.idle: list[PooledConnection] = []
+        self.limiter = anyio.Semaphore(size)
+        self.in_use = 0
+
+    def _is_reusable(self, connection: PooledConnection) -> bool:
+        if not connection.smtp.is_connected:
+            return False
+
+        if self.max_messages and connection.messages >= self.max_messages:
+            return False
+
+        return time.monotonic() - connection.last_used < self.idle_timeout
+
+    async def _discard(self, connection: PooledConnection, polite: bool = True) -> None:
+        if polite and connection.smtp.is_connected:
+            try:
+                await connection.smtp.quit()
+                return
+            except Exception:
+                pass
+
+        connection.smtp.close()
+
+    async def _acquire(self) -> PooledConnection:
+        while self.idle:
+            connection = self.idle.pop()
+
+            if not self._is_reusable(connection):
+                await self._discard(connection)
+                continue
+
+            try:
+                await connection.smtp.rset()
+                return connection
+            except Exception as e:
+                logger.debug("Discarding pooled SMTP connection that failed RSET: %(reason)s", {"reason": str(e)})
+                await self._discard(connection, polite=False)
+
+        return PooledConnection(await self.connect())
+
+    async def _release(self, connection: PooledConnection) -> None:
+        connection.last_used = time.monotonic()
+
+        if self._is_reusable(connection):
+            self.idle.append(connection)
+        else:
+            await self._discard(connection)
+
+    async def sendmail(self, sender: str, recipients: list[str], message: bytes) -> any:
+        """
+        Sends the message over a pooled connection.
+        """
+        async with self.limiter:
+            self.in_use += 1
+
+            try:
+                while True:
+                    connection = await self._acquire()
+
+                    try:
+                        result = await connection.smtp.sendmail(sender, recipients, message)
+                    except CONNECTION_ERRORS as e:
+                        await self._discard(connection, polite=False)
+
+                        # Only a connection that had already been used can be
+                        # stale, so a fresh connection failing is final.
+                        if connection.messages == 0:
+                            raise
+
+                        logger.debug("Pooled SMTP connection dropped, reconnecting: %(reason)s", {"reason": str(e)})
+                        continue
+                    except Exception:
+                        # The server refused the transaction, but the
+                        # connection is still good. It is RSET before reuse.
+                        await self._release(connection)
+                        raise
+                    except BaseException:
+                        connection.smtp.close()
+                        raise
+
+                    connection.messages += 1
+                    await self._release(connection)
+
+                    return result
+            finally:
+                self.in_use -= 1
+
+    async def close(self) -> None:
+        """
+        Closes all the idle connections.
+        """
+        while self.idle:
+            await self._discard(self.idle.pop())
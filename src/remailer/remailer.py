@@ -1,8 +1,15 @@
 import logging
+from typing import Optional
 
+import anyio
 from aiosmtplib import SMTP
 from config import Config
 
+from src.tracing import record_error, span
+
+from .limiter import DestinationLimiter
+from .pool import SMTPPool
+
 logger = logging.getLogger(__name__)
 
 
@@ -20,12 +27,27 @@ class Remailer:
     * `smtp_username` (optional) username for SASL PLAIN authentication
     * `smtp_password` (optional) password for SASL PLAIN authentication
 
+    * `smtp_pool_size` (defaults to 0) the number of SMTP sessions to keep
+    open and reuse. When 0 a new connection is made for each message
+    * `smtp_pool_idle_timeout` (defaults to 60) seconds after which an idle
+    pooled session is closed
+    * `smtp_pool_max_messages` (defaults to 100) messages sent over a pooled
+    session before it is replaced
+    * `smtp_release_concurrency` (defaults to 4) the number of sessions used
+    by `sendmail_many` when there is no pool
+    * `smtp_rate_limits` (optional) rate and concurrency limits applied
+    globally and per recipient domain. See `DestinationLimiter`
+
+    Mail sent while a milter session waits that would wait too long for the
+    rate limits is queued in the `outbox`, if one is given, to be sent by its
+    workers instead.
+
     When `smtp_username` and `smtp_password` are both set, the connection
     will negotiate STARTTLS before authenticating. Both must be set or both
     must be unset.
     """
 
-    def __init__(self, app_config: Config):
+    def __init__(self, app_config: Config, outbox=None):
         self.host = app_config.get("smtp_host", "localhost")
         self.port = app_config.get("smtp_port", 25)
         self.helo_host = app_config.get("smtp_helo_host", "localhost")
@@ -49,21 +71,149 @@ class Remailer:
                 "smtp_username and smtp_password must both be set or both be unset"
             )
 
+        self.outbox = outbox
+        self.pool = None
+        self.release_concurrency = int(app_config.get("smtp_release_concurrency", 4))
+
+        rate_limits = app_config.get("smtp_rate_limits", None)
+        self.limiter = DestinationLimiter(rate_limits) if rate_limits else None
+        pool_size = int(app_config.get("smtp_pool_size", 0))
+
+        if pool_size > 0:
+            self.pool = SMTPPool(
+                self._connect,
+                size=pool_size,
+                idle_timeout=float(app_config.get("smtp_pool_idle_timeout", 60)),
+                max_messages=int(app_config.get("smtp_pool_max_messages", 100)),
+            )
+
+    async def _connect(self) -> SMTP:
+        """
+        Opens a new connection for the pool, authenticating if required.
+        """
+        smtp = SMTP(
+            hostname=self.host,
+            port=self.port,
+            local_hostname=self.helo_host,
+            validate_certs=self.validate_certs
+        )
+        await smtp.connect()
+
+        if self.username:
+            try:
+                await smtp.login(self.username, self.password)
+            except Exception:
+                smtp.close()
+                raise
+
+        return smtp
+
+    async def close(self) -> None:
+        if self.pool:
+            await self.pool.close()
+
     async def sendmail(
-        self, recipients: list[str], message: str, sender: str = None
+        self, recipients: list[str], message: str, sender: str = None, in_session: bool = False
+    ) -> any:
+        """
+        Sends a message, returning False if it was not accepted.
+
+        `in_session` should be set when a milter session is waiting on the
+        send, so that it is not held up by the rate limits for longer than
+        `smtp_rate_limits.max_session_wait`. A message that would wait longer
+        is queued in the outbox instead, or waits its turn if there is none.
+        """
+        return await self._sendmail(self.pool, recipients, message, sender, in_session)
+
+    async def sendmail_many(
+        self, messages: list[tuple[list[str], str, Optional[str]]], in_session: bool = False
+    ) -> list[any]:
+        """
+        Sends many messages concurrently, each given as a tuple of the
+        recipients, the message and the sender.
+
+        The messages share a bounded set of SMTP sessions: the pool if there
+        is one, otherwise up to `smtp_release_concurrency` sessions opened just
+        for these messages. The result for each message is returned in the
+        same order, and is False if the message was not accepted. See
+        `sendmail` for `in_session`.
+        """
+        results = [False] * len(messages)
+
+        if not messages:
+            return results
+
+        pool = self.pool or SMTPPool(self._connect, size=self.release_concurrency, max_messages=0)
+
+        async def send(index: int, recipients: list[str], message: str, sender: Optional[str]) -> None:
+            results[index] = await self._sendmail(pool, recipients, message, sender, in_session)
+
+        try:
+            async with anyio.create_task_group() as tasks:
+                for index, (recipients, message, sender) in enumerate(messages):
+                    tasks.start_soon(send, index, recipients, message, sender)
+        finally:
+            if pool is not self.pool:
+                await pool.close()
+
+        return results
+
+    async def _sendmail(
+        self, pool: Optional[SMTPPool], recipients: list[str], message: str, sender: str = None,
+        in_session: bool = False
     ) -> any:
         if sender is None:
             sender = self.sender_from
+
+        if self.limiter:
+            timeout = self.limiter.max_session_wait if in_session and self.outbox else None
+
+            try:
+                async with self.limiter.limit(recipients, timeout):
+                    return await self._send(pool, recipients, message, sender)
+            except TimeoutError:
+                return await self._defer(recipients, message, sender, timeout)
+
+        return await self._send(pool, recipients, message, sender)
+
+    async def _defer(self, recipients: list[str], message: str, sender: str, timeout: float) -> any:
+        """
+        Queues a message in the outbox, returning False if it could not be.
+        """
         try:
-            async with SMTP(
-                hostname=self.host,
-                port=self.port,
-                local_hostname=self.helo_host,
-                validate_certs=self.validate_certs
-            ) as smtp:
-                if self.username:
-                    await smtp.login(self.username, self.password)
-                return await smtp.sendmail(sender, recipients, message.encode("UTF-8"))
+            await anyio.to_thread.run_sync(self.outbox.queue, [(recipients, message, sender)])
         except Exception as e:
-            logger.error("Exception in SMTP: %(reason)s", {"reason": str(e)})
+            logger.error("Unable to queue the mail to %(recipients)s in the outbox: %(reason)s", {
+                "recipients": ", ".join(recipients),
+                "reason": str(e)
+            })
             return False
+
+        self.outbox.notify()
+
+        logger.info("Queued the mail to %(recipients)s in the outbox, as it would wait more than %(timeout)ss", {
+            "recipients": ", ".join(recipients),
+            "timeout": timeout
+        })
+
+        return ({}, "Queued in the outbox")
+
+    async def _send(self, pool: Optional[SMTPPool], recipients: list[str], message: str, sender: str) -> any:
+        with span("smtp", {"server.address": self.host, "smtp.recipients": len(recipients), "smtp.pooled": bool(pool)}):
+            try:
+                if pool:
+                    return await pool.sendmail(sender, recipients, message.encode("UTF-8"))
+
+                async with SMTP(
+                    hostname=self.host,
+                    port=self.port,
+                    local_hostname=self.helo_host,
+                    validate_certs=self.validate_certs
+                ) as smtp:
+                    if self.username:
+                        await smtp.login(self.username, self.password)
+                    return await smtp.sendmail(sender, recipients, message.encode("UTF-8"))
+            except Exception as e:
+                logger.error("Exception in SMTP: %(reason)s", {"reason": str(e)})
+                record_error(str(e))
+                return False
@@ -0,0 +1,18 @@
+from .domains import most_specific, normalise_domain, parent_domains, pattern_to_domain
+from .linear import LinearPattern, Unsupported
+from .lint import lint_pattern
+from .patterns import PatternMatcher, get_matcher, make_matcher, matcher
+
+__all__ = [
+    "LinearPattern",
+    "PatternMatcher",
+    "Unsupported",
+    "get_matcher",
+    "lint_pattern",
+    "make_matcher",
+    "matcher",
+    "most_specific",
+    "normalise_domain",
+    "parent_domains",
+    "pattern_to_domain",
+]
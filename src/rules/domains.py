@@ -0,0 +1,66 @@
+import re
+from typing import Optional
+
+# A domain name, as held for a domain rule: lowercased, without a trailing dot
+DOMAIN_RE = re.compile(r"(?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\.)*[a-z0-9](?:[a-z0-9-]*[a-z0-9])?")
+
+# Patterns that match an address at a domain or any of its subdomains, and so
+# can be replaced by a domain rule. eg `.*@(.*\.)?example\.com` or
+# `^.*[@.]example\.com$`. A pattern such as `.*@example\.com` only matches
+# the domain itself, so is left as it is.
+DOMAIN_PATTERN_RE = re.compile(
+    r"\^?\.\*(?:@\((?:\?:)?\.[*+]\\\.\)\?|\[(?:@\.|\.@)\])"
+    r"(?P<domain>(?:[A-Za-z0-9-]+\\\.)+[A-Za-z0-9-]+)\$?"
+)
+
+
+def normalise_domain(entry: str) -> Optional[str]:
+    """
+    Returns the domain for an entry in a domain list, or None if it is not a
+    domain. The entry can be written as `example.com`, `@example.com` or
+    `*.example.com`.
+    """
+    domain = entry.strip().lower().removeprefix("@").removeprefix("*.").removesuffix(".")
+
+    return domain if DOMAIN_RE.fullmatch(domain) else None
+
+
+def parent_domains(email: str) -> list[str]:
+    """
+    Returns the domain of the address and each of its parent domains, most
+    specific first. eg `list@mail.example.com` gives `mail.example.com`,
+    `example.com` and `com`.
+    """
+    domain = email.rsplit("@", 1)[-1].lower().rstrip(".")
+
+    if not domain:
+        return []
+
+    labels = domain.split(".")
+
+    return [".".join(labels[index:]) for index in range(len(labels))]
+
+
+def pattern_to_domain(pattern: str) -> Optional[str]:
+    """
+    Returns the domain a pattern can be replaced with, if it is equivalent to
+    a domain rule.
+    """
+    match = DOMAIN_PATTERN_RE.fullmatch(pattern.strip())
+
+    if not match:
+        return None
+
+    return normalise_domain(match["domain"].replace("\\.", "."))
+
+
+def most_specific(email: str, actions: dict[str, str]) -> Optional[str]:
+    """
+    Returns the action of the most specific domain rule for the address,
+    from those for its domains.
+    """
+    for domain in parent_domains(email):
+        if domain in actions:
+            return actions[domain]
+
+    return None
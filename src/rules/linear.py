@@ -0,0 +1,348 @@
+"""
+A linear-time matcher for the patterns that could backtrack badly.
+
+The pattern is parsed with the same parser as `re`, and turned into a
+Thompson NFA which is run over the address one character at a time,
+keeping the set of states it could be in. The time taken is proportional
+to the length of the address times the size of the pattern, whatever the
+pattern. Unlike `re` its worst case is bounded, which matters more for
+patterns set by operators.
+
+The sets of states are cached along with the moves between them as they
+are found, building a DFA lazily, so that once a pattern has seen a few
+addresses each character costs a dictionary lookup.
+
+Only the constructs that do not need backtracking are supported. Anything
+else, eg backreferences or lookarounds, raises `Unsupported`.
+"""
+import re
+from typing import Callable, Optional
+
+from .sre import compiler as sre_compile, constants as sre, parser as sre_parse
+
+# Bounded repeats are expanded into copies of their body, so the states are
+# capped to keep that from getting out of hand.
+MAX_STATES = 10000
+
+# The most sets of states cached for a pattern, and moves cached from each,
+# so that unusual addresses cannot grow the cache without bound. Past these
+# they are worked out for each address.
+MAX_STATE_SETS = 1000
+MAX_MOVES = 256
+
+
+class Unsupported(ValueError):
+    pass
+
+
+class State:
+    __slots__ = ("test", "assertion", "out", "alt")
+
+    def __init__(
+        self,
+        test: Optional[Callable[[str], bool]] = None,
+        assertion: Optional[int] = None,
+        out: Optional["State"] = None,
+        alt: Optional["State"] = None,
+    ) -> None:
+        self.test = test
+        self.assertion = assertion
+        self.out = out
+        self.alt = alt
+
+
+def _is_word(char: str) -> bool:
+    return char.isalnum() or char == "_"
+
+
+CATEGORIES = {
+    sre.CATEGORY_DIGIT: str.isdecimal,
+    sre.CATEGORY_NOT_DIGIT: lambda char: not char.isdecimal(),
+    sre.CATEGORY_SPACE: str.isspace,
+    sre.CATEGORY_NOT_SPACE: lambda char: not char.isspace(),
+    sre.CATEGORY_WORD: _is_word,
+    sre.CATEGORY_NOT_WORD: lambda char: not _is_word(char),
+}
+
+
+def _at_boundary(text: str, pos: int) -> bool:
+    before = pos > 0 and _is_word(text[pos - 1])
+    after = pos < len(text) and _is_word(text[pos])
+
+    return before != after
+
+
+ASSERTIONS = {
+    sre.AT_BEGINNING: lambda text, pos: pos == 0,
+    sre.AT_BEGINNING_STRING: lambda text, pos: pos == 0,
+    sre.AT_END: lambda text, pos: pos == len(text) or (pos == len(text) - 1 and text[pos] == "\n"),
+    sre.AT_END_STRING: lambda text, pos: pos == len(text),
+    sre.AT_BOUNDARY: _at_boundary,
+    sre.AT_NON_BOUNDARY: lambda text, pos: not _at_boundary(text, pos),
+}
+
+
+class Compiler:
+    def __init__(self, flags: int) -> None:
+        if flags & (re.MULTILINE | re.ASCII | re.LOCALE):
+            raise Unsupported("only the IGNORECASE, DOTALL and VERBOSE flags are supported")
+
+        self.ignore_case = bool(flags & re.IGNORECASE)
+        self.dot_all = bool(flags & re.DOTALL)
+        self.states = 0
+        # The tests for characters ignoring case, by the item they are for
+        self.folded: dict[str, Callable[[str], bool]] = {}
+        # The assertions used, and their position in a context
+        self.assertions: dict[int, int] = {}
+        self.compilers = {
+            sre.LITERAL: self.literal,
+            sre.NOT_LITERAL: self.not_literal,
+            sre.ANY: self.any_char,
+            sre.IN: self.char_set,
+            sre.AT: self.at,
+            sre.BRANCH: self.branch,
+            sre.SUBPATTERN: self.subpattern,
+            sre.MAX_REPEAT: self.repeat_item,
+            sre.MIN_REPEAT: self.repeat_item,
+        }
+
+    def state(self, **kwargs) -> State:
+        self.states += 1
+
+        if self.states > MAX_STATES:
+            raise Unsupported("the pattern is too large")
+
+        return State(**kwargs)
+
+    def _folded_test(self, item) -> Callable[[str], bool]:
+        """
+        Returns a test of whether a character matches the item ignoring case,
+        compiled by `re` itself. It folds case in ways that `lower` and
+        `upper` do not, eg the Kelvin sign matches `k`, so this keeps the
+        engine matching the same addresses as `re` would.
+        """
+        key = repr(item)
+
+        if key not in self.folded:
+            state = sre_parse.State()
+            state.flags = re.IGNORECASE | re.UNICODE
+            match = sre_compile.compile(sre_parse.SubPattern(state, [item]), state.flags).match
+            self.folded[key] = lambda char: match(char) is not None
+
+        return self.folded[key]
+
+    def _set_test(self, items: list) -> Callable[[str], bool]:
+        negate = False
+        tests = []
+
+        for (op, av) in items:
+            if op is sre.NEGATE:
+                negate = True
+            elif op is sre.LITERAL:
+                tests.append(lambda char, code=av: ord(char) == code)
+            elif op is sre.RANGE:
+                tests.append(lambda char, low=av[0], high=av[1]: low <= ord(char) <= high)
+            elif op is sre.CATEGORY:
+                tests.append(CATEGORIES[av])
+            else:
+                raise Unsupported(f"{op} in a set is not supported")
+
+        if self.ignore_case:
+            return self._folded_test((sre.IN, items))
+
+        if negate:
+            return lambda char: not any(test(char) for test in tests)
+
+        return lambda char: any(test(char) for test in tests)
+
+    def sequence(self, items, out: State) -> State:
+        for item in reversed(list(items)):
+            out = self.item(item, out)
+
+        return out
+
+    def repeat(self, low: int, high: int, body, out: State) -> State:
+        if high == sre.MAXREPEAT:
+            # A loop back to a choice between the body and carrying on
+            loop = self.state(alt=out)
+            loop.out = self.sequence(body, loop)
+            start = loop
+        else:
+            start = out
+
+            for _ in range(high - low):
+                start = self.state(out=self.sequence(body, start), alt=out)
+
+        for _ in range(low):
+            start = self.sequence(body, start)
+
+        return start
+
+    def literal(self, code: int, out: State) -> State:
+        if self.ignore_case:
+            return self.state(test=self._folded_test((sre.LITERAL, code)), out=out)
+
+        return self.state(test=lambda char: ord(char) == code, out=out)
+
+    def not_literal(self, code: int, out: State) -> State:
+        if self.ignore_case:
+            return self.state(test=self._folded_test((sre.NOT_LITERAL, code)), out=out)
+
+        return self.state(test=lambda char: ord(char) != code, out=out)
+
+    def any_char(self, _, out: State) -> State:
+        return self.state(test=(lambda char: True) if self.dot_all else (lambda char: char != "\n"), out=out)
+
+    def char_set(self, items: list, out: State) -> State:
+        return self.state(test=self._set_test(items), out=out)
+
+    def at(self, position, out: State) -> State:
+        if position not in ASSERTIONS:
+            raise Unsupported(f"{position} is not supported")
+
+        index = self.assertions.setdefault(position, len(self.assertions))
+
+        return self.state(assertion=index, out=out)
+
+    def branch(self, av, out: State) -> State:
+        branches = [self.sequence(branch, out) for branch in av[1]]
+        start = branches[-1]
+
+        for branch in reversed(branches[:-1]):
+            start = self.state(out=branch, alt=start)
+
+        return start
+
+    def subpattern(self, av, out: State) -> State:
+        (_, add_flags, del_flags, body) = av
+
+        if del_flags & re.IGNORECASE and self.ignore_case or add_flags & ~(re.IGNORECASE | re.UNICODE):
+            raise Unsupported("inline flags are not supported")
+
+        if add_flags & re.IGNORECASE and not self.ignore_case:
+            raise Unsupported("inline flags are not supported")
+
+        return self.sequence(body, out)
+
+    def repeat_item(self, av, out: State) -> State:
+        # Laziness only changes which match is found, not whether there is
+        # one.
+        (low, high, body) = av
+        return self.repeat(low, high, body, out)
+
+    def item(self, item, out: State) -> State:
+        (op, av) = item
+        compile_op = self.compilers.get(op)
+
+        if compile_op is None:
+            raise Unsupported(f"{op} is not supported")
+
+        return compile_op(av, out)
+
+
+class StateSet:
+    """
+    A set of states that the pattern could be in, with the moves from it
+    that have been found so far.
+    """
+
+    __slots__ = ("states", "matched", "moves")
+
+    def __init__(self, states: list[State]) -> None:
+        self.states = states
+        self.matched = any(state.test is None and state.out is None for state in states)
+        self.moves: dict[object, "StateSet"] = {}
+
+
+class LinearPattern:
+    """
+    A pattern compiled for matching in linear time, with the same `fullmatch`
+    as a compiled `re` pattern.
+    """
+
+    def __init__(self, pattern: str, flags: int = 0) -> None:
+        self.pattern = pattern
+
+        parsed = sre_parse.parse(pattern, flags)
+        compiler = Compiler(parsed.state.flags)
+        self.start = compiler.sequence(parsed, State())
+        self.assertions = [ASSERTIONS[position] for position in compiler.assertions]
+
+        self.state_sets: dict[tuple[int, ...], StateSet] = {}
+        self.starts: dict[tuple[bool, ...], StateSet] = {}
+
+    def _context(self, text: str, pos: int) -> tuple[bool, ...]:
+        """
+        Returns which of the pattern's assertions hold at the position.
+        """
+        return tuple(assertion(text, pos) for assertion in self.assertions)
+
+    def _closure(self, states: list[State], context: tuple[bool, ...]) -> StateSet:
+        """
+        Follows the choices and assertions from the states, returning the
+        set of states that consume a character or match.
+        """
+        seen = set()
+        stack = list(reversed(states))
+        result = []
+
+        while stack:
+            state = stack.pop()
+
+            if id(state) in seen:
+                continue
+
+            seen.add(id(state))
+
+            if state.test is not None or state.out is None:
+                result.append(state)
+            elif state.assertion is not None:
+                if context[state.assertion]:
+                    stack.append(state.out)
+            else:
+                if state.alt is not None:
+                    stack.append(state.alt)
+                stack.append(state.out)
+
+        key = tuple(id(state) for state in result)
+        state_set = self.state_sets.get(key)
+
+        if state_set is None:
+            state_set = StateSet(result)
+
+            if len(self.state_sets) < MAX_STATE_SETS:
+                self.state_sets[key] = state_set
+
+        return state_set
+
+    def fullmatch(self, text: str) -> bool:
+        context = self._context(text, 0)
+        state_set = self.starts.get(context)
+
+        if state_set is None:
+            state_set = self.starts[context] = self._closure([self.start], context)
+
+        for (pos, char) in enumerate(text):
+            # Without assertions the moves depend only on the character
+            if self.assertions:
+                context = self._context(text, pos + 1)
+                move = (char, context)
+            else:
+                move = char
+
+            following = state_set.moves.get(move)
+
+            if following is None:
+                following = self._closure(
+                    [state.out for state in state_set.states if state.test is not None and state.test(char)], context
+                )
+
+                if len(state_set.moves) < MAX_MOVES:
+                    state_set.moves[move] = following
+
+            state_set = following
+
+            if not state_set.states:
+                return False
+
+        return state_set.matched
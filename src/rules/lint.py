@@ -0,0 +1,157 @@
+import re
+
+from .sre import ATOMIC_GROUP, POSSESSIVE_REPEAT, constants as sre, parser as sre_parse
+
+# Repeats of more than this are treated as unbounded
+LARGE_REPEAT = 16
+
+
+def _is_repeat(op) -> bool:
+    return op in (sre.MAX_REPEAT, sre.MIN_REPEAT, POSSESSIVE_REPEAT)
+
+
+def _is_unbounded(high: int) -> bool:
+    return high == sre.MAXREPEAT or high > LARGE_REPEAT
+
+
+def _contains_repeat(items) -> bool:
+    for (op, av) in items:
+        if _is_repeat(op) and av[1] > 1:
+            return True
+
+        if any(_contains_repeat(child) for child in _children(op, av)):
+            return True
+
+    return False
+
+
+def _children(op, av) -> list:
+    if op is sre.BRANCH:
+        return av[1]
+
+    if op is sre.SUBPATTERN:
+        return [av[3]]
+
+    if _is_repeat(op):
+        return [av[2]]
+
+    if op in (sre.ASSERT, sre.ASSERT_NOT):
+        return [av[1]]
+
+    if op is ATOMIC_GROUP:
+        return [av]
+
+    if op is sre.GROUPREF_EXISTS:
+        return [branch for branch in av[1:] if branch]
+
+    return []
+
+
+def _is_wide(items) -> bool:
+    """
+    Whether the items are a single item that matches a broad class of
+    characters, eg `.` or `\\w`, which overlaps with most anything else.
+    """
+    items = list(items)
+
+    if len(items) != 1:
+        return False
+
+    (op, av) = items[0]
+
+    if op is sre.ANY or op is sre.NOT_LITERAL:
+        return True
+
+    if op is sre.IN:
+        return any(item_op in (sre.NEGATE, sre.CATEGORY) for (item_op, _) in av)
+
+    if op is sre.SUBPATTERN:
+        return _is_wide(av[3])
+
+    return False
+
+
+# Matching a run of wide unbounded quantifiers separated only by literals
+# can take time polynomial in the length of the address, to the power of the
+# number of them. Two, as in `.*-bounces@.*`, are common and quick enough.
+MAX_OVERLAPPING = 2
+
+OVERLAPPING = "three or more overlapping quantifiers, eg .*a.*a.*b"
+
+
+def _lint_repeat(body, hazards: list[str]) -> None:
+    if _contains_repeat(body):
+        hazards.append("nested quantifiers, eg (a+)+")
+
+    if any(body_op is sre.BRANCH for (body_op, _) in _flatten(body)):
+        hazards.append("a quantified alternation, eg (a|ab)*")
+
+
+def _after_item(overlapping: int, op, av) -> int:
+    """
+    Returns the number of wide unbounded quantifiers in the run carried on
+    past `op`, which ends the run unless it is a literal or can be skipped.
+    """
+    if _is_repeat(op):
+        # A repeat that can be skipped does not separate anything
+        return overlapping if av[0] == 0 else 0
+
+    if op is sre.AT or op is sre.LITERAL:
+        return overlapping
+
+    return 0
+
+
+def _lint(items, hazards: list[str]) -> None:
+    overlapping = 0
+
+    for (op, av) in _flatten(items):
+        if _is_repeat(op) and _is_unbounded(av[1]):
+            _lint_repeat(av[2], hazards)
+
+            if _is_wide(av[2]):
+                overlapping += 1
+
+                if overlapping > MAX_OVERLAPPING:
+                    hazards.append(OVERLAPPING)
+            else:
+                overlapping = 0
+        else:
+            overlapping = _after_item(overlapping, op, av)
+
+        if op is sre.GROUPREF:
+            hazards.append("a backreference")
+
+        for child in _children(op, av):
+            _lint(child, hazards)
+
+
+def _flatten(items) -> list:
+    """
+    Returns the items, with any groups opened up.
+    """
+    flattened = []
+
+    for (op, av) in items:
+        if op is sre.SUBPATTERN:
+            flattened.extend(_flatten(av[3]))
+        else:
+            flattened.append((op, av))
+
+    return flattened
+
+
+def lint_pattern(pattern: str) -> list[str]:
+    """
+    Returns the hazards in a pattern that could make matching it take time
+    exponential or polynomial in the length of the address, if any. Raises
+    `re.error` if it is not a valid pattern.
+
+    This errs on the side of caution, so a pattern that is flagged may well
+    be safe.
+    """
+    hazards = []
+
+    _lint(sre_parse.parse(pattern, re.IGNORECASE), hazards)
+
+    return list(dict.fromkeys(hazards))
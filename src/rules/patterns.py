@@ -0,0 +1,137 @@
+import logging
+import re
+import time
+from typing import Optional
+
+from config import Config
+
+from src import services
+from src.metrics import Counter, registry
+
+from .linear import LinearPattern, Unsupported
+from .lint import lint_pattern
+
+logger = logging.getLogger(__name__)
+
+pattern_matches = registry.register(Counter(
+    "postconfirm_pattern_matches_total", "Addresses matched against patterns, by engine", ["engine"]
+))
+slow_patterns = registry.register(Counter(
+    "postconfirm_slow_patterns_total", "Pattern matches that took longer than the budget"
+))
+
+
+class CompiledPattern:
+    __slots__ = ("pattern", "regex", "linear", "hazards", "skipped")
+
+    def __init__(self, pattern: str) -> None:
+        self.pattern = pattern
+        self.regex = re.compile(pattern, re.IGNORECASE)
+        self.linear: Optional[LinearPattern] = None
+        self.hazards = lint_pattern(pattern)
+        self.skipped = False
+
+
+class PatternMatcher:
+    """
+    Matches addresses against the patterns from the rules, which are
+    matched case insensitively against the whole address.
+
+    The patterns come from operators but the addresses do not, and a pattern
+    that backtracks badly can hold up everything else for seconds. A match
+    in `re` cannot be interrupted, so:
+
+    * patterns are matched in linear time, and only those that cannot be (eg
+    with backreferences or lookarounds) are matched with `re`
+    * of those, the ones that the lint flags are skipped
+    * addresses longer than `max_length` are not matched against patterns
+    * a match with `re` that takes longer than `budget` seconds is reported,
+    and the pattern is skipped from then on
+
+    Each pattern is compiled and linted once, when it is first used.
+    """
+
+    def __init__(self, max_length: int = 254, budget: float = 0.05) -> None:
+        self.max_length = max_length
+        self.budget = budget
+        self.compiled: dict[str, CompiledPattern] = {}
+
+    def _make_linear(self, compiled: CompiledPattern) -> None:
+        try:
+            compiled.linear = LinearPattern(compiled.pattern, re.IGNORECASE)
+        except Unsupported as e:
+            if compiled.hazards:
+                compiled.skipped = True
+
+                logger.error(
+                    "The pattern %(pattern)s has %(hazards)s and cannot be matched in linear time (%(cause)s), "
+                    "so is skipped",
+                    {"pattern": compiled.pattern, "hazards": ", ".join(compiled.hazards), "cause": str(e)}
+                )
+            else:
+                logger.info("The pattern %(pattern)s cannot be matched in linear time (%(cause)s), so is matched with re", {
+                    "pattern": compiled.pattern,
+                    "cause": str(e),
+                })
+
+    def compile(self, pattern: str) -> CompiledPattern:
+        """
+        Returns the compiled pattern. Raises `re.error` if it is not valid.
+        """
+        compiled = self.compiled.get(pattern)
+
+        if compiled is None:
+            compiled = CompiledPattern(pattern)
+            self._make_linear(compiled)
+            self.compiled[pattern] = compiled
+
+        return compiled
+
+    def fullmatch(self, pattern: str, email: str) -> bool:
+        if len(email) > self.max_length:
+            logger.debug("Not matching %(email)s against patterns, as it is too long", {"email": email})
+            return False
+
+        compiled = self.compile(pattern)
+
+        if compiled.skipped:
+            return False
+
+        if compiled.linear:
+            pattern_matches.inc(engine="linear")
+            return compiled.linear.fullmatch(email)
+
+        pattern_matches.inc(engine="re")
+
+        start = time.perf_counter()
+        matched = compiled.regex.fullmatch(email) is not None
+        elapsed = time.perf_counter() - start
+
+        if elapsed > self.budget:
+            slow_patterns.inc()
+            compiled.skipped = True
+
+            logger.error("The pattern %(pattern)s took %(elapsed).3fs to match %(email)s, so is skipped", {
+                "pattern": pattern,
+                "elapsed": elapsed,
+                "email": email,
+            })
+
+        return matched
+
+
+def make_matcher(app_config: Config) -> PatternMatcher:
+    return PatternMatcher(
+        max_length=int(app_config.get("patterns.max_length", 254)),
+        budget=float(app_config.get("patterns.budget", 0.05)),
+    )
+
+
+matcher = PatternMatcher()
+
+
+def get_matcher() -> PatternMatcher:
+    """
+    Returns the pattern matcher of the current services, if there is one.
+    """
+    return services.get("patterns", matcher)
@@ -0,0 +1,27 @@
+"""
+The parser behind `re`, which the lint and the linear-time engine share so
+that they see patterns exactly as `re` does, and its compiler, which the
+engine uses to match characters ignoring case exactly as `re` does.
+
+It is not a public API: it moved to `re._parser` and `re._constants` in
+Python 3.11, with the old `sre_parse` and `sre_constants` modules kept only
+as deprecated aliases. The possessive repeats and atomic groups that arrived
+with it are stood in for on older versions, where they cannot be parsed.
+"""
+try:
+    from re import _compiler as compiler, _constants as constants, _parser as parser
+except ImportError:  # Python < 3.11
+    import sre_compile as compiler
+    import sre_constants as constants
+    import sre_parse as parser
+
+POSSESSIVE_REPEAT = getattr(constants, "POSSESSIVE_REPEAT", object())
+ATOMIC_GROUP = getattr(constants, "ATOMIC_GROUP", object())
+
+__all__ = [
+    "ATOMIC_GROUP",
+    "POSSESSIVE_REPEAT",
+    "compiler",
+    "constants",
+    "parser",
+]
@@ -1,22 +1,40 @@
 from psycopg import Cursor
 
+from src import services
 
 from .handler_db import HandlerDb
 from .handler_db_static import HandlerDbStatic
+from .keys import SenderKeys, get_sender_keys, make_sender_keys
 from .sender import Sender
 
+__all__ = [
+    "get_default_handler",
+    "get_handler_instance",
+    "get_sender",
+    "get_sender_keys",
+    "get_static_sender",
+    "make_sender_keys",
+    "HandlerDb",
+    "HandlerDbStatic",
+    "Sender",
+    "SenderKeys",
+]
 
 handlers = {"db": HandlerDb, "static": HandlerDbStatic, "_default": "db"}
 instances = {}
 
 
 def get_handler_instance(name: str, **kwargs) -> any:
-    global instances
+    """
+    Returns the handler of the current services, creating it on first use so
+    that it is built from their configuration.
+    """
+    handler_instances = services.get("sender_handlers", instances)
 
-    if name not in instances:
-        instances[name] = handlers[name](**kwargs)
+    if name not in handler_instances:
+        handler_instances[name] = handlers[name](**kwargs)
 
-    return instances[name]
+    return handler_instances[name]
 
 
 def get_default_handler() -> any:
@@ -26,8 +44,8 @@ def get_default_handler() -> any:
 
 
 def get_sender(email) -> Sender:
-    return Sender(email, get_default_handler())
+    return Sender(get_sender_keys().key(email), get_default_handler(), address=email)
 
 
 def get_static_sender(email, cursor: Cursor = None) -> Sender:
-    return Sender(email, get_handler_instance("static", cursor=cursor))
+    return Sender(get_sender_keys().key(email), get_handler_instance("static", cursor=cursor), address=email)
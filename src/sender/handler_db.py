@@ -4,76 +4,171 @@ from typing import Iterable, Optional, Tuple
 
 from config import Config
 
-from .typing import Action
+from .keys import get_sender_keys
+from .typing import Action, Outbound
 
 from src import services
 from src.db import get_db_pool
+from src.rules import parent_domains
 
 logger = logging.getLogger(__name__)
 
+# Messages are stashed by postconfirm and also imported from the legacy cache.
+STASH_TABLES = ["stash", "stash_static"]
+
+
+def match_sender(column: str = "sender") -> str:
+    """
+    Returns the condition matching `column` against the `sender` parameter.
+
+    With `sender_keys.lowercase` set the keys are lowercase, so the rows
+    stored before it was set are matched ignoring case.
+    """
+    if get_sender_keys().lowercase:
+        return f"lower({column})=%(sender)s"
+
+    return f"{column}=%(sender)s"
+
 
 class HandlerDb:
     def __init__(self, app_config: Config = None) -> None:
         self.app_config = app_config if app_config else services["app_config"]
 
-    def get_action_for_sender(self, sender: str) -> Optional[Tuple[Action, str]]:
+    def warm_up(self) -> None:
         """
-        Return any action for the given sender
+        Opens the database pools, including those for any replicas, so that
+        the first lookups do not wait for connections.
         """
+        get_db_pool(self.app_config["db"], "db")
+        get_db_pool(self.app_config["db"], "db", read_only=True)
 
-        action = None
-        refs = None
+    def get_action_for_sender(self, sender: str, use_primary: bool = False) -> Optional[Tuple[Action, str]]:
+        """
+        Return any action for the given sender
+
+        The lookup is made against a replica, if available, unless
+        `use_primary` is set. This should be used where the result must
+        reflect earlier writes.
+        """
 
         # We use the data from the senders table as a start.
         # We fill in the gaps from the static table.
         # Any references are always merged.
+        # Failing those, the most specific domain rule is used.
+        # Addresses are matched ignoring case if the keys are lowercased,
+        # preferring an exact match.
 
-        with get_db_pool(self.app_config["db"], "db").connection() as connection:
+        with get_db_pool(self.app_config["db"], "db", read_only=not use_primary).connection() as connection:
             with connection.cursor() as cursor:
-                cursor.execute(
-                    """
-                    SELECT
-                        action, ref
-                        FROM senders
-                        WHERE sender=%(sender)s AND type='E'
-                    """,
-                    {"sender": sender}
-                )
-                result = cursor.fetchone()
+                (action, refs) = self._get_sender_action(cursor, sender)
+                (static_action, static_refs) = self._get_static_action(cursor, sender)
 
-                cursor.execute(
-                    """
-                    SELECT
-                        action, ref
-                        FROM senders_static
-                        WHERE sender=%(sender)s AND type='E'
-                    """,
-                    {"sender": sender}
-                )
-                static_result = cursor.fetchone()
-
-                if result:
-                    action = result[0]
-                    if result[1]:
-                        refs = self._extract_refs(result[1])
-
-                if static_result:
-                    if not action:
-                        action = static_result[0]
+                action = action or static_action
+                refs = self._merge_refs(refs, static_refs)
 
-                    if static_result[1]:
-                        static_refs = self._extract_refs(static_result[1])
-
-                        if refs is None:
-                            refs = static_refs
-                        elif static_refs:
-                            refs = list(set(refs).union(static_refs))
+                if not action:
+                    action = self._get_domain_action(cursor, sender)
 
         if not action:
             action = "unknown"
 
         return (action, refs)
 
+    def _get_sender_action(self, cursor, sender: str) -> Tuple[Optional[Action], Optional[list[str]]]:
+        """
+        Returns the action and references held for the sender on the senders
+        table.
+        """
+        cursor.execute(
+            f"""
+            SELECT
+                action
+                FROM senders
+                WHERE {match_sender()} AND type='E'
+                ORDER BY sender=%(sender)s DESC
+                LIMIT 1
+            """,
+            {"sender": sender}
+        )
+        result = cursor.fetchone()
+
+        if not result:
+            return (None, None)
+
+        cursor.execute(
+            f"""
+            SELECT
+                ref
+                FROM sender_refs
+                WHERE {match_sender()}
+                ORDER BY created
+            """,
+            {"sender": sender}
+        )
+        sender_refs = [row[0] for row in cursor.fetchall()]
+
+        return (result[0], sender_refs or None)
+
+    def _get_static_action(self, cursor, sender: str) -> Tuple[Optional[Action], Optional[list[str]]]:
+        """
+        Returns the action and references held for the sender on the static
+        table.
+        """
+        cursor.execute(
+            f"""
+            SELECT
+                action, ref
+                FROM senders_static
+                WHERE {match_sender()} AND type='E'
+                ORDER BY sender=%(sender)s DESC
+                LIMIT 1
+            """,
+            {"sender": sender}
+        )
+        static_result = cursor.fetchone()
+
+        if not static_result:
+            return (None, None)
+
+        static_refs = self._extract_refs(static_result[1]) if static_result[1] else None
+
+        return (static_result[0], static_refs)
+
+    def _merge_refs(self, refs: Optional[list[str]], static_refs: Optional[list[str]]) -> Optional[list[str]]:
+        if refs is None:
+            return static_refs
+
+        if static_refs:
+            return list(set(refs).union(static_refs))
+
+        return refs
+
+    def _get_domain_action(self, cursor, sender: str) -> Optional[Action]:
+        """
+        Returns the action of the most specific domain rule for the sender,
+        preferring the senders table for the same domain. The rules are held
+        under the domain, so this is an indexed lookup.
+        """
+        cursor.execute(
+            """
+            SELECT
+                action, 0 AS precedence, length(sender) AS specificity
+                FROM senders
+                WHERE sender = ANY(%(domains)s) AND type='D'
+            UNION ALL
+            SELECT
+                action, 1 AS precedence, length(sender) AS specificity
+                FROM senders_static
+                WHERE sender = ANY(%(domains)s) AND type='D'
+            ORDER BY specificity DESC, precedence
+            LIMIT 1
+            """,
+            {"domains": parent_domains(sender)}
+        )
+        result = cursor.fetchone()
+
+        return result[0] if result else None
+
     def _extract_refs(self, ref_entry) -> Optional[list[str]]:
         refs = None
 
@@ -93,7 +188,7 @@ class HandlerDb:
         """
         Returns any pattern-type actions
         """
-        with get_db_pool(self.app_config["db"], "db").connection() as connection:
+        with get_db_pool(self.app_config["db"], "db", read_only=True).connection() as connection:
             with connection.cursor() as cursor:
                 # Patterns can be much simpler than Emails because a pattern
                 # should never actually have references. This means there is no
@@ -116,46 +211,178 @@ class HandlerDb:
                     yield row
 
     def is_never_allowed(self, sender: str) -> bool:
-        with get_db_pool(self.app_config["db"], "db").connection() as connection:
+        with get_db_pool(self.app_config["db"], "db", read_only=True).connection() as connection:
             with connection.cursor() as cursor:
                 cursor.execute(
-                    "SELECT 1 FROM never_allow WHERE email = %(sender)s",
+                    f"SELECT 1 FROM never_allow WHERE {match_sender('email')}",
                     {"sender": sender}
                 )
                 return cursor.fetchone() is not None
 
-    def set_action_for_sender(self, sender: str, action: Action, ref: str) -> bool:
+    def set_action_for_sender(self, sender: str, action: Action) -> bool:
         """
         Sets the action for the sender
+
+        The references are not touched, as they are stored as they are added.
         """
         with get_db_pool(self.app_config["db"], "db").connection() as connection:
             with connection.cursor() as cursor:
-                parsed_ref = json.dumps(ref) if ref else None
+                try:
+                    self._set_action(cursor, sender, action)
+                    connection.commit()
+                    return True
+
+                except Exception as e:
+                    print(f"ERROR setting sender: {e}", flush=True)
+                    return False
+
+    def _set_action(self, cursor, sender: str, action: Action) -> None:
+        cursor.execute(
+            """
+            INSERT INTO senders
+                (sender, action, type, source)
+                VALUES
+                    (%(sender)s, %(action)s, 'E', 'postconfirm')
+                ON CONFLICT (sender)
+                    DO UPDATE SET action=%(action)s, updated=now()
+            """,
+            {"sender": sender, "action": action}
+        )
+
+    def claim_challenge_for_sender(self, sender: str, cooldown: float) -> bool:
+        """
+        Records that the sender is about to be challenged, unless they were
+        already challenged within the last `cooldown` seconds.
+
+        The check and update are a single statement, so when concurrent
+        sessions race for the same sender only one of them wins.
 
+        Returns True if the challenge should be sent.
+        """
+        with get_db_pool(self.app_config["db"], "db").connection() as connection:
+            with connection.cursor() as cursor:
                 try:
                     cursor.execute(
                         """
                         INSERT INTO senders
-                            (sender, action, ref, type, source)
+                            (sender, action, type, source, challenged)
                             VALUES
-                                (%(sender)s, %(action)s, %(ref)s, 'E', 'postconfirm')
+                                (%(sender)s, 'confirm', 'E', 'postconfirm', now())
                             ON CONFLICT (sender)
-                                DO UPDATE SET action=%(action)s, updated=now()
+                                DO UPDATE SET challenged=now()
+                                WHERE senders.challenged IS NULL
+                                    OR senders.challenged < now() - make_interval(secs => %(cooldown)s)
+                            RETURNING 1
+                        """,
+                        {"sender": sender, "cooldown": cooldown}
+                    )
+                    claimed = cursor.fetchone() is not None
+                    connection.commit()
+                    return claimed
+
+                except Exception as e:
+                    # Failing open means a possible duplicate challenge rather
+                    # than none at all.
+                    print(f"ERROR claiming challenge: {e}", flush=True)
+                    return True
+
+    def add_reference_for_sender(self, sender: str, ref: str) -> bool:
+        """
+        Adds a single reference for the sender.
+
+        This is an atomic append, so concurrent sessions cannot lose each
+        other's references.
+        """
+        with get_db_pool(self.app_config["db"], "db").connection() as connection:
+            with connection.cursor() as cursor:
+                try:
+                    cursor.execute(
+                        """
+                        INSERT INTO sender_refs
+                            (sender, ref)
+                            VALUES
+                                (%(sender)s, %(ref)s)
+                            ON CONFLICT DO NOTHING
                         """,
-                        {"sender": sender, "action": action, "ref": parsed_ref}
+                        {"sender": sender, "ref": ref}
                     )
                     connection.commit()
                     return True
 
                 except Exception as e:
-                    print(f"ERROR setting sender: {e}", flush=True)
+                    print(f"ERROR adding reference: {e}", flush=True)
+                    return False
+
+    def has_reference_for_sender(self, sender: str, ref: str) -> bool:
+        """
+        Checks whether the reference is held for the sender.
+
+        This always uses the primary as the reference may have only just been
+        added.
+        """
+        with get_db_pool(self.app_config["db"], "db").connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"SELECT 1 FROM sender_refs WHERE {match_sender()} AND ref=%(ref)s",
+                    {"sender": sender, "ref": ref}
+                )
+
+                if cursor.fetchone() is not None:
+                    return True
+
+                # Imported in-progress confirmations still hold their
+                # references on the static table.
+                cursor.execute(
+                    f"""
+                    SELECT ref
+                        FROM senders_static
+                        WHERE {match_sender()} AND type='E'
+                        ORDER BY sender=%(sender)s DESC
+                        LIMIT 1
+                    """,
+                    {"sender": sender}
+                )
+                static_result = cursor.fetchone()
+
+                if static_result and static_result[0]:
+                    return ref in (self._extract_refs(static_result[0]) or [])
+
+        return False
+
+    def clear_references_for_sender(self, sender: str) -> bool:
+        """
+        Removes all the references for the sender
+        """
+        with get_db_pool(self.app_config["db"], "db").connection() as connection:
+            with connection.cursor() as cursor:
+                try:
+                    cursor.execute(
+                        f"DELETE FROM sender_refs WHERE {match_sender()}",
+                        {"sender": sender}
+                    )
+                    connection.commit()
+                    return True
+
+                except Exception as e:
+                    print(f"ERROR clearing references: {e}", flush=True)
                     return False
 
     def stash_message_for_sender(
-        self, sender: str, msg: str, recipients: list[str]
+        self,
+        sender: str,
+        msg: str,
+        recipients: list[str],
+        outbound: Optional[list[Outbound]] = None,
+        envelope_sender: Optional[str] = None,
     ) -> bool:
         """
         Stores the message for the sender
+
+        The `envelope_sender` the message came from, if it is not the
+        sender's key, is kept so that the message is released from it.
+
+        Any outbound messages, such as the challenge, are queued in the outbox
+        in the same transaction.
         """
         with get_db_pool(self.app_config["db"], "db").connection() as connection:
             with connection.cursor() as cursor:
@@ -163,12 +390,32 @@ class HandlerDb:
                     cursor.execute(
                         """
                         INSERT INTO stash
-                            (sender, recipients, message)
+                            (sender, envelope_sender, recipients, message)
                             VALUES
-                                (%(sender)s, %(recipients)s, %(message)s)
+                                (%(sender)s, %(envelope_sender)s, %(recipients)s, %(message)s)
                         """,
-                        {"sender": sender, "recipients": json.dumps(recipients), "message": msg}
+                        {
+                            "sender": sender,
+                            "envelope_sender": envelope_sender,
+                            "recipients": json.dumps(recipients),
+                            "message": msg,
+                        }
                     )
+
+                    if outbound:
+                        cursor.executemany(
+                            """
+                            INSERT INTO outbox
+                                (sender, recipients, message)
+                                VALUES
+                                    (%(sender)s, %(recipients)s, %(message)s)
+                            """,
+                            [
+                                {"sender": out_sender, "recipients": json.dumps(out_recipients), "message": out_msg}
+                                for (out_recipients, out_msg, out_sender) in outbound
+                            ]
+                        )
+
                     connection.commit()
                     return True
 
@@ -176,6 +423,138 @@ class HandlerDb:
                     print(f"ERROR stashing mail: {e}")
                     return False
 
+    def get_stashed_messages_for_sender(
+        self, sender: str
+    ) -> list[Tuple[Tuple[str, int], list[str], str, str]]:
+        """
+        Returns the stashed messages for the sender without removing them,
+        along with the envelope sender each came from.
+
+        Each entry has a key to pass to `remove_stashed_messages_for_sender`
+        once the message has been dealt with.
+        """
+        stashed = []
+
+        with get_db_pool(self.app_config["db"], "db").connection() as connection:
+            with connection.cursor() as cursor:
+                for table in STASH_TABLES:
+                    cursor.execute(
+                        f"""
+                        SELECT
+                            id, recipients, message, COALESCE(envelope_sender, sender)
+                            FROM {table}
+                            WHERE {match_sender()}
+                            ORDER BY id
+                        """,
+                        {"sender": sender}
+                    )
+
+                    stashed.extend(
+                        ((table, row_id), json.loads(recipients), message, envelope_sender)
+                        for (row_id, recipients, message, envelope_sender) in cursor.fetchall()
+                    )
+
+        return stashed
+
+    def remove_stashed_messages_for_sender(self, sender: str, keys: Iterable[Tuple[str, int]]) -> bool:
+        """
+        Removes the given stashed messages for the sender.
+        """
+        ids_by_table = {}
+        for (table, row_id) in keys:
+            ids_by_table.setdefault(table, []).append(row_id)
+
+        with get_db_pool(self.app_config["db"], "db").connection() as connection:
+            with connection.cursor() as cursor:
+                try:
+                    for table in STASH_TABLES:
+                        if table in ids_by_table:
+                            cursor.execute(
+                                f"""
+                                DELETE FROM {table}
+                                    WHERE {match_sender()} AND id = ANY(%(ids)s)
+                                """,
+                                {"sender": sender, "ids": ids_by_table[table]}
+                            )
+                    connection.commit()
+                    return True
+
+                except Exception as e:
+                    print(f"ERROR removing stashed mails: {e}", flush=True)
+                    return False
+
+    def queue_release_for_sender(self, sender: str) -> int:
+        """
+        Moves all the stashed messages for the sender into the outbox, in a
+        single transaction, to be sent from the envelope senders they came
+        from.
+
+        Returns the number of messages queued.
+        """
+        with get_db_pool(self.app_config["db"], "db").connection() as connection:
+            with connection.cursor() as cursor:
+                try:
+                    queued = self._queue_release(cursor, sender)
+                    connection.commit()
+
+                except Exception as e:
+                    print(f"ERROR queueing stashed mails: {e}", flush=True)
+                    return 0
+
+        return queued
+
+    def _queue_release(self, cursor, sender: str) -> int:
+        queued = 0
+
+        for table in STASH_TABLES:
+            cursor.execute(
+                f"""
+                WITH released AS (
+                    DELETE FROM {table}
+                        WHERE {match_sender()}
+                        RETURNING id, COALESCE(envelope_sender, sender) AS sender, recipients, message
+                )
+                INSERT INTO outbox
+                    (sender, recipients, message)
+                    SELECT sender, recipients, message
+                        FROM released
+                        ORDER BY id
+                """,
+                {"sender": sender}
+            )
+            queued += cursor.rowcount
+
+        return queued
+
+    def accept_sender(self, sender: str, queue_release: bool = False) -> Optional[int]:
+        """
+        Accepts the sender and removes their references, and if
+        `queue_release` is set moves their stashed messages into the outbox,
+        all in a single transaction.
+
+        Returns the number of messages queued, or None if the sender could
+        not be accepted.
+        """
+        with get_db_pool(self.app_config["db"], "db").connection() as connection:
+            with connection.cursor() as cursor:
+                try:
+                    self._set_action(cursor, sender, "accept")
+
+                    cursor.execute(
+                        f"DELETE FROM sender_refs WHERE {match_sender()}",
+                        {"sender": sender}
+                    )
+
+                    queued = self._queue_release(cursor, sender) if queue_release else 0
+
+                    connection.commit()
+
+                except Exception as e:
+                    print(f"ERROR accepting sender: {e}", flush=True)
+                    return None
+
+        return queued
+
     def unstash_messages_for_sender(
         self, sender: str
     ) -> Iterable[Tuple[str, list[str]]]:
@@ -186,11 +565,11 @@ class HandlerDb:
             with connection.cursor() as cursor:
                 try:
                     cursor.execute(
-                        """
+                        f"""
                         SELECT
                             id, recipients, message
                             FROM stash
-                            WHERE sender=%(sender)s
+                            WHERE {match_sender()}
                         """,
                         {"sender": sender}
                     )
@@ -209,11 +588,11 @@ class HandlerDb:
                         connection.commit()
 
                     cursor.execute(
-                        """
+                        f"""
                         SELECT
                             id, recipients, message
                             FROM stash_static
-                            WHERE sender=%(sender)s
+                            WHERE {match_sender()}
                         """,
                         {"sender": sender}
                     )
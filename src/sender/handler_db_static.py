@@ -5,10 +5,12 @@ from typing import Iterable, Optional, Tuple
 from config import Config
 from psycopg import Cursor
 
-from .typing import Action
+from .handler_db import match_sender
+from .typing import Action, Outbound
 
 from src import services
 from src.db import get_db_pool
+from src.rules import parent_domains
 
 
 logger = logging.getLogger(__name__)
@@ -27,17 +29,19 @@ class HandlerDbStatic:
                 with connection.cursor() as cursor:
                     yield cursor
 
-    def get_action_for_sender(self, sender: str) -> Optional[Tuple[Action, str]]:
+    def get_action_for_sender(self, sender: str, use_primary: bool = False) -> Optional[Tuple[Action, str]]:
         """
         Return any action for the given sender
         """
         for cursor in self._get_cursor():
             cursor.execute(
-                """
+                f"""
                 SELECT
                     action, ref
                     FROM senders_static
-                    WHERE sender=%(sender)s AND type='E'
+                    WHERE {match_sender()} AND type='E'
+                    ORDER BY sender=%(sender)s DESC
+                    LIMIT 1
                 """,
                 {"sender": sender}
             )
@@ -61,6 +65,23 @@ class HandlerDbStatic:
                     refs
                 )
 
+            # Failing that, the most specific domain rule is used
+            cursor.execute(
+                """
+                SELECT
+                    action
+                    FROM senders_static
+                    WHERE sender = ANY(%(domains)s) AND type='D'
+                    ORDER BY length(sender) DESC
+                    LIMIT 1
+                """,
+                {"domains": parent_domains(sender)}
+            )
+            result = cursor.fetchone()
+
+            if result:
+                return (result[0], None)
+
         return ('unknown', None)
 
     def get_patterns(self) -> Iterable[Tuple[str, str, str]]:
@@ -107,21 +128,38 @@ class HandlerDbStatic:
                 return False
 
     def stash_message_for_sender(
-        self, sender: str, msg: str, recipients: list[str]
+        self,
+        sender: str,
+        msg: str,
+        recipients: list[str],
+        outbound: Optional[list[Outbound]] = None,
+        envelope_sender: Optional[str] = None,
     ) -> bool:
         """
-        Stores the message for the sender
+        Stores the message for the sender, and the `envelope_sender` it came
+        from if that is not the sender's key.
+
+        Imported messages never trigger outbound mail, so `outbound` is
+        not supported.
         """
+        if outbound:
+            raise ValueError("Static stashes cannot queue outbound messages")
+
         for cursor in self._get_cursor():
             try:
                 cursor.execute(
                     """
                     INSERT INTO stash_static
-                        (sender, recipients, message)
+                        (sender, envelope_sender, recipients, message)
                         VALUES
-                            (%(sender)s, %(recipients)s, %(message)s)
+                            (%(sender)s, %(envelope_sender)s, %(recipients)s, %(message)s)
                     """,
-                    {"sender": sender, "recipients": json.dumps(recipients), "message": msg}
+                    {
+                        "sender": sender,
+                        "envelope_sender": envelope_sender,
+                        "recipients": json.dumps(recipients),
+                        "message": msg,
+                    }
                 )
                 cursor.connection.commit()
                 return True
@@ -130,6 +168,52 @@ class HandlerDbStatic:
                 print(f"ERROR stashing mail: {e}")
                 return False
 
+    def get_stashed_messages_for_sender(
+        self, sender: str
+    ) -> list[Tuple[Tuple[str, int], list[str], str, str]]:
+        """
+        Returns the stashed messages for the sender without removing them,
+        along with the envelope sender each came from.
+        """
+        for cursor in self._get_cursor():
+            cursor.execute(
+                f"""
+                SELECT
+                    id, recipients, message, COALESCE(envelope_sender, sender)
+                    FROM stash_static
+                    WHERE {match_sender()}
+                    ORDER BY id
+                """,
+                {"sender": sender}
+            )
+
+            return [
+                (("stash_static", row_id), json.loads(recipients), message, envelope_sender)
+                for (row_id, recipients, message, envelope_sender) in cursor.fetchall()
+            ]
+
+        return []
+
+    def remove_stashed_messages_for_sender(self, sender: str, keys: Iterable[Tuple[str, int]]) -> bool:
+        """
+        Removes the given stashed messages for the sender.
+        """
+        for cursor in self._get_cursor():
+            try:
+                cursor.execute(
+                    f"""
+                    DELETE FROM stash_static
+                        WHERE {match_sender()} AND id = ANY(%(ids)s)
+                    """,
+                    {"sender": sender, "ids": [row_id for (_, row_id) in keys]}
+                )
+                cursor.connection.commit()
+                return True
+
+            except Exception as e:
+                print(f"ERROR removing stashed mails: {e}", flush=True)
+                return False
+
     def unstash_messages_for_sender(
         self, sender: str
     ) -> Iterable[Tuple[str, list[str]]]:
@@ -139,11 +223,11 @@ class HandlerDbStatic:
         for cursor in self._get_cursor():
             try:
                 cursor.execute(
-                    """
+                    f"""
                     SELECT
                         id, recipients, message
                         FROM stash_static
-                        WHERE sender=%(sender)s
+                        WHERE {match_sender()}
                     """,
                     {"sender": sender}
                 )
@@ -0,0 +1,79 @@
+import logging
+import re
+from typing import Iterable, Optional
+
+from config import Config
+
+from src import services
+
+logger = logging.getLogger(__name__)
+
+
+class SenderKeys:
+    """
+    Maps envelope senders to the keys that their state is held under, so
+    that the senders that differ only in a per-message tag share a key.
+
+    * `rewrites` are applied to the local part, the first pattern to match
+    the whole of it being replaced, eg to drop a BATV `prvs=<tag>=` prefix
+    * the local part is cut at the first of the `separators` after its first
+    character, eg `+` for `someone+tag@example.com` or the VERP bounce
+    addresses of mailing lists, `list-bounces+someone=example.org@lists.example.com`
+    * the key is lowercased if `lowercase` is set
+
+    With the defaults the key is the address as it is.
+    """
+
+    def __init__(
+        self, lowercase: bool = False, separators: str = "", rewrites: Optional[Iterable[tuple[str, str]]] = None
+    ) -> None:
+        self.lowercase = lowercase
+        self.separators = separators
+        self.rewrites = [(re.compile(pattern, re.IGNORECASE), replace) for (pattern, replace) in rewrites or []]
+
+    def key(self, email: str) -> str:
+        (local_part, at, domain) = email.rpartition("@")
+
+        if not at:
+            (local_part, domain) = (email, "")
+
+        for (pattern, replace) in self.rewrites:
+            match = pattern.fullmatch(local_part)
+
+            if match:
+                local_part = match.expand(replace)
+                break
+
+        for separator in self.separators:
+            position = local_part.find(separator, 1)
+
+            if position > 0:
+                local_part = local_part[:position]
+
+        key = f"{local_part}{at}{domain}"
+
+        if self.lowercase:
+            key = key.lower()
+
+        if key != email:
+            logger.debug("Using the key %(key)s for %(email)s", {"key": key, "email": email})
+
+        return key
+
+
+def make_sender_keys(app_config: Config) -> SenderKeys:
+    return SenderKeys(
+        lowercase=bool(app_config.get("sender_keys.lowercase", False)),
+        separators=app_config.get("sender_keys.separators", ""),
+        rewrites=[(entry["pattern"], entry["replace"]) for entry in app_config.get("sender_keys.rewrites", [])],
+    )
+
+
+sender_keys = SenderKeys()
+
+
+def get_sender_keys() -> SenderKeys:
+    """
+    Returns the sender keys of the current services, if there are any.
+    """
+    return services.get("sender_keys", sender_keys)
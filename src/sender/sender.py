@@ -1,8 +1,10 @@
 import logging
-import re
 from typing import Iterable, Optional
 
-from .typing import Action
+from src.rules import get_matcher
+from src.tracing import span
+
+from .typing import Action, Outbound
 
 
 logger = logging.getLogger(__name__)
@@ -27,10 +29,15 @@ class Sender:
     `reject` or `discard` but a value of `confirm` is possible and effectively
     allows a matching email address to confirm with a specific email, rather than
     waiting for a confirmation request first.
+
+    The sender's state is held under `email`, which is the key for the
+    envelope sender (see `SenderKeys`), while challenges are sent to the
+    `address` it came from.
     """
 
-    def __init__(self, email: str, handler: any) -> None:
+    def __init__(self, email: str, handler: any, address: Optional[str] = None) -> None:
         self.email = email
+        self.address = address or email
         self.references = None
         self.action = None
 
@@ -42,9 +49,12 @@ class Sender:
         """
         return self.email
 
-    def get_action(self) -> Action:
+    def get_action(self, use_primary: bool = False) -> Action:
         """
         Return the action which should be applied to emails from this sender
+
+        If `use_primary` is set then the lookup will not be made against a
+        read replica, for cases where the result must reflect earlier writes.
         """
 
         if self.action:
@@ -54,25 +64,45 @@ class Sender:
             })
             return self.action
 
-        action_data = self.handler.get_action_for_sender(self.email)
+        return self.apply_action_data(self.look_up_action_data(use_primary))
+
+    def look_up_action_data(self, use_primary: bool = False) -> Optional[tuple[Action, any]]:
+        """
+        Look up the action and references for this sender, without updating
+        the sender. Specific entries take precedence over patterns.
+
+        This does not depend on the state of the sender, so the result can
+        be shared between senders with the same email.
+        """
+        with span("sender_handler", {"handler": type(self.handler).__name__, "use_primary": use_primary}):
+            action_data = self.handler.get_action_for_sender(self.email, use_primary=use_primary)
 
-        logger.debug("Action record for %(email)s: %(action)s", {"email": self.email, "action": action_data})
+            logger.debug("Action record for %(email)s: %(action)s", {"email": self.email, "action": action_data})
 
-        if not action_data:
-            patterns = self.handler.get_patterns()
+            if not action_data:
+                patterns = self.handler.get_patterns()
+                matcher = get_matcher()
 
-            for pattern, action, ref in patterns:
-                if re.fullmatch(pattern, self.email, re.IGNORECASE) is not None:
-                    action_data = (action, ref)
-                    logger.debug("Matched pattern for %(email)s: %(action)s", {"email": self.email, "action": action_data})
-                    break
+                for pattern, action, ref in patterns:
+                    if matcher.fullmatch(pattern, self.email):
+                        action_data = (action, ref)
+                        logger.debug("Matched pattern for %(email)s: %(action)s", {"email": self.email, "action": action_data})
+                        break
 
+        return action_data
+
+    def apply_action_data(self, action_data: Optional[tuple[Action, any]]) -> Action:
+        """
+        Update the sender from the result of `look_up_action_data`.
+        """
         if action_data:
             self.action = action_data[0]
+            # The looked up references may be shared, so are copied.
+            refs = list(action_data[1]) if isinstance(action_data[1], list) else action_data[1]
             if self.references is None:
-                self.references = action_data[1]
-            elif action_data[1] is not None:
-                self.references = list(set(self.references).union(action_data[1]))
+                self.references = refs
+            elif refs is not None:
+                self.references = list(set(self.references).union(refs))
             # Existing references are assumed to be good.
         else:
             self.action = "unknown"
@@ -98,11 +128,65 @@ class Sender:
             "action": action,
         })
 
-        self.handler.set_action_for_sender(self.email, action, refs)
+        self._store_action(action, refs)
         self.action = action
 
         return refs
 
+    def _store_action(self, action: Action, refs: Optional[list[str]]) -> None:
+        if hasattr(self.handler, "add_reference_for_sender"):
+            # The references are stored as they are added
+            self.handler.set_action_for_sender(self.email, action)
+        else:
+            self.handler.set_action_for_sender(self.email, action, refs)
+
+    def accept(self, queue_release: bool = False) -> Optional[int]:
+        """
+        Accepts the sender once they have been confirmed, removing their
+        references and, if `queue_release` is set, moving their stashed
+        messages to the outbox.
+
+        Handlers that can do this in a single transaction do so, so a sender
+        is never accepted with their messages left behind.
+
+        Returns the number of messages queued, or None if the sender could
+        not be accepted.
+        """
+        logger.debug("Accepting %(email)s", {"email": self.email})
+
+        if hasattr(self.handler, "accept_sender"):
+            queued = self.handler.accept_sender(self.email, queue_release)
+        else:
+            self.clear_references()
+            self._store_action("accept", None)
+            queued = self.queue_release() if queue_release else 0
+
+        if queued is not None:
+            self.references = None
+            self.action = "accept"
+
+        return queued
+
+    def claim_challenge(self, cooldown: float) -> bool:
+        """
+        Determine whether a challenge should be sent to this sender, given
+        that they should not be challenged more than once in `cooldown`
+        seconds. If so, this is recorded as the time of the last challenge.
+
+        Returns a boolean, true if the challenge should be sent.
+        """
+        if not cooldown or not hasattr(self.handler, "claim_challenge_for_sender"):
+            return True
+
+        claimed = self.handler.claim_challenge_for_sender(self.email, cooldown)
+
+        logger.debug("Challenge claim for %(email)s: %(claimed)s", {
+            "email": self.email,
+            "claimed": claimed,
+        })
+
+        return claimed
+
     def is_never_allowed(self) -> bool:
         return self.handler.is_never_allowed(self.email)
 
@@ -120,7 +204,9 @@ class Sender:
         """
         Add the reference to the set of references for the sender.
 
-        A given reference will only be added to the sender once.
+        A given reference will only be added to the sender once. If the
+        handler can store references individually then the reference is
+        stored immediately.
         """
         if self.references is None:
             logger.debug("Setting reference %(reference)s for %(email)s", {
@@ -139,6 +225,10 @@ class Sender:
                 "email": self.email,
                 "reference": reference
             })
+            return
+
+        if hasattr(self.handler, "add_reference_for_sender"):
+            self.handler.add_reference_for_sender(self.email, reference)
 
     def remove_reference(self, reference: str) -> None:
         """
@@ -173,17 +263,29 @@ class Sender:
         old_refs = self.references
         self.references = None
 
+        if hasattr(self.handler, "clear_references_for_sender"):
+            self.handler.clear_references_for_sender(self.email)
+
         return old_refs
 
-    def stash_message(self, msg: str, recipients: list[str], reference: str = None) -> str:
+    def stash_message(
+        self, msg: str, recipients: list[str], reference: str = None, outbound: Optional[list[Outbound]] = None
+    ) -> str:
         """
         Stashes the email message so that it can be released after confirmation.
 
+        Any `outbound` messages are queued for sending along with the stash.
+
         Returns the reference to be used for the confirmation
         """
         logger.debug("Stashing message for %(email)s", {"email": self.email})
 
-        self.handler.stash_message_for_sender(self.email, msg, recipients)
+        # The message is released from the envelope sender it came from
+        envelope_sender = self.address if self.address != self.email else None
+
+        self.handler.stash_message_for_sender(
+            self.email, msg, recipients, outbound=outbound, envelope_sender=envelope_sender
+        )
 
         if reference:
             self.add_reference(reference)
@@ -205,10 +307,49 @@ class Sender:
 
             yield stash
 
+    def queue_release(self) -> int:
+        """
+        Moves the stashed email messages to the outbox to be sent.
+
+        Returns the number of messages queued.
+        """
+        queued = self.handler.queue_release_for_sender(self.email)
+
+        logger.debug("Queued %(count)d stashed messages for %(email)s", {
+            "email": self.email,
+            "count": queued
+        })
+
+        return queued
+
+    def get_stashed_messages(self) -> list[tuple[any, list[str], str, str]]:
+        """
+        Returns the stashed email messages as a list of tuples of a key, the
+        recipients, the message and the envelope sender it came from.
+
+        Unlike `unstash_messages` the messages are left in the stash, and
+        should be removed with `remove_stashed_messages` once released.
+        """
+        return self.handler.get_stashed_messages_for_sender(self.email)
+
+    def remove_stashed_messages(self, keys: list[any]) -> None:
+        """
+        Removes the stashed messages with the given keys.
+        """
+        if keys:
+            logger.debug("Removing %(count)d stashed messages for %(email)s", {
+                "email": self.email,
+                "count": len(keys)
+            })
+            self.handler.remove_stashed_messages_for_sender(self.email, keys)
+
     def validate_ref(self, ref: str) -> bool:
         """
         Determine if this is a valid reference for this sender
 
         Returns a boolean, true if this is a valid reference.
         """
-        return ref in self.references
+        if hasattr(self.handler, "has_reference_for_sender"):
+            return self.handler.has_reference_for_sender(self.email, ref)
+
+        return ref in (self.references or [])
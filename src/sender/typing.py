@@ -1,3 +1,6 @@
-from typing import Literal, TypeAlias
+from typing import Literal, Optional, TypeAlias
 
 Action: TypeAlias = Literal["unknown", "confirm", "accept", "reject", "discard"]
+
+# An outbound message, as the recipients, the message and the envelope sender.
+Outbound: TypeAlias = tuple[list[str], str, Optional[str]]
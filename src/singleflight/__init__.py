@@ -0,0 +1,5 @@
+from .singleflight import SingleFlight
+
+__all__ = [
+    "SingleFlight"
+]
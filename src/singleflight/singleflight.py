@@ -0,0 +1,74 @@
+import logging
+from typing import Any, Callable, Hashable, Optional
+
+import anyio
+
+logger = logging.getLogger(__name__)
+
+
+class Call:
+    """
+    A lookup that is in progress, which other callers can wait on.
+    """
+
+    def __init__(self) -> None:
+        self.done = anyio.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent lookups with the same key.
+
+    The first caller for a key runs the (blocking) lookup in a worker thread,
+    leaving the event loop free for other sessions. Any callers with the same
+    key that arrive whilst it is running wait for it and share its result,
+    rather than repeating the lookup. Nothing is kept once the lookup
+    completes, so this is not a cache.
+    """
+
+    def __init__(self) -> None:
+        self.in_flight: dict[Hashable, Call] = {}
+        self.lookups = 0
+        self.coalesced = 0
+
+    async def run(self, key: Hashable, func: Callable[..., Any], *args: Any) -> Any:
+        if key in self.in_flight:
+            self.coalesced += 1
+            call = self.in_flight[key]
+
+            logger.debug("Coalescing lookup for %(key)s", {"key": key})
+
+            await call.done.wait()
+
+            if isinstance(call.error, Exception):
+                raise call.error
+            elif call.error:
+                # The first caller was cancelled, which should not affect
+                # this one, so the lookup is tried again.
+                return await self.run(key, func, *args)
+
+            return call.result
+
+        self.lookups += 1
+        call = Call()
+        self.in_flight[key] = call
+
+        try:
+            call.result = await anyio.to_thread.run_sync(func, *args)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            del self.in_flight[key]
+            call.done.set()
+
+        return call.result
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "lookups": self.lookups,
+            "coalesced": self.coalesced,
+            "in_flight": len(self.in_flight),
+        }
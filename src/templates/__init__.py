@@ -0,0 +1,9 @@
+from .templates import Template, TemplateCache, select_template, template_paths, templates
+
+__all__ = [
+    "Template",
+    "TemplateCache",
+    "select_template",
+    "template_paths",
+    "templates",
+]
@@ -0,0 +1,161 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Optional
+
+import chevron
+from chevron.tokenizer import tokenize
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TEMPLATE = "/etc/postconfirm/confirm.email.mustache"
+
+
+class Template:
+    """
+    A template parsed into chevron's tokens, along with the modification
+    time of the file it was parsed from.
+    """
+
+    __slots__ = ("path", "tokens", "mtime_ns", "checked")
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+        with open(path, "r") as template_file:
+            self.mtime_ns = os.fstat(template_file.fileno()).st_mtime_ns
+            self.tokens = list(tokenize(template_file.read()))
+
+        self.checked = time.monotonic()
+
+    def render(self, data: dict[str, Any]) -> str:
+        return chevron.render(self.tokens, data)
+
+
+class TemplateCache:
+    """
+    Parses each template once, and keeps it in memory.
+
+    A cached template is checked against its file at most every
+    `check_interval` seconds, and is parsed again if the file has changed.
+    If the file cannot be read then the cached template is kept, so that a
+    template being replaced does not stop challenges being sent.
+    """
+
+    def __init__(self, check_interval: float = 5) -> None:
+        self.check_interval = check_interval
+        self.templates: dict[str, Template] = {}
+        self.lock = threading.Lock()
+
+    def _is_current(self, template: Template) -> bool:
+        now = time.monotonic()
+
+        if now - template.checked < self.check_interval:
+            return True
+
+        template.checked = now
+
+        try:
+            return os.stat(template.path).st_mtime_ns == template.mtime_ns
+        except OSError as e:
+            logger.warning("Unable to check the template %(path)s, keeping the cached one: %(reason)s", {
+                "path": template.path,
+                "reason": str(e),
+            })
+            return True
+
+    def get(self, path: str) -> Template:
+        template = self.templates.get(path)
+
+        if template is not None and self._is_current(template):
+            return template
+
+        with self.lock:
+            try:
+                loaded = Template(path)
+            except OSError as e:
+                if template is None:
+                    raise
+
+                logger.warning("Unable to reload the template %(path)s, keeping the cached one: %(reason)s", {
+                    "path": path,
+                    "reason": str(e),
+                })
+                return template
+
+            self.templates[path] = loaded
+
+        if template is not None:
+            logger.info("Reloaded the template %(path)s", {"path": path})
+
+        return loaded
+
+    def render(self, path: str, data: dict[str, Any]) -> str:
+        return self.get(path).render(data)
+
+    def clear(self) -> None:
+        self.templates.clear()
+
+
+def _language_tags(language: Optional[str]) -> list[str]:
+    """
+    Returns the language tags to try for a `Content-Language` value, most
+    specific first. eg `fr-CA, en` gives `fr-ca` then `fr`.
+    """
+    if not language:
+        return []
+
+    tag = language.split(",", 1)[0].strip().lower()
+
+    if not tag:
+        return []
+
+    primary = tag.split("-", 1)[0]
+
+    return [tag] if primary == tag else [tag, primary]
+
+
+def select_template(app_config: Config, recipient: str, language: Optional[str] = None) -> str:
+    """
+    Returns the path of the template for a challenge on behalf of the
+    recipient, for a message in the language.
+
+    A variant for the recipient's domain is used first, then one for the
+    language, and otherwise `mail_template`.
+    """
+    variants = app_config.get("mail_template_variants") or {}
+
+    if variants:
+        domain = recipient.rsplit("@", 1)[-1].lower()
+        domains = variants.get("domains") or {}
+
+        if domain in domains:
+            return domains[domain]
+
+        languages = variants.get("languages") or {}
+
+        for tag in _language_tags(language):
+            if tag in languages:
+                return languages[tag]
+
+    return app_config.get("mail_template", DEFAULT_TEMPLATE)
+
+
+def template_paths(app_config: Config) -> list[str]:
+    """
+    Returns the paths of all of the configured templates.
+    """
+    variants = app_config.get("mail_template_variants") or {}
+    paths = [app_config.get("mail_template", DEFAULT_TEMPLATE)]
+
+    for group in ("domains", "languages"):
+        for path in (variants.get(group) or {}).values():
+            if path not in paths:
+                paths.append(path)
+
+    return paths
+
+
+templates = TemplateCache()
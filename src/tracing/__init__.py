@@ -0,0 +1,15 @@
+from .exporters import FileExporter, OTLPExporter, configure_tracing
+from .tracer import Tracer, is_tracing, record_error, set_attributes, span, start_trace, tracer
+
+__all__ = [
+    "FileExporter",
+    "OTLPExporter",
+    "configure_tracing",
+    "Tracer",
+    "is_tracing",
+    "record_error",
+    "set_attributes",
+    "span",
+    "start_trace",
+    "tracer",
+]
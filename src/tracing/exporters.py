@@ -0,0 +1,164 @@
+import json
+import logging
+from typing import Optional
+from urllib.parse import urlsplit
+
+import anyio
+from config import Config
+
+from .tracer import Span, Tracer, tracer as default_tracer
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "postconfirm"
+
+# OpenTelemetry status codes
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+# Internal span kind
+SPAN_KIND_INTERNAL = 1
+
+
+def _attribute_value(value: object) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+
+    if isinstance(value, float):
+        return {"doubleValue": value}
+
+    return {"stringValue": str(value)}
+
+
+def _attributes(attributes: dict) -> list[dict]:
+    return [{"key": key, "value": _attribute_value(value)} for (key, value) in attributes.items()]
+
+
+def otlp_span(span: Span) -> dict:
+    """
+    Returns the span in the OTLP JSON encoding.
+    """
+    encoded = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": SPAN_KIND_INTERNAL,
+        "startTimeUnixNano": str(span.start),
+        "endTimeUnixNano": str(span.end),
+        "attributes": _attributes(span.attributes),
+        "status": {"code": STATUS_ERROR, "message": span.error} if span.error else {"code": STATUS_OK},
+    }
+
+    if span.parent_id:
+        encoded["parentSpanId"] = span.parent_id
+
+    return encoded
+
+
+def otlp_request(spans: list[Span]) -> dict:
+    """
+    Returns the spans as an OTLP trace export request, in its JSON encoding.
+    """
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": _attributes({"service.name": SERVICE_NAME})},
+            "scopeSpans": [{
+                "scope": {"name": SERVICE_NAME},
+                "spans": [otlp_span(span) for span in spans],
+            }],
+        }],
+    }
+
+
+class FileExporter:
+    """
+    Appends each batch of spans to a file, as a line of OTLP JSON. This is
+    the format of the OpenTelemetry collector's file exporter, so the file
+    can be replayed into a collector or read directly.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def _write(self, line: str) -> None:
+        with open(self.path, "a") as trace_file:
+            trace_file.write(line)
+
+    async def export(self, spans: list[Span]) -> None:
+        await anyio.to_thread.run_sync(self._write, json.dumps(otlp_request(spans)) + "\n")
+
+
+class OTLPExporter:
+    """
+    Posts each batch of spans to an OTLP/HTTP collector endpoint, eg
+    `http://localhost:4318/v1/traces`, in the JSON encoding.
+    """
+
+    def __init__(self, endpoint: str, timeout: float = 5) -> None:
+        url = urlsplit(endpoint)
+
+        if url.scheme not in ("http", "https") or not url.hostname:
+            raise ValueError(f"Invalid OTLP endpoint {endpoint}")
+
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == "https" else 80)
+        self.path = url.path or "/v1/traces"
+        self.tls = url.scheme == "https"
+        self.timeout = timeout
+
+    async def export(self, spans: list[Span]) -> None:
+        body = json.dumps(otlp_request(spans)).encode()
+        request = (
+            f"POST {self.path} HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode() + body
+
+        with anyio.fail_after(self.timeout):
+            async with await anyio.connect_tcp(self.host, self.port, tls=self.tls) as stream:
+                await stream.send(request)
+
+                response = b""
+                while b"\r\n" not in response:
+                    response += await stream.receive()
+
+        status_line = response.split(b"\r\n", 1)[0].decode("ascii", "replace")
+        status = status_line.split(" ")[1] if " " in status_line else ""
+
+        if not status.startswith("2"):
+            raise RuntimeError(f"Collector responded with {status_line}")
+
+
+def configure_tracing(app_config: Config, tracer: Tracer = default_tracer) -> Optional[Tracer]:
+    """
+    Sets up tracing from the `tracing` configuration. Returns the tracer if
+    it is enabled, and None otherwise.
+    """
+    endpoint = app_config.get("tracing.otlp_endpoint")
+    path = app_config.get("tracing.file")
+
+    if endpoint:
+        exporter = OTLPExporter(endpoint)
+    elif path:
+        exporter = FileExporter(path)
+    else:
+        return None
+
+    tracer.configure(
+        exporter,
+        sample_rate=float(app_config.get("tracing.sample_rate", 0.01)),
+        flush_interval=float(app_config.get("tracing.flush_interval", 5)),
+        max_queue=int(app_config.get("tracing.max_queue", 2048)),
+    )
+
+    if not tracer.enabled:
+        return None
+
+    logger.info("Tracing %(rate)s of sessions", {"rate": tracer.sample_rate})
+
+    return tracer
@@ -0,0 +1,186 @@
+import logging
+import random
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+import anyio
+
+logger = logging.getLogger(__name__)
+
+# The span that new spans are made children of. Only sampled traces set this,
+# so outside of them starting a span costs a single lookup.
+current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+# Returned in place of a span when the trace is not sampled
+NOT_SAMPLED = nullcontext()
+
+
+class Span:
+    """
+    A timed operation within a trace, with its attributes.
+
+    The times are nanoseconds since the epoch, as in OpenTelemetry.
+    """
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attributes", "start", "end", "error")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Optional[dict]) -> None:
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = dict(attributes) if attributes else {}
+        self.start = time.time_ns()
+        self.end: Optional[int] = None
+        self.error: Optional[str] = None
+
+    def set_attributes(self, attributes: dict) -> None:
+        self.attributes.update(attributes)
+
+    def set_error(self, message: str) -> None:
+        self.error = message
+
+
+class Tracer:
+    """
+    Records sampled traces of milter sessions and hands the finished spans to
+    an exporter.
+
+    The decision to sample is made once, when the trace is started, and the
+    spans within an unsampled trace are never created. Finished spans are
+    queued and exported in batches by `run`, so the sessions never wait on
+    the exporter. If the queue fills then spans are dropped.
+    """
+
+    def __init__(
+        self, exporter=None, sample_rate: float = 0.0, flush_interval: float = 5, max_queue: int = 2048
+    ) -> None:
+        self.configure(exporter, sample_rate, flush_interval, max_queue)
+        self.exported = 0
+        self.dropped = 0
+
+    def configure(
+        self, exporter=None, sample_rate: float = 0.0, flush_interval: float = 5, max_queue: int = 2048
+    ) -> None:
+        self.exporter = exporter
+        self.sample_rate = sample_rate if exporter else 0.0
+        self.flush_interval = flush_interval
+        self.queue: deque[Span] = deque(maxlen=max_queue)
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0
+
+    def _finish(self, span: Span) -> None:
+        span.end = time.time_ns()
+
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+
+        self.queue.append(span)
+
+    @contextmanager
+    def _run_span(self, span: Span) -> Iterator[Span]:
+        token = current_span.set(span)
+
+        try:
+            yield span
+        except BaseException as e:
+            span.set_error(str(e) or type(e).__name__)
+            raise
+        finally:
+            current_span.reset(token)
+            self._finish(span)
+
+    def start_trace(self, name: str, attributes: Optional[dict] = None):
+        """
+        Starts a new trace, if it is sampled, with `name` as its root span.
+        The context manager gives the span, or None if it is not sampled.
+        """
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return NOT_SAMPLED
+
+        return self._run_span(Span(name, f"{random.getrandbits(128):032x}", None, attributes))
+
+    def span(self, name: str, attributes: Optional[dict] = None):
+        """
+        Starts a span within the current trace. The context manager gives
+        the span, or None if there is no sampled trace.
+        """
+        parent = current_span.get()
+
+        if parent is None:
+            return NOT_SAMPLED
+
+        return self._run_span(Span(name, parent.trace_id, parent.span_id, attributes))
+
+    async def flush(self) -> None:
+        spans = []
+
+        while self.queue:
+            spans.append(self.queue.popleft())
+
+        if not spans:
+            return
+
+        try:
+            await self.exporter.export(spans)
+            self.exported += len(spans)
+        except Exception as e:
+            self.dropped += len(spans)
+            logger.warning("Unable to export %(count)s spans: %(reason)s", {"count": len(spans), "reason": str(e)})
+
+    async def run(self) -> None:
+        """
+        Exports the finished spans every `flush_interval` seconds, until
+        cancelled.
+        """
+        try:
+            while True:
+                await anyio.sleep(self.flush_interval)
+                await self.flush()
+        finally:
+            with anyio.CancelScope(shield=True):
+                await self.flush()
+
+
+tracer = Tracer()
+
+
+def start_trace(name: str, attributes: Optional[dict] = None):
+    return tracer.start_trace(name, attributes)
+
+
+def span(name: str, attributes: Optional[dict] = None):
+    return tracer.span(name, attributes)
+
+
+def is_tracing() -> bool:
+    """
+    Returns whether there is a sampled trace, so that attributes which are
+    costly to work out are only worked out if they are used.
+    """
+    return current_span.get() is not None
+
+
+def set_attributes(attributes: dict) -> None:
+    """
+    Sets attributes on the current span, if there is one.
+    """
+    active = current_span.get()
+
+    if active is not None:
+        active.set_attributes(attributes)
+
+
+def record_error(message: str) -> None:
+    """
+    Marks the current span, if there is one, as failed.
+    """
+    active = current_span.get()
+
+    if active is not None:
+        active.set_error(message)
@@ -1,5 +1,6 @@
-from .validator import Validator
+from .validator import SHORT_HASH_LENGTH, Validator
 
 __all__ = [
+    "SHORT_HASH_LENGTH",
     "Validator"
 ]
@@ -2,38 +2,162 @@ import base64
 import hashlib
 import hmac
 import logging
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Iterable, Optional, Union
 
 from config import Config
 
 logger = logging.getLogger(__name__)
 
+# The length of the short hash carried by VERP-style challenge addresses. In
+# lowercase base32 this is 80 bits.
+SHORT_HASH_LENGTH = 16
+
+
+class Key:
+    """
+    A hash key, with the HMAC state for it worked out once so that each hash
+    only has to copy it.
+    """
+
+    __slots__ = ("secret", "since", "hmac")
+
+    def __init__(self, secret: bytes, since: float = float("-inf")) -> None:
+        self.secret = secret
+        self.since = since
+        self.hmac = hmac.new(secret, digestmod=hashlib.sha224)
+
+    def digest(self, message_bytes: bytes) -> bytes:
+        mac = self.hmac.copy()
+        mac.update(message_bytes)
+
+        return mac.digest()
+
+    def hash(self, message_bytes: bytes) -> str:
+        return base64.urlsafe_b64encode(self.digest(message_bytes)).strip(b"=").decode()
+
+    def short_hash(self, message_bytes: bytes) -> str:
+        """
+        Returns a shortened hash that is not case sensitive, for use where
+        the case may not be kept, eg in the local part of an address.
+        """
+        return base64.b32encode(self.digest(message_bytes)).decode().lower()[:SHORT_HASH_LENGTH]
+
+
+def _parse_since(since: Any) -> float:
+    """
+    Returns a key's `since` as a timestamp. It can be given as a timestamp,
+    or as an ISO 8601 date or time which is taken to be UTC unless it says
+    otherwise.
+    """
+    if since is None or since == "":
+        return float("-inf")
+
+    if isinstance(since, (int, float)):
+        return float(since)
+
+    when = datetime.fromisoformat(str(since))
+
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+
+    return when.timestamp()
+
 
 class Validator:
     """
     Provides validation services for dealing with the confirmation token
+
+    The hash key is read from `key_file`. This can instead be a keyring, a
+    list of keys each with a `file` and the time it is used from as `since`,
+    so that the key can be rotated without invalidating the challenges
+    already sent. Tokens are signed with the newest key in use, and a key
+    that has been replaced is still accepted for `key_grace_period` seconds.
     """
     def __init__(self, app_config: Config):
         self.hash_key = bytes()
+        self.keys: list[Key] = []
+        self.grace_period = 0.0
 
-        hash_key_filename = app_config.get("key_file")
+        key_file = app_config.get("key_file")
 
-        if not hash_key_filename:
+        if not key_file:
             logger.error("A hash key filename must be provided as 'key_file'")
-            return
+        elif isinstance(key_file, list):
+            self.grace_period = float(app_config.get("key_grace_period", 86400))
+            self.keys = [key for key in (self._load_key(entry) for entry in key_file) if key]
+        else:
+            key = self._load_key(key_file)
+            self.keys = [key] if key else []
+
+        # The newest key is first
+        self.keys.sort(key=lambda key: key.since, reverse=True)
+
+        if not self.keys:
+            self.keys = [Key(self.hash_key)]
+
+        self.hash_key = self.signing_key().secret
+
+    def _load_key(self, entry: Union[str, dict]) -> Optional[Key]:
+        if isinstance(entry, str):
+            entry = {"file": entry}
+
+        hash_key_filename = entry.get("file")
 
         try:
             with open(hash_key_filename, "rb") as f:
-                self.hash_key = f.read()
-        except (FileNotFoundError, PermissionError) as e:
+                return Key(f.read(), _parse_since(entry.get("since")))
+        except (FileNotFoundError, PermissionError, TypeError) as e:
             logger.error("The hash key file %(filename)s could not be opened: %(reason)s", {
                 "filename": hash_key_filename,
                 "reason": str(e)
             })
-            return
+        except ValueError as e:
+            logger.error("The hash key file %(filename)s has an invalid since: %(reason)s", {
+                "filename": hash_key_filename,
+                "reason": str(e)
+            })
+
+        return None
+
+    def signing_key(self, now: Optional[float] = None) -> Key:
+        """
+        Returns the newest key that is in use.
+        """
+        now = time.time() if now is None else now
+
+        for key in self.keys:
+            if key.since <= now:
+                return key
+
+        return self.keys[-1]
+
+    def accepted_keys(self, now: Optional[float] = None) -> list[Key]:
+        """
+        Returns the keys that tokens are accepted for: any not yet in use, the
+        signing key, and those replaced within the grace period.
+        """
+        if len(self.keys) == 1:
+            return self.keys
+
+        now = time.time() if now is None else now
+        accepted = []
+        successor = None
+
+        for key in self.keys:
+            if key.since > now or successor is None or now - successor.since <= self.grace_period:
+                accepted.append(key)
+            else:
+                break
+
+            if key.since <= now:
+                successor = key
+
+        return accepted
 
     def hash(self, message_bytes: bytes) -> str:
-        digest = hmac.new(self.hash_key, message_bytes, hashlib.sha224).digest()
-        return base64.urlsafe_b64encode(digest).strip(b"=").decode()
+        return self.signing_key().hash(message_bytes)
 
     def make_hash(self, sender: str, recipient: str, reference: str):
         hashable = f"{sender}-{recipient}-{reference}"
@@ -41,21 +165,59 @@ class Validator:
         return self.hash(hashable.encode())
 
     def validate_hash(self, sender: str, recipient: str, reference: str, hash: str) -> bool:
-        return self.make_hash(sender, recipient, reference) == hash
-
-    def validate_token(self, sender: str, token: str, references: list[str]) -> bool:
+        message_bytes = f"{sender}-{recipient}-{reference}".encode()
+        hash_bytes = hash.encode()
+
+        return any(
+            hmac.compare_digest(key.hash(message_bytes).encode(), hash_bytes) for key in self.accepted_keys()
+        )
+
+    def validate_token(
+        self, sender: str, token: str, references: Union[Iterable[str], Callable[[str], bool]]
+    ) -> bool:
+        """
+        Validates the token for the sender.
+
+        The references can either be the list of valid references or a
+        callable that checks whether a single reference is valid.
+        """
         try:
             (recipient, reference, hash) = token.strip().split(":")
         except ValueError:
             return False
 
-        for reference_entry in references:
-            if reference_entry == reference:
-                return self.validate_hash(sender, recipient, reference_entry, hash)
+        if callable(references):
+            is_reference = references(reference)
+        else:
+            is_reference = reference in (references or [])
 
-        return False
+        if not is_reference:
+            return False
+
+        return self.validate_hash(sender, recipient, reference, hash)
 
     def get_token(self, sender: str, recipient: str, reference: str) -> str:
         hash_str = self.make_hash(sender, recipient, reference)
 
         return f"{recipient}:{reference}:{hash_str}"
+
+    def make_short_hash(self, sender: str, reference: str) -> str:
+        """
+        Returns the short hash for the sender and the reference. This is
+        validated against the sender's references, so does not need to carry
+        them.
+        """
+        return self.signing_key().short_hash(f"short-{sender}-{reference}".encode())
+
+    def validate_short_hash(self, sender: str, hash: str, references: Iterable[str]) -> bool:
+        """
+        Validates a short hash for the sender against each of their
+        references.
+        """
+        hash_bytes = hash.lower().encode()
+
+        return any(
+            hmac.compare_digest(key.short_hash(f"short-{sender}-{reference}".encode()).encode(), hash_bytes)
+            for reference in references or []
+            for key in self.accepted_keys()
+        )
@@ -10,3 +10,13 @@ class MockChallengeHandler:
 
     def get_patterns(self):
         return self.patterns
+
+
+class MockBatchChallengeHandler(MockChallengeHandler):
+    def __init__(self, actions=None, patterns=None):
+        super().__init__(actions, patterns)
+        self.get_actions_calls = 0
+
+    def get_actions(self, emails):
+        self.get_actions_calls += 1
+        return {email: self.actions[email] for email in emails if email in self.actions}
@@ -4,15 +4,17 @@ defined_sender = "specific@example.com"
 class MockHandler:
     def __init__(self):
         self.actions = {defined_sender: ("accept", None)}
+        self.outbox = []
+        self.challenged = set()
 
         self.stash = {
             defined_sender: [
-                ("a message", ["a@b.c", "d@e.f"]),
-                ("a message", ["a@b.c", "d@e.f"]),
+                ("a message", ["a@b.c", "d@e.f"], defined_sender),
+                ("a message", ["a@b.c", "d@e.f"], defined_sender),
             ]
         }
 
-    def get_action_for_sender(self, sender: str):
+    def get_action_for_sender(self, sender: str, use_primary: bool = False):
         if sender in self.actions:
             return self.actions[sender]
         else:
@@ -26,17 +28,44 @@ class MockHandler:
             ]
         )
 
-    def set_action_for_sender(self, sender: str, action: str, ref: str):
+    def is_never_allowed(self, sender: str):
+        return False
+
+    def set_action_for_sender(self, sender: str, action: str, ref: str = None):
         self.actions[sender] = (action, ref)
 
-    def stash_message_for_sender(self, sender: str, msg: str, recipients: list[str]):
-        data = (msg, recipients)
+    def stash_message_for_sender(self, sender: str, msg: str, recipients: list[str], outbound=None, envelope_sender=None):
+        data = (msg, recipients, envelope_sender or sender)
 
         if sender in self.stash:
             self.stash[sender].append(data)
         else:
             self.stash[sender] = [data]
 
+        if outbound:
+            self.outbox.extend(outbound)
+
+    def queue_release_for_sender(self, sender: str):
+        released = self.stash.pop(sender, [])
+        self.outbox.extend((recipients, msg, envelope_sender) for (msg, recipients, envelope_sender) in released)
+        return len(released)
+
+    def get_stashed_messages_for_sender(self, sender: str):
+        return [
+            (index, recipients, msg, envelope_sender)
+            for index, (msg, recipients, envelope_sender) in enumerate(self.stash.get(sender, []))
+        ]
+
+    def remove_stashed_messages_for_sender(self, sender: str, keys):
+        self.stash[sender] = [data for index, data in enumerate(self.stash.get(sender, [])) if index not in keys]
+
+    def claim_challenge_for_sender(self, sender: str, cooldown: float):
+        if sender in self.challenged:
+            return False
+
+        self.challenged.add(sender)
+        return True
+
     def unstash_messages_for_sender(self, sender: str):
         if sender in self.stash:
             emails = self.stash[sender]
@@ -46,3 +75,18 @@ class MockHandler:
 
         for index, data in enumerate(emails):
             yield (index, *data)
+
+
+class MockReferenceHandler(MockHandler):
+    def __init__(self):
+        super().__init__()
+        self.refs = {}
+
+    def add_reference_for_sender(self, sender: str, ref: str):
+        self.refs.setdefault(sender, []).append(ref)
+
+    def has_reference_for_sender(self, sender: str, ref: str):
+        return ref in self.refs.get(sender, [])
+
+    def clear_references_for_sender(self, sender: str):
+        self.refs.pop(sender, None)
@@ -1,5 +1,8 @@
-from src.challenge.challenge import Challenge
-from tests.mocks.challenge_handler import MockChallengeHandler
+from unittest.mock import patch
+
+from src.challenge.challenge import Challenge, look_up_challenges
+from src.challenge.handler_query import HandlerQuery
+from tests.mocks.challenge_handler import MockBatchChallengeHandler, MockChallengeHandler
 
 
 class TestChallengeDefaults:
@@ -61,3 +64,51 @@ class TestChallengeHydration:
         challenge.get_action()
         challenge.get_action()
         assert handler.get_action_calls == 2
+
+
+class TestLookUpChallenges:
+    def test_batch_handler_looked_up_once(self):
+        handler = MockBatchChallengeHandler(actions={"a@example.com": "challenge"})
+        challenges = look_up_challenges(["a@example.com", "b@example.com"], [handler])
+        assert [c.get_action() for c in challenges] == ["challenge", "unknown"]
+        assert handler.get_actions_calls == 1
+        assert handler.get_action_calls == 0
+
+    def test_falls_back_to_single_lookups(self):
+        handler = MockChallengeHandler(actions={"a@example.com": "challenge"})
+        challenges = look_up_challenges(["a@example.com", "b@example.com"], [handler])
+        assert [c.get_action() for c in challenges] == ["challenge", "unknown"]
+        assert handler.get_action_calls == 2
+
+    def test_duplicate_emails_looked_up_once(self):
+        handler = MockChallengeHandler(actions={"a@example.com": "challenge"})
+        challenges = look_up_challenges(["a@example.com", "a@example.com"], [handler])
+        assert [c.get_action() for c in challenges] == ["challenge", "challenge"]
+        assert handler.get_action_calls == 1
+
+    def test_patterns_used_when_no_exact_match(self):
+        handler = MockBatchChallengeHandler(patterns=[(r".*@example\.com", "challenge")])
+        challenges = look_up_challenges(["a@example.com", "b@example.org"], [handler])
+        assert [c.get_action() for c in challenges] == ["challenge", "unknown"]
+
+    def test_ignore_beats_challenge(self):
+        h1 = MockBatchChallengeHandler(actions={"a@example.com": "challenge"})
+        h2 = MockChallengeHandler(actions={"a@example.com": "ignore"})
+        challenges = look_up_challenges(["a@example.com"], [h1, h2])
+        assert challenges[0].get_action() == "ignore"
+
+
+class TestHandlerQueryBatch:
+    @patch("src.challenge.handler_query.get_db_pool")
+    def test_results_matched_ignoring_case(self, mock_get_db_pool):
+        cursor = mock_get_db_pool.return_value.connection.return_value.__enter__.return_value \
+            .cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = [
+            ("list", "example.com", "confirm"),
+            ("someone", "example.org", "reject"),
+        ]
+        handler = HandlerQuery({"name": "query", "db": {}, "batch_action_query": "SELECT"})
+
+        actions = handler.get_actions(["List@Example.COM", "someone@example.org", "other@example.net"])
+
+        assert actions == {"List@Example.COM": "confirm", "someone@example.org": "reject"}
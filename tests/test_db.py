@@ -0,0 +1,149 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from src.db import db
+from src.db.db import get_db_pool
+
+
+def _make_pool(lag=None):
+    pool = MagicMock()
+    cursor = pool.connection.return_value.__enter__.return_value.cursor.return_value.__enter__.return_value
+    cursor.fetchone.return_value = (lag,)
+    return pool
+
+
+@pytest.fixture(autouse=True)
+def _clear_caches():
+    db.pool_cache.clear()
+    db.replica_cache.clear()
+    yield
+    db.pool_cache.clear()
+    db.replica_cache.clear()
+
+
+class TestGetDbPool:
+    @patch("src.db.db.ConnectionPool")
+    def test_pool_is_cached(self, mock_pool_cls):
+        pool = get_db_pool({}, "db")
+        assert get_db_pool({}, "db") is pool
+        assert mock_pool_cls.call_count == 1
+
+    @patch("src.db.db.ConnectionPool")
+    def test_read_only_without_replicas_uses_primary(self, mock_pool_cls):
+        primary = get_db_pool({}, "db")
+        assert get_db_pool({}, "db", read_only=True) is primary
+
+    @patch("src.db.db.ConnectionPool")
+    def test_pool_that_cannot_open_is_closed(self, mock_pool_cls):
+        pool = mock_pool_cls.return_value
+        pool.open.side_effect = Exception("timed out")
+
+        with pytest.raises(Exception, match="timed out"):
+            db._make_pool({}, timeout=2)
+
+        pool.open.assert_called_once_with(wait=True, timeout=2)
+        pool.close.assert_called_once()
+
+
+class TestReplicas:
+    @patch("src.db.db._make_pool")
+    def test_replica_inherits_primary_settings(self, mock_make_pool):
+        config = {"name": "pc", "user": "pc", "host": "primary", "replicas": [{"host": "replica"}]}
+        get_db_pool(config, "db", read_only=True)
+        mock_make_pool.assert_called_once_with({"name": "pc", "user": "pc", "host": "replica"}, db.REPLICA_OPEN_TIMEOUT)
+
+    @patch("src.db.db._make_pool")
+    def test_writes_use_primary(self, mock_make_pool):
+        primary, replica = _make_pool(), _make_pool()
+        mock_make_pool.side_effect = [replica, primary]
+        config = {"replicas": [{"host": "replica"}]}
+        assert get_db_pool(config, "db", read_only=True) is replica
+        assert get_db_pool(config, "db") is primary
+
+    @patch("src.db.db._make_pool")
+    def test_replicas_are_round_robin(self, mock_make_pool):
+        first, second = _make_pool(), _make_pool()
+        mock_make_pool.side_effect = [first, second]
+        config = {"replicas": [{"host": "r1"}, {"host": "r2"}]}
+        pools = {id(get_db_pool(config, "db", read_only=True)) for _ in range(4)}
+        assert pools == {id(first), id(second)}
+
+    @patch("src.db.db._make_pool")
+    def test_lagging_replica_falls_back_to_primary(self, mock_make_pool):
+        replica, primary = _make_pool(lag=30), _make_pool()
+        mock_make_pool.side_effect = [replica, primary]
+        config = {"replicas": [{"host": "replica"}], "max_replica_lag": 5}
+        assert get_db_pool(config, "db", read_only=True) is primary
+
+    @patch("src.db.db._make_pool")
+    def test_replica_within_lag_is_used(self, mock_make_pool):
+        replica = _make_pool(lag=1)
+        mock_make_pool.side_effect = [replica]
+        config = {"replicas": [{"host": "replica"}], "max_replica_lag": 5}
+        assert get_db_pool(config, "db", read_only=True) is replica
+
+    @patch("src.db.db._make_pool")
+    def test_unknown_lag_falls_back_to_primary(self, mock_make_pool):
+        replica, primary = _make_pool(), _make_pool()
+        replica.connection.side_effect = Exception("connection refused")
+        mock_make_pool.side_effect = [replica, primary]
+        config = {"replicas": [{"host": "replica"}], "max_replica_lag": 5}
+        assert get_db_pool(config, "db", read_only=True) is primary
+
+    @patch("src.db.db._make_pool")
+    def test_lag_is_only_checked_periodically(self, mock_make_pool):
+        replica = _make_pool(lag=1)
+        mock_make_pool.side_effect = [replica]
+        config = {"replicas": [{"host": "replica"}], "max_replica_lag": 5}
+        get_db_pool(config, "db", read_only=True)
+        get_db_pool(config, "db", read_only=True)
+        assert replica.connection.call_count == 1
+
+    @patch("src.db.db._make_pool")
+    def test_replica_that_cannot_open_falls_back_to_primary(self, mock_make_pool):
+        primary = _make_pool()
+        mock_make_pool.side_effect = [Exception("connection refused"), primary]
+        config = {"replicas": [{"host": "replica"}]}
+        assert get_db_pool(config, "db", read_only=True) is primary
+        # Not tried again until the retry interval has passed
+        assert get_db_pool(config, "db", read_only=True) is primary
+        assert mock_make_pool.call_count == 2
+
+    @patch("src.db.db._make_pool")
+    def test_replica_is_retried(self, mock_make_pool):
+        primary, replica = _make_pool(), _make_pool()
+        mock_make_pool.side_effect = [Exception("connection refused"), primary, replica]
+        config = {"replicas": [{"host": "replica"}], "replica_retry_interval": 0}
+        assert get_db_pool(config, "db", read_only=True) is primary
+        assert get_db_pool(config, "db", read_only=True) is replica
+
+    @patch("src.db.db._make_pool")
+    def test_replica_being_opened_is_skipped(self, mock_make_pool):
+        primary, replica = _make_pool(), _make_pool()
+        config = {"replicas": [{"host": "replica"}], "replica_open_timeout": 2}
+        results = []
+
+        def open_replica(config_fragment, timeout=db.OPEN_TIMEOUT):
+            if config_fragment.get("host") != "replica":
+                return primary
+
+            # Another lookup while the replica is opening uses the primary
+            # rather than waiting on the lock.
+            results.append(get_db_pool(config, "db", read_only=True))
+            return replica
+
+        mock_make_pool.side_effect = open_replica
+
+        assert get_db_pool(config, "db", read_only=True) is replica
+        assert results == [primary]
+        assert mock_make_pool.call_args_list[0].args == ({"host": "replica"}, 2)
+
+    @patch("src.db.db._make_pool")
+    def test_get_pools(self, mock_make_pool):
+        primary, replica = _make_pool(), _make_pool()
+        mock_make_pool.side_effect = [Exception("connection refused"), replica, primary]
+        config = {"replicas": [{"host": "down"}, {"host": "up"}]}
+        get_db_pool(config, "db", read_only=True)
+        get_db_pool(config, "db")
+        assert db.get_pools() == {"db": primary, "db:up": replica}
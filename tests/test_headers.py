@@ -0,0 +1,71 @@
+import pytest
+
+from src import services
+from src.milter.headers import MessageHeaders
+from src.milter.processor import extract_reference, header_drop_matchers, message_should_be_dropped
+
+
+class TestMessageHeaders:
+    def test_only_inspected_headers_are_decoded(self):
+        headers = MessageHeaders()
+        headers.add("Subject", b" hello")
+        headers.add("Received", b" from somewhere")
+
+        assert headers.get("subject") == " hello"
+        assert headers.get("Received") is None
+        assert headers.values == {"subject": [" hello"]}
+
+    def test_lookup_is_case_insensitive(self):
+        headers = MessageHeaders.from_list([("message-ID", "<abc@example.com>")])
+        assert headers.get("Message-Id") == "<abc@example.com>"
+
+    def test_all_headers_kept_in_order(self):
+        pairs = [("Received", " one"), ("Subject", " hi"), ("X-Other", " two")]
+        headers = MessageHeaders.from_list(pairs)
+
+        assert list(headers) == pairs
+        assert len(headers) == 3
+
+    def test_add(self):
+        headers = MessageHeaders()
+        headers.add("Subject", b"hello")
+        assert headers.get_subject() == "hello"
+        assert list(headers) == [("Subject", "hello")]
+
+    def test_encoded_subject_is_decoded(self):
+        headers = MessageHeaders.from_list([("Subject", " =?utf-8?q?caf=C3=A9?=")])
+        assert headers.get_subject() == "café"
+
+    def test_missing_subject(self):
+        assert MessageHeaders().get_subject() == ""
+
+    def test_repeated_headers(self):
+        headers = MessageHeaders.from_list([("Precedence", "normal"), ("Precedence", "bulk")])
+        assert headers.get("precedence") == "normal"
+        assert headers.get_all("precedence") == ["normal", "bulk"]
+
+
+class TestInspectedLookups:
+    @pytest.fixture(autouse=True)
+    def _setup_config(self):
+        header_drop_matchers.clear()
+        services["app_config"] = {}
+        yield
+        header_drop_matchers.clear()
+        del services["app_config"]
+
+    def test_dropped(self):
+        headers = MessageHeaders.from_list([("Received", " x"), ("Precedence", " bulk")])
+        assert message_should_be_dropped(headers) is True
+
+    def test_repeated_header_dropped(self):
+        headers = MessageHeaders.from_list([("Precedence", " normal"), ("Auto-Submitted", " auto-generated")])
+        assert message_should_be_dropped(headers) is True
+
+    def test_not_dropped(self):
+        headers = MessageHeaders.from_list([("Subject", " hi"), ("Precedence", " normal")])
+        assert message_should_be_dropped(headers) is False
+
+    def test_reference(self):
+        headers = MessageHeaders.from_list([("Message-ID", "<ab:cd@example.com>")])
+        assert extract_reference(headers) == "abcd"
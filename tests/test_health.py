@@ -0,0 +1,128 @@
+import time
+from unittest.mock import MagicMock, patch
+
+import anyio
+import pytest
+
+from src.metrics import Registry
+from src.metrics.health import HealthMonitor
+from src.milter.processor import sessions_in_flight
+
+
+def make_monitor(**config):
+    return HealthMonitor(config, Registry())
+
+
+@pytest.fixture(autouse=True)
+def _no_pools():
+    with patch("src.metrics.health.db") as mock_db:
+        mock_db.get_pools.return_value = {}
+        yield mock_db
+
+
+class TestLiveness:
+    def test_alive(self):
+        assert make_monitor().liveness() == []
+
+    def test_loop_lag(self):
+        monitor = make_monitor(**{"health.max_loop_lag": 1})
+        monitor.loop_lag = 2
+
+        assert monitor.liveness() == ["event loop lag of 2.000s"]
+
+    def test_stalled_heartbeat(self):
+        monitor = make_monitor(**{"health.max_loop_lag": 1, "health.loop_interval": 1})
+        monitor.last_beat = time.monotonic() - 5
+
+        assert monitor.liveness()
+
+    @pytest.mark.asyncio
+    async def test_heartbeat(self):
+        monitor = make_monitor(**{"health.loop_interval": 0.01})
+        monitor.last_beat = 0
+
+        with anyio.move_on_after(0.05):
+            await monitor.watch_loop()
+
+        assert monitor.last_beat > 0
+        assert monitor.liveness() == []
+
+
+class TestReadiness:
+    def test_ready(self):
+        assert make_monitor().readiness() == []
+
+    def test_starting(self):
+        monitor = make_monitor()
+        monitor.starting = True
+
+        assert monitor.readiness() == ["starting"]
+
+    def test_sessions_in_flight(self):
+        monitor = make_monitor(**{"health.max_sessions": "2"})
+
+        sessions_in_flight.inc(2)
+        try:
+            assert monitor.readiness() == ["2 sessions in flight"]
+        finally:
+            sessions_in_flight.dec(2)
+
+        assert monitor.readiness() == []
+
+    def test_db_pool_waiting(self, _no_pools):
+        _no_pools.get_pools.return_value = {"default": MagicMock(get_stats=lambda: {"requests_waiting": 3})}
+
+        assert make_monitor().readiness() == []
+        assert make_monitor(**{"health.max_db_waiting": 2}).readiness() == [
+            "3 lookups waiting for the default database"
+        ]
+
+    def test_replica_pool_waiting(self, _no_pools):
+        _no_pools.get_pools.return_value = {
+            "default": MagicMock(get_stats=lambda: {"requests_waiting": 0}),
+            "default:replica1": MagicMock(get_stats=lambda: {"requests_waiting": 6}),
+        }
+
+        assert make_monitor().readiness() == ["6 lookups waiting for the default:replica1 database"]
+
+    def test_smtp_unreachable(self):
+        monitor = make_monitor(smtp_host="mail", smtp_port=25)
+        monitor.smtp_reachable = False
+
+        assert monitor.readiness() == ["SMTP server mail:25 unreachable"]
+
+    def test_ready_gauge(self):
+        registry = Registry()
+        monitor = HealthMonitor({}, registry)
+
+        assert "postconfirm_ready 1" in registry.render()
+
+        monitor.smtp_reachable = False
+
+        assert "postconfirm_ready 0" in registry.render()
+
+    @pytest.mark.asyncio
+    async def test_smtp_check(self):
+        listener = await anyio.create_tcp_listener(local_host="127.0.0.1")
+        port = listener.extra(anyio.abc.SocketAttribute.local_port)
+
+        assert await make_monitor(smtp_host="127.0.0.1", smtp_port=port).check_smtp()
+
+        await listener.aclose()
+
+        assert not await make_monitor(smtp_host="127.0.0.1", smtp_port=port).check_smtp()
+
+
+class TestRoutes:
+    @pytest.mark.asyncio
+    async def test_routes(self):
+        monitor = make_monitor()
+        routes = monitor.routes()
+
+        assert await routes["/healthz"]() == (200, "text/plain", "ok\n")
+        assert await routes["/readyz"]() == (200, "text/plain", "ok\n")
+
+        monitor.smtp_reachable = False
+
+        assert await routes["/healthz"]() == (200, "text/plain", "ok\n")
+        assert (await routes["/readyz"]())[0] == 503
@@ -0,0 +1,188 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import anyio
+import pytest
+
+from src import Generation, Services, services as default_services
+from src.lifecycle import Lifecycle, build_services
+from src.milter.listener import create_unix_socket_listener
+from src.milter.processor import message_should_be_dropped
+from src.outbox import Outbox
+from src.sender import get_default_handler
+
+
+def make_generation(name):
+    return Generation(name=name, outbox=MagicMock(enabled=False, workers=0), remailer=MagicMock(close=AsyncMock()))
+
+
+def make_lifecycle(services, **config):
+    return Lifecycle("/etc/postconfirm.cfg", config, services)
+
+
+class TestServices:
+    def test_pinned_generation_kept(self):
+        services = Services()
+        services.swap(make_generation("first"))
+
+        with services.pin() as pinned:
+            services.swap(make_generation("second"))
+
+            assert services["name"] == "first"
+            assert pinned.sessions == 1
+
+        assert services["name"] == "second"
+        assert pinned.sessions == 0
+
+    def test_pin_given_generation(self):
+        services = Services()
+        services.swap(make_generation("first"))
+        second = make_generation("second")
+
+        with services.pin(second):
+            assert services["name"] == "second"
+            assert second.sessions == 1
+
+        assert services["name"] == "first"
+
+    def test_mapping(self):
+        services = Services()
+        services["app_config"] = {}
+
+        assert dict(services) == {"app_config": {}}
+        assert services.get("remailer") is None
+
+        del services["app_config"]
+
+        assert len(services) == 0
+
+    def test_build_services(self, tmp_path):
+        key_file = tmp_path / "key"
+        key_file.write_bytes(b"secret")
+
+        generation = build_services({"key_file": str(key_file)})
+
+        assert generation["validator"].hash_key == b"secret"
+        assert generation["app_config"] == {"key_file": str(key_file)}
+        assert len(generation["challenge_handlers"]) == 1
+
+    def test_caches_kept_per_generation(self, tmp_path):
+        key_file = tmp_path / "key"
+        key_file.write_bytes(b"secret")
+        (first, second) = (build_services({"key_file": str(key_file)}), build_services({"key_file": str(key_file)}))
+
+        for generation in (first, second):
+            with default_services.pin(generation):
+                get_default_handler()
+                message_should_be_dropped([])
+
+        assert first["sender_handlers"]["db"] is not second["sender_handlers"]["db"]
+        assert first["sender_handlers"]["db"].app_config is first["app_config"]
+        assert set(first["header_drop_matchers"]) == {"Precedence", "Auto-Submitted"}
+        assert second["header_drop_matchers"] is not first["header_drop_matchers"]
+
+
+class TestReload:
+    @pytest.mark.asyncio
+    async def test_reload_after_sessions(self):
+        services = Services()
+        first = make_generation("first")
+        services.swap(first)
+        lifecycle = make_lifecycle(services)
+
+        with patch("src.lifecycle.lifecycle.build_services", return_value=make_generation("second")), \
+                patch("src.lifecycle.lifecycle.run_warm_up", new_callable=AsyncMock) as run_warm_up:
+            with patch.object(lifecycle, "load_config", return_value={}):
+                async with anyio.create_task_group() as tasks:
+                    lifecycle.tasks = tasks
+
+                    with services.pin():
+                        assert await lifecycle.reload()
+                        await anyio.sleep(0.1)
+
+                        assert services["name"] == "first"
+                        first["remailer"].close.assert_not_awaited()
+
+                    assert services["name"] == "second"
+
+                    with anyio.fail_after(2):
+                        while not first["remailer"].close.await_count:
+                            await anyio.sleep(0.05)
+
+                    tasks.cancel_scope.cancel()
+
+        first["outbox"].stop.assert_called_once()
+        run_warm_up.assert_awaited_once()
+
+    @pytest.mark.asyncio
+    async def test_failed_reload_keeps_services(self):
+        services = Services()
+        services.swap(make_generation("first"))
+        lifecycle = make_lifecycle(services)
+
+        with patch.object(lifecycle, "load_config", side_effect=ValueError("bad config")):
+            assert not await lifecycle.reload()
+
+        assert services["name"] == "first"
+
+
+class TestDrain:
+    async def serve(self, lifecycle, path, session_time):
+        started = anyio.Event()
+        finished = []
+
+        async def handler(stream):
+            async with stream:
+                started.set()
+                await anyio.sleep(session_time)
+                finished.append(True)
+
+        listener = await create_unix_socket_listener(path)
+
+        with anyio.fail_after(5):
+            async with anyio.create_task_group() as tasks:
+                tasks.start_soon(lifecycle.serve, listener, handler)
+
+                async with await anyio.connect_unix(path):
+                    await started.wait()
+                    lifecycle.drain()
+
+                    # No further connections are accepted
+                    await anyio.sleep(0.05)
+                    with pytest.raises(OSError):
+                        await anyio.connect_unix(path)
+
+        return finished
+
+    @pytest.mark.asyncio
+    async def test_sessions_finish(self, tmp_path):
+        services = Services()
+        services.swap(make_generation("first"))
+        on_drain = MagicMock()
+        lifecycle = make_lifecycle(services)
+        lifecycle.on_drain = on_drain
+
+        assert await self.serve(lifecycle, str(tmp_path / "milter.sock"), 0.2) == [True]
+
+        on_drain.assert_called_once()
+        services["remailer"].close.assert_awaited_once()
+
+    @pytest.mark.asyncio
+    async def test_drain_timeout(self, tmp_path):
+        services = Services()
+        services.swap(make_generation("first"))
+        lifecycle = make_lifecycle(services, **{"shutdown.drain_timeout": 0.1})
+
+        assert await self.serve(lifecycle, str(tmp_path / "milter.sock"), 10) == []
+
+
+class TestOutboxStop:
+    @pytest.mark.asyncio
+    async def test_workers_stop(self):
+        outbox = Outbox({"outbox": {"enabled": True, "workers": 2, "poll_interval": 10}})
+
+        with patch.object(outbox, "process_batch", new_callable=AsyncMock, return_value=0):
+            with anyio.fail_after(2):
+                async with anyio.create_task_group() as tasks:
+                    tasks.start_soon(outbox.run, MagicMock())
+                    await anyio.sleep(0.05)
+                    outbox.stop()
@@ -0,0 +1,140 @@
+import time
+
+import anyio
+import pytest
+
+from src.remailer.limiter import DestinationLimiter, TokenBucket
+
+
+class TestTokenBucket:
+    @pytest.mark.asyncio
+    async def test_burst_is_immediate(self):
+        bucket = TokenBucket(rate=1, burst=5)
+        start = time.monotonic()
+        for _ in range(5):
+            await bucket.acquire()
+        assert time.monotonic() - start < 0.1
+
+    @pytest.mark.asyncio
+    async def test_rate_is_enforced(self):
+        bucket = TokenBucket(rate=20, burst=1)
+        start = time.monotonic()
+        for _ in range(3):
+            await bucket.acquire()
+        assert time.monotonic() - start >= 0.09
+
+
+class TestDestinationLimiter:
+    @pytest.mark.asyncio
+    async def test_domain_concurrency_is_capped(self):
+        limiter = DestinationLimiter({"default": {"concurrency": 2}})
+        active = 0
+        peak = 0
+
+        async def send():
+            nonlocal active, peak
+            async with limiter.limit(["user@example.com"]):
+                active += 1
+                peak = max(peak, active)
+                await anyio.sleep(0.01)
+                active -= 1
+
+        async with anyio.create_task_group() as tasks:
+            for _ in range(6):
+                tasks.start_soon(send)
+
+        assert peak == 2
+        assert limiter.stats()["example.com"]["sent"] == 6
+
+    @pytest.mark.asyncio
+    async def test_domains_are_limited_separately(self):
+        limiter = DestinationLimiter({"default": {"concurrency": 1}})
+
+        async with limiter.limit(["a@example.com"]):
+            with anyio.fail_after(1):
+                async with limiter.limit(["b@example.org"]):
+                    pass
+
+    @pytest.mark.asyncio
+    async def test_domain_override(self):
+        limiter = DestinationLimiter({
+            "default": {"concurrency": 1},
+            "domains": {"Example.com": {"rate": 100}},
+        })
+
+        async with limiter.limit(["a@example.com"]):
+            pass
+
+        assert limiter.domain_limits["example.com"].semaphore is None
+        assert limiter.domain_limits["example.com"].bucket.rate == 100
+
+    @pytest.mark.asyncio
+    async def test_unlimited_domains_not_reported(self):
+        limiter = DestinationLimiter({"global": {"concurrency": 5}})
+
+        async with limiter.limit(["a@example.com"]):
+            assert limiter.stats()["*"]["waiting"] == 0
+
+        assert list(limiter.stats()) == ["*"]
+        assert limiter.stats()["*"]["sent"] == 1
+
+    @pytest.mark.asyncio
+    async def test_queue_depth_reported(self):
+        limiter = DestinationLimiter({"default": {"concurrency": 1}})
+        entered = anyio.Event()
+        release = anyio.Event()
+
+        async def hold():
+            async with limiter.limit(["a@example.com"]):
+                entered.set()
+                await release.wait()
+
+        async def wait():
+            async with limiter.limit(["b@example.com"]):
+                pass
+
+        async with anyio.create_task_group() as tasks:
+            tasks.start_soon(hold)
+            await entered.wait()
+            tasks.start_soon(wait)
+            await anyio.sleep(0.01)
+            assert limiter.stats()["example.com"]["waiting"] == 1
+            release.set()
+
+        assert limiter.stats()["example.com"]["max_wait"] > 0
+
+    @pytest.mark.asyncio
+    async def test_idle_default_limits_are_evicted(self):
+        limiter = DestinationLimiter({
+            "default": {"rate": 10},
+            "domains": {"example.com": {"rate": 100}},
+            "max_domains": 2,
+        })
+
+        for domain in ("example.com", "a.example", "b.example", "c.example"):
+            async with limiter.limit([f"user@{domain}"]):
+                pass
+
+        assert list(limiter.domain_limits) == ["example.com", "b.example", "c.example"]
+
+    @pytest.mark.asyncio
+    async def test_limits_in_use_are_kept(self):
+        limiter = DestinationLimiter({"default": {"concurrency": 1}, "max_domains": 1})
+
+        async with limiter.limit(["user@a.example"]):
+            async with limiter.limit(["user@b.example"]):
+                pass
+
+            assert "a.example" in limiter.domain_limits
+
+    @pytest.mark.asyncio
+    async def test_wait_can_time_out(self):
+        limiter = DestinationLimiter({"default": {"concurrency": 1}})
+
+        async with limiter.limit(["a@example.com"]):
+            with pytest.raises(TimeoutError):
+                async with limiter.limit(["b@example.com"], timeout=0.01):
+                    pass
+
+        assert limiter.stats()["example.com"]["waiting"] == 0
+        assert limiter.domain_limits["example.com"].active == 0
@@ -0,0 +1,115 @@
+import os
+import stat
+from unittest.mock import AsyncMock, patch
+
+import anyio
+import pytest
+from anyio.abc import SocketAttribute
+from anyio.streams.stapled import MultiListener
+
+from src.milter.listener import create_milter_listener, create_unix_socket_listener
+
+
+class TestUnixSocketListener:
+    @pytest.mark.asyncio
+    async def test_socket_permissions(self, tmp_path):
+        path = str(tmp_path / "milter.sock")
+        listener = await create_unix_socket_listener(path, 0o600)
+
+        assert stat.S_ISSOCK(os.stat(path).st_mode)
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+        await listener.aclose()
+
+    @pytest.mark.asyncio
+    async def test_accepted_connection(self, tmp_path):
+        path = str(tmp_path / "milter.sock")
+        listener = await create_unix_socket_listener(path)
+
+        async with await anyio.connect_unix(path) as client:
+            async with await listener.accept() as server:
+                await client.send(b"ping")
+                assert await server.receive() == b"ping"
+                await server.send(b"pong")
+                assert await client.receive() == b"pong"
+
+        await listener.aclose()
+
+        with pytest.raises(anyio.ClosedResourceError):
+            await listener.accept()
+
+    @pytest.mark.asyncio
+    async def test_serve(self, tmp_path):
+        path = str(tmp_path / "milter.sock")
+        listener = await create_unix_socket_listener(path)
+
+        assert listener.extra(SocketAttribute.local_address) == path
+
+        async def echo(stream):
+            async with stream:
+                await stream.send(await stream.receive())
+
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(listener.serve, echo)
+
+            async with await anyio.connect_unix(path) as client:
+                await client.send(b"ping")
+                assert await client.receive() == b"ping"
+
+            task_group.cancel_scope.cancel()
+
+        await listener.aclose()
+
+    @pytest.mark.asyncio
+    async def test_stale_socket_replaced(self, tmp_path):
+        path = str(tmp_path / "milter.sock")
+        await (await create_unix_socket_listener(path)).aclose()
+
+        listener = await create_unix_socket_listener(path)
+
+        async with await anyio.connect_unix(path):
+            pass
+
+        await listener.aclose()
+
+    @pytest.mark.asyncio
+    async def test_other_file_not_removed(self, tmp_path):
+        path = tmp_path / "milter.sock"
+        path.write_text("not a socket")
+
+        with pytest.raises(OSError):
+            await create_unix_socket_listener(str(path))
+
+        assert path.read_text() == "not a socket"
+
+
+class TestMilterListener:
+    @pytest.mark.asyncio
+    @patch("src.milter.listener.create_tcp_listener", new_callable=AsyncMock)
+    async def test_tcp_by_default(self, mock_tcp):
+        listener = await create_milter_listener({})
+
+        mock_tcp.assert_awaited_once_with(local_port=1999)
+        assert listener is mock_tcp.return_value
+
+    @pytest.mark.asyncio
+    @patch("src.milter.listener.create_tcp_listener", new_callable=AsyncMock)
+    async def test_socket_instead_of_tcp(self, mock_tcp, tmp_path):
+        path = str(tmp_path / "milter.sock")
+        listener = await create_milter_listener({"milter_socket": path, "milter_socket_mode": "640"})
+
+        mock_tcp.assert_not_awaited()
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+
+        await listener.aclose()
+
+    @pytest.mark.asyncio
+    @patch("src.milter.listener.create_tcp_listener", new_callable=AsyncMock)
+    async def test_socket_alongside_tcp(self, mock_tcp, tmp_path):
+        path = str(tmp_path / "milter.sock")
+        listener = await create_milter_listener({"milter_socket": path, "milter_port": 2000})
+
+        mock_tcp.assert_awaited_once_with(local_port=2000)
+        assert isinstance(listener, MultiListener)
+
+        await listener.listeners[0].aclose()
@@ -0,0 +1,81 @@
+import json
+import logging
+import sys
+from logging.handlers import QueueHandler
+
+import pytest
+
+from src.log import JSONFormatter, configure_logging
+
+
+def make_record(**extra):
+    record = logging.LogRecord("src.milter", logging.INFO, "processor.py", 10, "%(a)s happened", ({"a": "it"},), None)
+    record.__dict__.update(extra)
+    return record
+
+
+class TestJSONFormatter:
+    def test_session_fields(self):
+        record = make_record(queue_id="Q1", sender="a@example.com", verdict="accept", stages={"sender": 0.01})
+
+        entry = json.loads(JSONFormatter().format(record))
+
+        assert entry["message"] == "it happened"
+        assert entry["level"] == "INFO"
+        assert entry["logger"] == "src.milter"
+        assert entry["queue_id"] == "Q1"
+        assert entry["sender"] == "a@example.com"
+        assert entry["verdict"] == "accept"
+        assert entry["stages"] == {"sender": 0.01}
+        assert entry["source"] == "processor.py:10"
+
+    def test_fields_are_stable(self):
+        entry = json.loads(JSONFormatter().format(make_record()))
+
+        assert entry["queue_id"] is None
+        assert entry["stages"] is None
+
+    def test_exception(self):
+        try:
+            raise ValueError("broken")
+        except ValueError:
+            record = make_record()
+            record.exc_info = sys.exc_info()
+
+        assert "ValueError: broken" in json.loads(JSONFormatter().format(record))["exception"]
+
+
+class TestConfigureLogging:
+    @pytest.fixture(autouse=True)
+    def _restore_root_logger(self):
+        root_logger = logging.getLogger()
+        (handlers, level) = (list(root_logger.handlers), root_logger.level)
+        yield
+        root_logger.handlers = handlers
+        root_logger.setLevel(level)
+
+    @pytest.mark.parametrize("log_format", ["text", "json"])
+    def test_written_by_listener(self, tmp_path, log_format):
+        path = tmp_path / "postconfirm.log"
+        listener = configure_logging({"log.filename": str(path), "log.format": log_format, "log.level": "INFO"})
+
+        root_logger = logging.getLogger()
+        assert [type(handler) for handler in root_logger.handlers] == [QueueHandler]
+
+        logging.getLogger("test").info("%(count)s things", {"count": 3}, extra={"queue_id": "Q1"})
+        logging.getLogger("test").debug("not logged")
+        listener.stop()
+
+        lines = path.read_text().splitlines()
+
+        assert len(lines) == 1
+
+        if log_format == "json":
+            assert json.loads(lines[0])["message"] == "3 things"
+            assert json.loads(lines[0])["queue_id"] == "Q1"
+        else:
+            assert "postconfirm/postconfirm[" in lines[0] and "3 things" in lines[0]
+
+    def test_unknown_format(self, tmp_path):
+        with pytest.raises(ValueError):
+            configure_logging({"log.filename": str(tmp_path / "postconfirm.log"), "log.format": "xml"})
@@ -0,0 +1,185 @@
+import math
+from unittest.mock import MagicMock, patch
+
+import anyio
+import pytest
+
+from src.metrics import Counter, Gauge, Histogram, Registry, StatusServer, metrics_route, registry as default_registry
+from src.metrics.collectors import register_service_metrics
+from src.metrics.metrics import Metric
+from src.milter.processor import challenges
+
+
+class TestMetrics:
+    def test_counter(self):
+        counter = Counter("test_total", "A test counter", ["path"])
+        counter.inc(path="a")
+        counter.inc(2, path="a")
+        counter.inc(path="b")
+
+        assert counter.get(path="a") == 3
+        assert counter.render() == "\n".join([
+            "# HELP test_total A test counter",
+            "# TYPE test_total counter",
+            'test_total{path="a"} 3',
+            'test_total{path="b"} 1',
+        ])
+
+    def test_wrong_labels(self):
+        counter = Counter("test_total", "A test counter", ["path"])
+
+        with pytest.raises(ValueError):
+            counter.inc(verdict="accept")
+
+    def test_label_escaping(self):
+        gauge = Gauge("test", "A test gauge", ["name"])
+        gauge.set(1.5, name='a "b"\n')
+
+        assert 'test{name="a \\"b\\"\\n"} 1.5' in gauge.render()
+
+    def test_collected_gauge(self):
+        gauge = Gauge("test", "A test gauge", ["state"], collect=lambda: {("idle",): 2, ("busy",): None})
+
+        assert gauge.render().splitlines()[2:] == ['test{state="idle"} 2']
+
+        assert Gauge("single", "A test gauge", collect=lambda: 4).render().endswith("single 4")
+
+    def test_histogram(self):
+        histogram = Histogram("test_seconds", "A test histogram", buckets=[0.1, 1])
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        assert histogram.render().splitlines()[2:] == [
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1"} 2',
+            'test_seconds_bucket{le="+Inf"} 3',
+            "test_seconds_sum 5.55",
+            "test_seconds_count 3",
+        ]
+
+    def test_histogram_time(self):
+        histogram = Histogram("test_seconds", "A test histogram", ["stage"])
+
+        with pytest.raises(RuntimeError):
+            with histogram.time(stage="send"):
+                raise RuntimeError()
+
+        assert sum(histogram.counts[("send",)]) == 1
+        assert not math.isnan(histogram.sums[("send",)])
+
+    def test_registry(self):
+        registry = Registry()
+        registry.register(Counter("test_total", "A test counter"))
+
+        with pytest.raises(ValueError):
+            registry.register(Counter("test_total", "A test counter"))
+
+        assert registry.render() == "# HELP test_total A test counter\n# TYPE test_total counter\n"
+
+    def test_service_metrics(self):
+        pool = MagicMock(size=2, in_use=1, idle=[object()])
+        limiter = MagicMock()
+        limiter.stats.return_value = {"*": {"waiting": 0, "sent": 12, "max_wait": 0.5}}
+        registry = Registry()
+
+        with patch("src.metrics.collectors.db") as mock_db:
+            mock_db.get_pools.return_value = {
+                "default": MagicMock(get_stats=lambda: {"pool_size": 4, "pool_available": 3})
+            }
+
+            register_service_metrics({"remailer": MagicMock(pool=pool, limiter=limiter)}, registry)
+            # Registering again replaces the metrics
+            register_service_metrics({"remailer": MagicMock(pool=pool, limiter=limiter)}, registry)
+
+            rendered = registry.render()
+
+        assert 'postconfirm_db_pool_connections{pool="default",state="size"} 4' in rendered
+        assert 'postconfirm_db_pool_connections{pool="default",state="waiting"} 0' in rendered
+        assert 'postconfirm_smtp_pool_connections{state="in_use"} 1' in rendered
+        assert 'postconfirm_smtp_limit_sent_total{domain="*"} 12' in rendered
+
+    def test_processor_metrics(self):
+        rendered = default_registry.render()
+
+        assert "postconfirm_lookups_total " in rendered
+        assert f'{challenges.name}{{result="suppressed"}} ' in rendered
+
+    def test_metric_must_have_samples(self):
+        class Incomplete(Metric):
+            pass
+
+        with pytest.raises(TypeError):
+            Incomplete("test", "A test metric")
+
+
+class TestStatusServer:
+    async def request(self, server, request):
+        (client, server_stream) = anyio.create_memory_object_stream(10)
+        (response_send, response_receive) = anyio.create_memory_object_stream(10)
+
+        class Stream:
+            async def receive(self):
+                return await server_stream.receive()
+
+            async def send(self, data):
+                await response_send.send(data)
+
+            async def aclose(self):
+                pass
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *args):
+                pass
+
+        await client.send(request)
+        await server.handle(Stream())
+
+        return response_receive.receive_nowait().decode()
+
+    @pytest.mark.asyncio
+    async def test_metrics(self):
+        registry = Registry()
+        registry.register(Counter("test_total", "A test counter")).inc()
+        server = StatusServer({"/metrics": metrics_route(registry)})
+
+        response = await self.request(server, b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+
+        assert response.startswith("HTTP/1.1 200 OK\r\n")
+        assert "Content-Type: text/plain; version=0.0.4" in response
+        assert response.endswith("test_total 1\n")
+
+    @pytest.mark.asyncio
+    async def test_head(self):
+        server = StatusServer({"/metrics": metrics_route(Registry())})
+
+        response = await self.request(server, b"HEAD /metrics HTTP/1.1\r\n\r\n")
+
+        assert response.startswith("HTTP/1.1 200 OK\r\n")
+        assert response.endswith("\r\n\r\n")
+
+    @pytest.mark.asyncio
+    async def test_not_found(self):
+        server = StatusServer({"/metrics": metrics_route(Registry())})
+
+        response = await self.request(server, b"GET /other HTTP/1.1\r\n\r\n")
+
+        assert response.startswith("HTTP/1.1 404 Not Found\r\n")
+
+    @pytest.mark.asyncio
+    async def test_method_not_allowed(self):
+        server = StatusServer({"/metrics": metrics_route(Registry())})
+
+        response = await self.request(server, b"POST /metrics HTTP/1.1\r\n\r\n")
+
+        assert response.startswith("HTTP/1.1 405 Method Not Allowed\r\n")
+
+    @pytest.mark.asyncio
+    async def test_bad_request(self):
+        server = StatusServer()
+
+        response = await self.request(server, b"nonsense\r\n\r\n")
+
+        assert response.startswith("HTTP/1.1 400 Bad Request\r\n")
@@ -0,0 +1,120 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import anyio
+import pytest
+
+from src.outbox import Outbox
+
+
+def _make_outbox(**settings):
+    return Outbox({"db": {}, "outbox": {"enabled": True, **settings}})
+
+
+class TestOutboxConfig:
+    def test_disabled_by_default(self):
+        outbox = Outbox({"db": {}})
+        assert outbox.enabled is False
+        assert outbox.workers == 1
+
+    def test_from_config(self):
+        outbox = _make_outbox(workers=3, batch_size=50, max_attempts=2)
+        assert outbox.enabled is True
+        assert outbox.workers == 3
+        assert outbox.batch_size == 50
+        assert outbox.max_attempts == 2
+
+
+class TestOutboxProcessBatch:
+    @pytest.mark.asyncio
+    async def test_sent_entries_completed_and_failed_retried(self):
+        outbox = _make_outbox()
+        outbox.claim = MagicMock(return_value=[
+            (1, None, ["a@example.com"], "challenge", 0),
+            (2, "s@example.com", ["b@example.com"], "released", 3),
+        ])
+        outbox.complete = MagicMock()
+        outbox.retry = MagicMock()
+        remailer = MagicMock()
+        remailer.sendmail_many = AsyncMock(return_value=[({}, "OK"), False])
+
+        assert await outbox.process_batch(remailer) == 2
+
+        remailer.sendmail_many.assert_awaited_once_with([
+            (["a@example.com"], "challenge", None),
+            (["b@example.com"], "released", "s@example.com"),
+        ])
+        outbox.complete.assert_called_once_with([1])
+        outbox.retry.assert_called_once_with([(2, 3)])
+
+    @pytest.mark.asyncio
+    async def test_lease_renewed_while_sending(self):
+        outbox = _make_outbox(lease=0.02)
+        outbox.claim = MagicMock(return_value=[(1, None, ["a@example.com"], "challenge", 0)])
+        outbox.complete = MagicMock()
+        outbox.retry = MagicMock()
+        outbox.renew = MagicMock()
+
+        async def slow_send(messages):
+            await anyio.sleep(0.05)
+            return [({}, "OK")]
+
+        remailer = MagicMock()
+        remailer.sendmail_many = slow_send
+
+        await outbox.process_batch(remailer)
+
+        outbox.renew.assert_called_with([1])
+        renewals = outbox.renew.call_count
+
+        await anyio.sleep(0.05)
+        assert outbox.renew.call_count == renewals
+
+    @pytest.mark.asyncio
+    async def test_nothing_to_send(self):
+        outbox = _make_outbox()
+        outbox.claim = MagicMock(return_value=[])
+        remailer = MagicMock()
+        remailer.sendmail_many = AsyncMock()
+
+        assert await outbox.process_batch(remailer) == 0
+        remailer.sendmail_many.assert_not_awaited()
+
+
+class TestOutboxQueue:
+    @patch("src.outbox.outbox.get_db_pool")
+    def test_queued_in_one_transaction(self, mock_get_db_pool):
+        connection = mock_get_db_pool.return_value.connection.return_value.__enter__.return_value
+        cursor = connection.cursor.return_value.__enter__.return_value
+        outbox = _make_outbox()
+
+        outbox.queue([(["a@example.com"], "one", None), (["b@example.com", "c@example.com"], "two", "<>")])
+
+        rows = cursor.executemany.call_args.args[1]
+        assert rows == [
+            {"sender": None, "recipients": '["a@example.com"]', "message": "one"},
+            {"sender": "<>", "recipients": '["b@example.com", "c@example.com"]', "message": "two"},
+        ]
+        connection.commit.assert_called_once()
+
+
+class TestOutboxRetry:
+    @patch("src.outbox.outbox.get_db_pool")
+    def test_backoff_doubles(self, mock_get_db_pool):
+        cursor = mock_get_db_pool.return_value.connection.return_value.__enter__.return_value \
+            .cursor.return_value.__enter__.return_value
+        outbox = _make_outbox(retry_delay=10, max_attempts=5)
+
+        outbox.retry([(1, 0), (2, 2)])
+
+        delays = [call.args[1]["delay"] for call in cursor.execute.call_args_list]
+        assert delays == [10, 40]
+
+    @patch("src.outbox.outbox.get_db_pool")
+    def test_abandoned_after_max_attempts(self, mock_get_db_pool):
+        cursor = mock_get_db_pool.return_value.connection.return_value.__enter__.return_value \
+            .cursor.return_value.__enter__.return_value
+        outbox = _make_outbox(max_attempts=3)
+
+        outbox.retry([(1, 2)])
+
+        assert cursor.execute.call_args.args[1]["delay"] is None
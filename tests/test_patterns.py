@@ -0,0 +1,186 @@
+import logging
+import random
+import re
+import time
+
+import pytest
+
+from src.rules import LinearPattern, PatternMatcher, Unsupported, lint_pattern
+from src.rules.patterns import pattern_matches, slow_patterns
+
+SAMPLES = [
+    "someone@example.com",
+    "Someone@Mail.Example.COM",
+    "list-bounces+someone=example.org@example.com",
+    "a@b",
+    "",
+    "aaaaaaaaaaaaaaaaaaaaaaaaaaaaaac",
+    "no-reply@example.com.evil.org",
+]
+
+
+class TestLint:
+    @pytest.mark.parametrize("pattern", [
+        r".*@example\.com",
+        r"^.*@(ex|why)\.com$",
+        r".*@(.*\.)?example\.com",
+        r"[a-z0-9._-]+@example\.(com|org)",
+        r".*-bounces@.*",
+        r".*@.*\.example\.com",
+        r"(.*)(.*)@example\.com",
+    ])
+    def test_safe(self, pattern):
+        assert lint_pattern(pattern) == []
+
+    @pytest.mark.parametrize("pattern, hazard", [
+        (r"(a+)+b", "nested quantifiers"),
+        (r"(\w+\.)*example\.com", "nested quantifiers"),
+        (r"(a|ab)*c", "a quantified alternation"),
+        (r".*.*.*@example\.com", "three or more overlapping quantifiers"),
+        (r"(.*)(.*)(.*)@example\.com", "three or more overlapping quantifiers"),
+        (r".*a.*a.*b", "three or more overlapping quantifiers"),
+        (r".*@.*\..*\.example\.com", "three or more overlapping quantifiers"),
+        (r"(x)\1@example\.com", "a backreference"),
+    ])
+    def test_hazards(self, pattern, hazard):
+        assert any(found.startswith(hazard) for found in lint_pattern(pattern))
+
+    def test_invalid(self):
+        with pytest.raises(re.error):
+            lint_pattern("(unclosed")
+
+
+class TestLinearPattern:
+    @pytest.mark.parametrize("pattern", [
+        r".*@example\.com",
+        r".*@(.*\.)?example\.com",
+        r"(a+)+c",
+        r"(a|ab)*c",
+        r"[^@]+@[a-z]{1,3}",
+        r"\w+@\w+\.com\b",
+        r"^list-.*?@example\.com$",
+        r"a{2,5}a*c",
+    ])
+    def test_same_as_re(self, pattern):
+        linear = LinearPattern(pattern, re.IGNORECASE)
+
+        for sample in SAMPLES:
+            expected = re.fullmatch(pattern, sample, re.IGNORECASE) is not None
+            assert linear.fullmatch(sample) == expected, sample
+
+    @pytest.mark.parametrize("pattern, sample", [
+        (r"[a-z]+@example\.com", "\u212aelvin@example.com"),
+        (r"kelvin@example\.com", "\u212aelvin@example.com"),
+        (r"[^k]elvin@example\.com", "\u212aelvin@example.com"),
+        (r"sam@example\.com", "\u017fam@example.com"),
+        (r"[r-t]am@example\.com", "\u017fam@example.com"),
+        (r"\u03c3@example\.com", "\u03c2@example.com"),
+        (r"[\u00b5]@example\.com", "\u039c@example.com"),
+        (r"i@example\.com", "\u0130@example.com"),
+    ])
+    def test_case_folded_as_re(self, pattern, sample):
+        expected = re.fullmatch(pattern, sample, re.IGNORECASE) is not None
+        assert LinearPattern(pattern, re.IGNORECASE).fullmatch(sample) == expected
+
+    def test_fuzz_same_as_re(self):
+        generator = random.Random(49)
+        pieces = ["k", "s", "[a-z]", "[^k]", "[r-t]", "\\w", ".", "@", "\u03c3", "[\u00b5]", "i"]
+        quantifiers = ["", "", "*", "+", "?", "{1,2}"]
+        chars = "kKs\u212a\u017f@\u03c3\u03c2\u03a3\u00b5\u039ci\u0130\u0131x-"
+
+        for _ in range(200):
+            pattern = "".join(
+                generator.choice(pieces) + generator.choice(quantifiers) for _ in range(generator.randint(1, 4))
+            )
+            linear = LinearPattern(pattern, re.IGNORECASE)
+
+            for _ in range(20):
+                sample = "".join(generator.choice(chars) for _ in range(generator.randint(0, 5)))
+                expected = re.fullmatch(pattern, sample, re.IGNORECASE) is not None
+                assert linear.fullmatch(sample) == expected, (pattern, sample)
+
+    def test_unsupported(self):
+        with pytest.raises(Unsupported):
+            LinearPattern(r"(x)\1")
+
+        with pytest.raises(Unsupported):
+            LinearPattern(r"(?!spam).*@example\.com")
+
+    def test_state_sets_cached(self):
+        linear = LinearPattern(r".*@example\.com", re.IGNORECASE)
+
+        assert linear.fullmatch("someone@example.com")
+        cached = len(linear.state_sets)
+
+        assert linear.fullmatch("someone@EXAMPLE.com")
+        assert not linear.fullmatch("someone@example.org")
+        assert len(linear.state_sets) == cached
+
+    def test_linear_time(self):
+        start = time.perf_counter()
+
+        assert not LinearPattern(r"(a+)+b").fullmatch("a" * 200 + "c")
+        assert time.perf_counter() - start < 1
+
+
+class TestPatternMatcher:
+    def test_match(self):
+        matcher = PatternMatcher()
+
+        assert matcher.fullmatch(r".*@example\.com", "Someone@EXAMPLE.com")
+        assert not matcher.fullmatch(r".*@example\.com", "someone@example.org")
+        assert matcher.compile(r".*@example\.com").linear is not None
+
+    @pytest.mark.parametrize("pattern, email", [
+        (r"(a+)+b", "a" * 40 + "c"),
+        (r".*a.*a.*a.*a.*b", "a" * 240 + "@"),
+    ])
+    def test_hazardous_pattern(self, pattern, email):
+        matcher = PatternMatcher()
+        start = time.perf_counter()
+
+        assert not matcher.fullmatch(pattern, email)
+        assert matcher.fullmatch(pattern, "aaaab")
+        assert time.perf_counter() - start < 1
+
+    def test_unsupported_pattern_is_skipped(self, caplog):
+        matcher = PatternMatcher()
+
+        assert not matcher.fullmatch(r"(x)\1@example\.com", "xx@example.com")
+        assert matcher.compile(r"(x)\1@example\.com").skipped
+        assert "so is skipped" in caplog.text
+
+    def test_max_length(self):
+        matcher = PatternMatcher(max_length=20)
+
+        assert matcher.fullmatch(r".*@example\.com", "short@example.com")
+        assert not matcher.fullmatch(r".*@example\.com", "rather-longer@example.com")
+
+    def test_unsupported_pattern_uses_re(self, caplog):
+        caplog.set_level(logging.INFO)
+        matcher = PatternMatcher()
+        before = pattern_matches.get(engine="re")
+
+        assert matcher.fullmatch(r"(?!spam).*@example\.com", "someone@example.com")
+        assert not matcher.fullmatch(r"(?!spam).*@example\.com", "spam@example.com")
+        assert matcher.compile(r"(?!spam).*@example\.com").linear is None
+        assert pattern_matches.get(engine="re") == before + 2
+        assert "so is matched with re" in caplog.text
+
+    def test_over_budget(self, caplog):
+        matcher = PatternMatcher(budget=0)
+        before = slow_patterns.get()
+
+        assert matcher.fullmatch(r"(?!spam).*@example\.com", "someone@example.com")
+        assert slow_patterns.get() == before + 1
+        assert matcher.compile(r"(?!spam).*@example\.com").skipped
+        assert "took" in caplog.text
+
+        # From then on skipped, without being timed
+        assert not matcher.fullmatch(r"(?!spam).*@example\.com", "someone@example.com")
+        assert slow_patterns.get() == before + 1
+
+    def test_compiled_once(self):
+        matcher = PatternMatcher()
+
+        assert matcher.compile(r".*@example\.com") is matcher.compile(r".*@example\.com")
@@ -1,23 +1,82 @@
+import asyncio
+import logging
 import tempfile
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 
 from src import services
+from kilter.protocol import Accept, Discard, Reject
+from kilter.protocol.messages import ActionFlags, Negotiate, ProtocolFlags
+
 from src.challenge.challenge import Challenge
 from src.milter.processor import (
     cleanup_mail,
     extract_reference,
     form_header,
+    get_challenge_address,
+    get_challenge_hash_from_address,
     get_challenge_subject,
     get_challenge_token_from_subject,
+    handle,
+    make_challenge_message,
     message_should_be_dropped,
     recipient_requires_challenge,
     reform_email_text,
+    release_messages,
+    resolve_sender_action,
+    sessions_in_flight,
     subject_is_challenge_response,
+    verdicts,
 )
+from src.sender import Sender
 from src.validator.validator import Validator
 from tests.mocks.challenge_handler import MockChallengeHandler
+from tests.mocks.sender_handler import MockHandler, defined_sender
+
+
+class FakeHeader:
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value.encode()
+
+
+class FakeSection:
+    def __init__(self, items):
+        self.items = items
+        self.entered = False
+
+    async def __aenter__(self):
+        self.entered = True
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    async def __aiter__(self):
+        for item in self.items:
+            yield item
+
+
+class FakeSession:
+    """
+    Enough of a kilter Session to drive the handler, recording which phases
+    of the message were collected.
+    """
+
+    def __init__(self, mail_from, recipients, headers=(), body=""):
+        self.mail_from = mail_from
+        self.recipients = recipients
+        self.macros = {"i": "QUEUEID"}
+        self.headers = FakeSection([FakeHeader(name, value) for (name, value) in headers])
+        self.body = FakeSection([memoryview(body.encode())])
+
+    async def envelope_from(self):
+        return self.mail_from
+
+    async def envelope_recipients(self):
+        for recipient in self.recipients:
+            yield recipient
 
 
 class TestCleanupMail:
@@ -166,32 +225,32 @@ def _make_challenge(email, action):
 
 
 class TestRecipientRequiresChallenge:
-    @patch("src.milter.processor.get_challenge")
-    def test_no_challenge_recipients(self, mock_get_challenge):
-        mock_get_challenge.side_effect = lambda e: _make_challenge(e, "unknown")
+    @patch("src.milter.processor.get_challenges")
+    def test_no_challenge_recipients(self, mock_get_challenges):
+        mock_get_challenges.side_effect = lambda emails: [_make_challenge(e, "unknown") for e in emails]
         result = recipient_requires_challenge(["a@example.com", "b@example.com"])
         assert result is False
 
-    @patch("src.milter.processor.get_challenge")
-    def test_one_challenge_recipient(self, mock_get_challenge):
-        mock_get_challenge.side_effect = lambda e: _make_challenge(e, "challenge")
+    @patch("src.milter.processor.get_challenges")
+    def test_one_challenge_recipient(self, mock_get_challenges):
+        mock_get_challenges.side_effect = lambda emails: [_make_challenge(e, "challenge") for e in emails]
         result = recipient_requires_challenge(["a@example.com"])
         assert result == ["a@example.com"]
 
-    @patch("src.milter.processor.get_challenge")
-    def test_mixed_recipients(self, mock_get_challenge):
+    @patch("src.milter.processor.get_challenges")
+    def test_mixed_recipients(self, mock_get_challenges):
         actions = {
             "a@example.com": "challenge",
             "b@example.com": "ignore",
             "c@example.com": "unknown",
         }
-        mock_get_challenge.side_effect = lambda e: _make_challenge(e, actions[e])
+        mock_get_challenges.side_effect = lambda emails: [_make_challenge(e, actions[e]) for e in emails]
         result = recipient_requires_challenge(list(actions.keys()))
         assert result == ["a@example.com"]
 
-    @patch("src.milter.processor.get_challenge")
-    def test_ignore_not_included(self, mock_get_challenge):
-        mock_get_challenge.side_effect = lambda e: _make_challenge(e, "ignore")
+    @patch("src.milter.processor.get_challenges")
+    def test_ignore_not_included(self, mock_get_challenges):
+        mock_get_challenges.side_effect = lambda emails: [_make_challenge(e, "ignore") for e in emails]
         result = recipient_requires_challenge(["a@example.com"])
         assert result is False
 
@@ -226,3 +285,391 @@ class TestGetChallengeSubject:
         result = get_challenge_subject("sender@a.com", ["rcpt@b.com"], "ref1")
         token = result.strip().removeprefix("Confirm: ")
         assert validator.validate_token("sender@a.com", token, ["ref1"]) is True
+
+
+class TestChallengeAddress:
+    @pytest.fixture(autouse=True)
+    def _setup_config(self):
+        services["app_config"] = {"challenge_verp_address": "confirm@example.com"}
+        services["validator"] = _make_test_validator()
+        yield
+        del services["app_config"]
+        del services["validator"]
+
+    def test_format(self):
+        address = get_challenge_address("sender@a.com", "CAxx+long=message.id.with=signs-1234567890abcdef")
+        (local_part, domain) = address.split("@")
+        assert domain == "example.com"
+        assert local_part.startswith("confirm+")
+        assert len(local_part) == len("confirm+") + 16
+
+    def test_round_trip(self):
+        reference = "CA+x=y.z"
+        address = get_challenge_address("sender@a.com", reference)
+        short_hash = get_challenge_hash_from_address(address)
+        assert services["validator"].validate_short_hash("sender@a.com", short_hash, ["other", reference]) is True
+        assert services["validator"].validate_short_hash("sender@a.com", short_hash, ["other"]) is False
+        assert services["validator"].validate_short_hash("other@a.com", short_hash, [reference]) is False
+
+    def test_case_insensitive(self):
+        address = get_challenge_address("sender@a.com", "ref1")
+        short_hash = get_challenge_hash_from_address(address.upper().replace("CONFIRM", "confirm"))
+        assert services["validator"].validate_short_hash("sender@a.com", short_hash, ["ref1"]) is True
+
+    def test_other_addresses(self):
+        assert get_challenge_hash_from_address("confirm@example.com") is None
+        assert get_challenge_hash_from_address("confirm+abcdefghijklmnop@example.org") is None
+        assert get_challenge_hash_from_address("list@example.com") is None
+
+    def test_malformed_tag(self):
+        assert get_challenge_hash_from_address("confirm+r=b.com@example.com") is None
+        assert get_challenge_hash_from_address("confirm+abcdefghijklmnop1@example.com") is None
+
+    def test_long_address_not_tagged(self):
+        services["app_config"]["challenge_verp_address"] = f"{'c' * 50}@example.com"
+        assert get_challenge_address("sender@a.com", "ref1") is None
+
+    def test_challenge_message_headers(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".mustache") as template:
+            template.write("{{challenge_address}}")
+            template.flush()
+            services["app_config"]["mail_template"] = template.name
+
+            message = make_challenge_message(Sender("sender@a.com", MockHandler()), "hi", ["rcpt@b.com"], "ref1")
+
+        headers = dict(line.split(":", 1) for line in message.split("\n\n")[0].split("\n"))
+        short_hash = get_challenge_hash_from_address(headers["Reply-To"].strip())
+        assert headers["From"] == f' "rcpt@b.com" <{headers["Reply-To"].strip()}>'
+        assert services["validator"].validate_short_hash("sender@a.com", short_hash, ["ref1"]) is True
+
+    def test_challenge_message_signed_once(self, tmp_path):
+        template = tmp_path / "confirm.email.mustache"
+        template.write_text("{{full_ref}}")
+        services["app_config"]["mail_template"] = str(template)
+        validator = services["validator"]
+
+        with patch.object(validator, "get_token", wraps=validator.get_token) as get_token:
+            message = make_challenge_message(Sender("sender@a.com", MockHandler()), "hi", ["rcpt@b.com"], "ref1")
+
+        get_token.assert_called_once()
+        (headers, body) = message.split("\n\n", 1)
+        assert f"Subject:{body}" in headers.split("\n")
+
+    def test_challenge_sent_to_the_address(self, tmp_path):
+        template = tmp_path / "confirm.email.mustache"
+        template.write_text("{{sender_address}}")
+        services["app_config"]["mail_template"] = str(template)
+        sender = Sender("sender@a.com", MockHandler(), address="sender+tag@a.com")
+
+        with patch.object(services["validator"], "get_token", return_value="token") as get_token:
+            message = make_challenge_message(sender, "hi", ["rcpt@b.com"], "ref1")
+
+        get_token.assert_called_once_with("sender@a.com", "rcpt@b.com", "ref1")
+        (headers, body) = message.split("\n\n", 1)
+        assert "To: sender+tag@a.com" in headers.split("\n")
+        assert body == "sender+tag@a.com"
+
+    def test_not_configured(self):
+        services["app_config"] = {}
+        assert get_challenge_address("sender@a.com", "ref1") is None
+        assert get_challenge_hash_from_address("confirm+abcdefghijklmnop@example.com") is None
+
+
+class TestReleaseMessages:
+    @pytest.fixture(autouse=True)
+    def _setup_remailer(self):
+        services["remailer"] = MagicMock()
+        services["outbox"] = MagicMock(enabled=False)
+        yield
+        del services["remailer"]
+        del services["outbox"]
+
+    @pytest.mark.asyncio
+    async def test_released_messages_are_removed(self):
+        services["remailer"].sendmail_many = AsyncMock(return_value=[({}, "OK"), ({}, "OK")])
+        sender = Sender(defined_sender, MockHandler())
+
+        await release_messages(sender)
+
+        services["remailer"].sendmail_many.assert_awaited_once_with([
+            (["a@b.c", "d@e.f"], "a message", defined_sender),
+            (["a@b.c", "d@e.f"], "a message", defined_sender),
+        ], in_session=True)
+        assert sender.get_stashed_messages() == []
+
+    @pytest.mark.asyncio
+    async def test_released_from_the_envelope_sender(self):
+        services["remailer"].sendmail_many = AsyncMock(return_value=[({}, "OK")])
+        sender = Sender("sender@a.com", MockHandler(), address="sender+tag@a.com")
+        sender.stash_message("a message", ["a@b.c"])
+
+        await release_messages(sender)
+
+        services["remailer"].sendmail_many.assert_awaited_once_with([
+            (["a@b.c"], "a message", "sender+tag@a.com"),
+        ], in_session=True)
+
+    @pytest.mark.asyncio
+    async def test_queued_to_outbox_when_enabled(self):
+        services["outbox"].enabled = True
+        services["remailer"].sendmail_many = AsyncMock()
+        handler = MockHandler()
+        sender = Sender(defined_sender, handler)
+
+        await release_messages(sender)
+
+        services["remailer"].sendmail_many.assert_not_awaited()
+        services["outbox"].notify.assert_called_once()
+        assert len(handler.outbox) == 2
+        assert sender.get_stashed_messages() == []
+
+    @pytest.mark.asyncio
+    async def test_failed_messages_are_retried_from_the_outbox(self):
+        services["remailer"].sendmail_many = AsyncMock(return_value=[False, ({}, "OK")])
+        handler = MockHandler()
+        handler.stash[defined_sender][0] = ("first message", ["a@b.c"], defined_sender)
+        sender = Sender(defined_sender, handler)
+
+        await release_messages(sender)
+
+        assert sender.get_stashed_messages() == []
+        assert handler.outbox == [(["a@b.c"], "first message", defined_sender)]
+        services["outbox"].notify.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_outbox_untouched_when_all_released(self):
+        services["remailer"].sendmail_many = AsyncMock(return_value=[({}, "OK"), ({}, "OK")])
+        handler = MockHandler()
+        sender = Sender(defined_sender, handler)
+
+        await release_messages(sender)
+
+        assert handler.outbox == []
+        services["outbox"].notify.assert_not_called()
+
+
+class TestResolveSenderAction:
+    @pytest.mark.asyncio
+    async def test_resolves_action(self):
+        sender = Sender(defined_sender, MockHandler())
+        assert await resolve_sender_action(sender) == "accept"
+
+    @pytest.mark.asyncio
+    async def test_existing_action_not_looked_up(self):
+        handler = MockHandler()
+        handler.get_action_for_sender = MagicMock()
+        sender = Sender(defined_sender, handler)
+        sender.action = "reject"
+        assert await resolve_sender_action(sender) == "reject"
+        handler.get_action_for_sender.assert_not_called()
+
+
+class TestHandleStages:
+    @pytest.fixture(autouse=True)
+    def _setup_services(self):
+        services["app_config"] = {"remail_sender": "postconfirm@example.com"}
+        services["outbox"] = MagicMock(enabled=False)
+        yield
+        del services["app_config"]
+        del services["outbox"]
+
+    async def run_handler(self, session):
+        return await next(iter(handle.filters))(session)
+
+    @pytest.mark.asyncio
+    @patch("src.milter.processor.resolve_challenge_recipients")
+    async def test_remail_sender_accepted_after_mail_from(self, mock_resolve):
+        session = FakeSession("<postconfirm@example.com>", ["list@example.org"])
+
+        assert isinstance(await self.run_handler(session), Accept)
+
+        mock_resolve.assert_not_called()
+        assert not session.headers.entered
+
+    @pytest.mark.asyncio
+    @patch("src.milter.processor.resolve_challenge_recipients", new_callable=AsyncMock, return_value=False)
+    async def test_unchallenged_recipients_accepted_without_headers(self, mock_resolve):
+        session = FakeSession("someone@example.net", ["list@example.org"], [("Subject", " hello")])
+
+        assert isinstance(await self.run_handler(session), Accept)
+
+        mock_resolve.assert_awaited_once_with(["list@example.org"])
+        assert not session.headers.entered
+        assert not session.body.entered
+
+    @pytest.mark.asyncio
+    @patch("src.milter.processor.resolve_challenge_recipients", new_callable=AsyncMock, return_value=["list@example.org"])
+    async def test_bulk_mail_dropped_without_body(self, _):
+        session = FakeSession("someone@example.net", ["list@example.org"], [("Precedence", " bulk")])
+
+        assert isinstance(await self.run_handler(session), Discard)
+
+        assert session.headers.entered
+        assert not session.body.entered
+
+    @pytest.mark.asyncio
+    @patch("src.milter.processor.resolve_challenge_recipients", new_callable=AsyncMock, return_value=["list@example.org"])
+    async def test_known_sender_accepted_without_body(self, _):
+        session = FakeSession(defined_sender, ["list@example.org"], [("Subject", " hello")])
+
+        with patch("src.milter.processor.get_sender", return_value=Sender(defined_sender, MockHandler())):
+            assert isinstance(await self.run_handler(session), Accept)
+
+        assert not session.body.entered
+
+    @pytest.mark.asyncio
+    @patch("src.milter.processor.send_challenge", new_callable=AsyncMock)
+    @patch("src.milter.processor.resolve_challenge_recipients", new_callable=AsyncMock, return_value=["list@example.org"])
+    async def test_unknown_sender_stashed_with_body(self, _, mock_send_challenge):
+        handler = MockHandler()
+        session = FakeSession(
+            "new@example.net", ["list@example.org"], [("Subject", " hello"), ("Message-ID", " <abc@example.net>")], "body"
+        )
+
+        with patch("src.milter.processor.get_sender", return_value=Sender("new@example.net", handler)):
+            assert isinstance(await self.run_handler(session), Discard)
+
+        assert session.body.entered
+        mock_send_challenge.assert_awaited_once()
+
+    @pytest.mark.asyncio
+    @patch("src.milter.processor.resolve_challenge_recipients", new_callable=AsyncMock, return_value=False)
+    async def test_verdict_counted(self, _):
+        session = FakeSession("someone@example.net", ["list@example.org"])
+        before = verdicts.get(verdict="accept", path="no_challenge")
+
+        await self.run_handler(session)
+
+        assert verdicts.get(verdict="accept", path="no_challenge") == before + 1
+        assert sessions_in_flight.get() == 0
+
+    @pytest.mark.asyncio
+    @patch("src.milter.processor.resolve_challenge_recipients", new_callable=AsyncMock, return_value=False)
+    async def test_outcome_logged(self, _, caplog):
+        session = FakeSession("someone@example.net", ["list@example.org"])
+
+        with caplog.at_level(logging.INFO, logger="src.milter.processor"):
+            await self.run_handler(session)
+
+        (record,) = caplog.records
+        assert record.getMessage() == "QUEUEID in-or-out allow from:someone@example.net - no challenge required"
+        assert record.queue_id == "QUEUEID"
+        assert record.sender == "someone@example.net"
+        assert record.verdict == "allow"
+        assert set(record.stages) == {"envelope", "recipients", "recipient_resolution"}
+
+    @pytest.mark.asyncio
+    @patch("src.milter.processor.resolve_challenge_recipients", new_callable=AsyncMock, return_value=False)
+    async def test_sampled_outcome_not_logged(self, _, caplog):
+        services["app_config"]["log.sample_rate"] = 0
+        session = FakeSession("someone@example.net", ["list@example.org"])
+
+        with caplog.at_level(logging.INFO, logger="src.milter.processor"):
+            await self.run_handler(session)
+
+        assert not caplog.records
+
+
+class TestNegotiation:
+    @pytest.fixture
+    def negotiated(self):
+        offered = ProtocolFlags(0)
+        for flag in ProtocolFlags:
+            offered |= flag
+
+        return asyncio.run(handle._negotiate(Negotiate(6, ActionFlags.ALL, offered, {}))).protocol_flags
+
+    def test_unused_stages_are_not_sent(self, negotiated):
+        assert ProtocolFlags.NO_HELO in negotiated
+        assert ProtocolFlags.NO_HEADERS not in negotiated
+        assert ProtocolFlags.NO_BODY not in negotiated
+
+    def test_responses_only_where_a_verdict_is_given(self, negotiated):
+        for flag in [ProtocolFlags.NR_RECIPIENT, ProtocolFlags.NR_HEADER, ProtocolFlags.NR_BODY]:
+            assert flag in negotiated
+
+        for flag in [ProtocolFlags.NR_SENDER, ProtocolFlags.NR_DATA, ProtocolFlags.NR_END_OF_HEADERS]:
+            assert flag not in negotiated
+
+    def test_skip_is_negotiated(self, negotiated):
+        assert ProtocolFlags.SKIP in negotiated
+
+
+class TestHandleVerpResponse:
+    @pytest.fixture(autouse=True)
+    def _setup_services(self):
+        services["app_config"] = {
+            "remail_sender": "postconfirm@example.com",
+            "challenge_verp_address": "confirm@example.com",
+        }
+        services["validator"] = _make_test_validator()
+        services["outbox"] = MagicMock(enabled=False)
+        yield
+        del services["app_config"]
+        del services["validator"]
+        del services["outbox"]
+
+    def make_sender(self, reference):
+        handler = MockHandler()
+        handler.actions["new@example.net"] = ("confirm", [reference])
+        return Sender("new@example.net", handler)
+
+    async def run_handler(self, session):
+        return await next(iter(handle.filters))(session)
+
+    @pytest.mark.asyncio
+    @patch("src.milter.processor.release_messages", new_callable=AsyncMock)
+    @patch("src.milter.processor.resolve_challenge_recipients", new_callable=AsyncMock)
+    async def test_valid_response_confirmed(self, mock_resolve, mock_release):
+        session = FakeSession("new@example.net", [get_challenge_address("new@example.net", "ref1")])
+        sender = self.make_sender("ref1")
+
+        with patch("src.milter.processor.get_sender", return_value=sender):
+            assert isinstance(await self.run_handler(session), Discard)
+
+        assert not session.body.entered
+        mock_resolve.assert_not_awaited()
+        mock_release.assert_awaited_once_with(sender)
+        assert sender.action == "accept"
+
+    @pytest.mark.asyncio
+    @patch("src.milter.processor.release_messages", new_callable=AsyncMock)
+    @patch("src.milter.processor.resolve_challenge_recipients", new_callable=AsyncMock)
+    async def test_valid_response_queued_with_the_acceptance(self, mock_resolve, mock_release):
+        services["outbox"].enabled = True
+        session = FakeSession("new@example.net", [get_challenge_address("new@example.net", "ref1")])
+        sender = self.make_sender("ref1")
+        sender.handler.stash["new@example.net"] = [("a message", ["a@b.c"], "new@example.net")]
+        sender.handler.accept_sender = MagicMock(side_effect=lambda email, _: sender.handler.queue_release_for_sender(email))
+
+        with patch("src.milter.processor.get_sender", return_value=sender):
+            assert isinstance(await self.run_handler(session), Discard)
+
+        sender.handler.accept_sender.assert_called_once_with("new@example.net", True)
+        assert sender.handler.outbox == [(["a@b.c"], "a message", "new@example.net")]
+        services["outbox"].notify.assert_called_once()
+        mock_release.assert_not_awaited()
+        assert sender.action == "accept"
+
+    @pytest.mark.asyncio
+    async def test_invalid_response_rejected(self):
+        session = FakeSession("new@example.net", [get_challenge_address("new@example.net", "ref2")])
+
+        with patch("src.milter.processor.get_sender", return_value=self.make_sender("ref1")):
+            assert isinstance(await self.run_handler(session), Reject)
+
+    @pytest.mark.asyncio
+    @patch("src.milter.processor.release_messages", new_callable=AsyncMock)
+    async def test_automatic_reply_dropped(self, mock_release):
+        session = FakeSession(
+            "new@example.net",
+            [get_challenge_address("new@example.net", "ref1")],
+            headers=[("Auto-Submitted", "auto-replied"), ("Subject", "Out of office")],
+        )
+        sender = self.make_sender("ref1")
+
+        with patch("src.milter.processor.get_sender", return_value=sender):
+            assert isinstance(await self.run_handler(session), Discard)
+
+        mock_release.assert_not_awaited()
+        assert sender.action != "accept"
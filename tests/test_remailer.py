@@ -1,10 +1,14 @@
 from io import StringIO
 from os.path import dirname
-from unittest.mock import AsyncMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 
+import anyio
 import config
 import pytest
+from aiosmtplib import SMTPServerDisconnected
 
+from src.outbox import Outbox
+from src.remailer.pool import SMTPPool
 from src.remailer.remailer import Remailer
 
 empty_cfg = config.Config(StringIO(""))
@@ -187,3 +191,226 @@ class TestRemailerAuth:
         result = await mailer.sendmail(["a@example.com"], "test")
 
         assert result is False
+
+
+class FakeSMTP:
+    def __init__(self):
+        self.is_connected = True
+        self.sent = []
+        self.rsets = 0
+        self.fail_next = None
+
+    async def rset(self):
+        self.rsets += 1
+
+    async def sendmail(self, sender, recipients, message):
+        if self.fail_next:
+            error, self.fail_next = self.fail_next, None
+            raise error
+        self.sent.append((sender, recipients, message))
+        return ({}, "OK")
+
+    async def quit(self):
+        self.is_connected = False
+
+    def close(self):
+        self.is_connected = False
+
+
+class TestSMTPPool:
+    def _make_pool(self, **kwargs):
+        connections = []
+
+        async def connect():
+            connections.append(FakeSMTP())
+            return connections[-1]
+
+        return SMTPPool(connect, **kwargs), connections
+
+    @pytest.mark.asyncio
+    async def test_connection_is_reused_with_rset(self):
+        pool, connections = self._make_pool()
+        await pool.sendmail("s@example.com", ["a@example.com"], b"one")
+        await pool.sendmail("s@example.com", ["a@example.com"], b"two")
+        assert len(connections) == 1
+        assert len(connections[0].sent) == 2
+        assert connections[0].rsets == 1
+
+    @pytest.mark.asyncio
+    async def test_connection_replaced_after_max_messages(self):
+        pool, connections = self._make_pool(max_messages=2)
+        for _ in range(3):
+            await pool.sendmail("s@example.com", ["a@example.com"], b"msg")
+        assert len(connections) == 2
+        assert connections[0].is_connected is False
+
+    @pytest.mark.asyncio
+    async def test_idle_connection_replaced(self):
+        pool, connections = self._make_pool(idle_timeout=0)
+        await pool.sendmail("s@example.com", ["a@example.com"], b"one")
+        await pool.sendmail("s@example.com", ["a@example.com"], b"two")
+        assert len(connections) == 2
+
+    @pytest.mark.asyncio
+    async def test_dropped_connection_is_reconnected(self):
+        pool, connections = self._make_pool()
+        await pool.sendmail("s@example.com", ["a@example.com"], b"one")
+        connections[0].fail_next = SMTPServerDisconnected("gone")
+        await pool.sendmail("s@example.com", ["a@example.com"], b"two")
+        assert len(connections) == 2
+        assert connections[1].sent[0][2] == b"two"
+
+    @pytest.mark.asyncio
+    async def test_fresh_connection_failure_is_raised(self):
+        pool, connections = self._make_pool()
+
+        async def connect():
+            smtp = FakeSMTP()
+            smtp.fail_next = SMTPServerDisconnected("gone")
+            return smtp
+
+        pool.connect = connect
+        with pytest.raises(SMTPServerDisconnected):
+            await pool.sendmail("s@example.com", ["a@example.com"], b"one")
+
+    @pytest.mark.asyncio
+    async def test_refused_message_keeps_connection(self):
+        pool, connections = self._make_pool()
+        await pool.sendmail("s@example.com", ["a@example.com"], b"one")
+        connections[0].fail_next = ValueError("refused")
+        with pytest.raises(ValueError):
+            await pool.sendmail("s@example.com", ["a@example.com"], b"two")
+        await pool.sendmail("s@example.com", ["a@example.com"], b"three")
+        assert len(connections) == 1
+
+
+class TestRemailerPool:
+    def test_no_pool_by_default(self):
+        assert Remailer(cfg).pool is None
+
+    def test_pool_from_config(self):
+        mailer = Remailer(config.Config(StringIO("smtp_pool_size: 4\nsmtp_pool_max_messages: 10")))
+        assert mailer.pool.size == 4
+        assert mailer.pool.max_messages == 10
+
+    @pytest.mark.asyncio
+    @patch("src.remailer.remailer.SMTP")
+    async def test_pooled_sendmail(self, mock_smtp_cls):
+        mock_conn = AsyncMock()
+        mock_conn.close = MagicMock()
+        mock_conn.is_connected = True
+        mock_smtp_cls.return_value = mock_conn
+
+        mailer = Remailer(config.Config(StringIO("smtp_pool_size: 1\nsmtp_username: 'u'\nsmtp_password: 'p'")))
+        await mailer.sendmail(["a@example.com"], "one")
+        await mailer.sendmail(["a@example.com"], "two")
+
+        assert mock_smtp_cls.call_count == 1
+        mock_conn.connect.assert_awaited_once()
+        mock_conn.login.assert_awaited_once_with("u", "p")
+        assert mock_conn.sendmail.await_count == 2
+
+
+class TestRemailerSendmailMany:
+    @pytest.mark.asyncio
+    async def test_results_in_order(self):
+        mailer = Remailer(cfg)
+        connections = []
+
+        async def connect():
+            connections.append(FakeSMTP())
+            return connections[-1]
+
+        mailer._connect = connect
+
+        messages = [(["a@example.com"], f"message {i}", None) for i in range(10)]
+        messages[3] = (["bad@example.com"], "refused", None)
+
+        sendmail = FakeSMTP.sendmail
+
+        async def refusing_sendmail(self, sender, recipients, message):
+            if recipients == ["bad@example.com"]:
+                raise ValueError("refused")
+            return await sendmail(self, sender, recipients, message)
+
+        with patch.object(FakeSMTP, "sendmail", refusing_sendmail):
+            results = await mailer.sendmail_many(messages)
+
+        assert [bool(result) for result in results] == [i != 3 for i in range(10)]
+        assert len(connections) <= mailer.release_concurrency
+        assert all(not connection.is_connected for connection in connections)
+
+    @pytest.mark.asyncio
+    async def test_uses_configured_pool(self):
+        mailer = Remailer(config.Config(StringIO("smtp_pool_size: 2")))
+        mailer.pool.sendmail = AsyncMock(return_value=({}, "OK"))
+
+        results = await mailer.sendmail_many([(["a@example.com"], "one", "s@example.com")])
+
+        assert results == [({}, "OK")]
+        mailer.pool.sendmail.assert_awaited_once_with("s@example.com", ["a@example.com"], b"one")
+
+    @pytest.mark.asyncio
+    async def test_no_messages(self):
+        assert await Remailer(cfg).sendmail_many([]) == []
+
+
+class TestRemailerRateLimits:
+    def test_no_limits_by_default(self):
+        assert Remailer(cfg).limiter is None
+
+    @pytest.mark.asyncio
+    @patch("src.remailer.remailer.SMTP")
+    async def test_send_is_limited(self, mock_smtp_cls):
+        mock_conn = AsyncMock()
+        mock_smtp_cls.return_value.__aenter__ = AsyncMock(return_value=mock_conn)
+        mock_smtp_cls.return_value.__aexit__ = AsyncMock(return_value=False)
+
+        mailer = Remailer(config.Config(StringIO("smtp_rate_limits: { default: { concurrency: 1 } }")))
+        await mailer.sendmail(["a@example.com", "b@example.org"], "test")
+
+        assert mailer.limiter.stats()["example.com"]["sent"] == 1
+        assert mailer.limiter.stats()["example.org"]["sent"] == 1
+
+    @pytest.mark.asyncio
+    async def test_over_limit_is_queued_and_sent_later(self):
+        queued = []
+        outbox = Outbox({"db": {}})
+        outbox.queue = MagicMock(side_effect=queued.extend)
+        outbox.claim = MagicMock(side_effect=lambda: [
+            (row_id, sender, recipients, message, 0) for (row_id, (recipients, message, sender)) in enumerate(queued)
+        ])
+        outbox.complete = MagicMock()
+        outbox.retry = MagicMock()
+
+        mailer = Remailer(config.Config(StringIO(
+            "smtp_rate_limits: { default: { concurrency: 1 }, max_session_wait: 0.01 }"
+        )), outbox=outbox)
+        mailer._send = AsyncMock(return_value=({}, "OK"))
+
+        async with mailer.limiter.limit(["a@example.com"]):
+            assert await mailer.sendmail(["b@example.com"], "test", in_session=True)
+
+        mailer._send.assert_not_awaited()
+        assert queued == [(["b@example.com"], "test", "<>")]
+
+        # The outbox workers send it once the limits allow
+        assert await outbox.process_batch(mailer) == 1
+
+        mailer._send.assert_awaited_once()
+        assert mailer._send.await_args.args[1:] == (["b@example.com"], "test", "<>")
+        outbox.complete.assert_called_once_with([0])
+
+    @pytest.mark.asyncio
+    async def test_session_waits_without_an_outbox(self):
+        mailer = Remailer(config.Config(StringIO(
+            "smtp_rate_limits: { default: { concurrency: 1 }, max_session_wait: 0.01 }"
+        )))
+        mailer._send = AsyncMock(return_value=({}, "OK"))
+
+        async with anyio.create_task_group() as tasks:
+            async with mailer.limiter.limit(["a@example.com"]):
+                tasks.start_soon(mailer.sendmail, ["b@example.com"], "test", None, True)
+                await anyio.sleep(0.05)
+
+        mailer._send.assert_awaited_once()
@@ -0,0 +1,69 @@
+from unittest.mock import MagicMock, patch
+
+from src.challenge.handler_internal import HandlerInternal
+from src.rules import most_specific, normalise_domain, parent_domains, pattern_to_domain
+
+
+class TestDomains:
+    def test_parent_domains(self):
+        assert parent_domains("list@Mail.Example.com") == ["mail.example.com", "example.com", "com"]
+        assert parent_domains("nobody@") == []
+
+    def test_normalise_domain(self):
+        assert normalise_domain(" Example.com\n") == "example.com"
+        assert normalise_domain("@example.com") == "example.com"
+        assert normalise_domain("*.example.com.") == "example.com"
+        assert normalise_domain("not a domain") is None
+        assert normalise_domain(".*@example\\.com") is None
+
+    def test_most_specific(self):
+        actions = {"example.com": "reject", "mail.example.com": "accept"}
+
+        assert most_specific("a@mail.example.com", actions) == "accept"
+        assert most_specific("a@lists.example.com", actions) == "reject"
+        assert most_specific("a@example.org", actions) is None
+
+
+class TestPatternToDomain:
+    def test_domain_patterns(self):
+        assert pattern_to_domain(r".*@(.*\.)?example\.com") == "example.com"
+        assert pattern_to_domain(r"^.*@(?:.+\.)?Mail\.example\.org$") == "mail.example.org"
+        assert pattern_to_domain(r".*[@.]example\.co\.uk") == "example.co.uk"
+
+    def test_other_patterns(self):
+        # Only the domain itself, so not equivalent to a domain rule
+        assert pattern_to_domain(r".*@example\.com") is None
+        # An unescaped dot matches any character
+        assert pattern_to_domain(r".*@(.*\.)?example.com") is None
+        assert pattern_to_domain(r"list-.*@example\.com") is None
+
+
+class TestHandlerInternalDomains:
+    def make_handler(self, exact, domains):
+        pool = MagicMock()
+        cursor = pool.connection.return_value.__enter__.return_value.cursor.return_value.__enter__.return_value
+        cursor.fetchall.side_effect = [exact, domains]
+
+        return (HandlerInternal({"db": {}}), pool, cursor)
+
+    def test_get_actions(self):
+        (handler, pool, cursor) = self.make_handler(
+            [("a@example.com", "ignore")],
+            [("example.com", "challenge"), ("lists.example.org", "ignore"), ("example.org", "challenge")],
+        )
+
+        with patch("src.challenge.handler_internal.get_db_pool", return_value=pool):
+            actions = handler.get_actions(["a@example.com", "b@mail.example.com", "c@lists.example.org", "d@else.net"])
+
+        assert actions == {"a@example.com": "ignore", "b@mail.example.com": "challenge", "c@lists.example.org": "ignore"}
+
+        domains = cursor.execute.call_args_list[1].args[1]["domains"]
+        assert "a@example.com" not in domains and "example.com" in domains and "else.net" in domains
+
+    def test_domains_not_looked_up_when_all_matched(self):
+        (handler, pool, cursor) = self.make_handler([("a@example.com", "ignore")], [])
+
+        with patch("src.challenge.handler_internal.get_db_pool", return_value=pool):
+            assert handler.get_actions(["a@example.com"]) == {"a@example.com": "ignore"}
+
+        assert cursor.execute.call_count == 1
@@ -1,5 +1,9 @@
-from src.sender import Sender
-from tests.mocks.sender_handler import MockHandler, defined_sender
+from unittest.mock import MagicMock, patch
+
+from src import services
+from src.sender import Sender, SenderKeys, get_sender
+from src.sender.handler_db import HandlerDb, match_sender
+from tests.mocks.sender_handler import MockHandler, MockReferenceHandler, defined_sender
 
 
 class TestSender:
@@ -63,6 +67,33 @@ class TestSender:
         assert len(email_data) == 3
         assert ref == [test_ref]
 
+    def test_claim_challenge_once_within_cooldown(self):
+        handler = MockHandler()
+        assert Sender(defined_sender, handler).claim_challenge(300) is True
+        assert Sender(defined_sender, handler).claim_challenge(300) is False
+
+    def test_claim_challenge_without_cooldown(self):
+        handler = MockHandler()
+        assert Sender(defined_sender, handler).claim_challenge(0) is True
+        assert Sender(defined_sender, handler).claim_challenge(0) is True
+        assert handler.challenged == set()
+
+    def test_outbound_queued_with_stash(self):
+        handler = MockHandler()
+        sender = Sender(defined_sender, handler)
+        outbound = [([defined_sender], "challenge", None)]
+        sender.stash_message("foo", ["e@f.g"], "a-reference", outbound=outbound)
+        assert handler.outbox == outbound
+
+    def test_stashed_messages_are_kept_until_removed(self):
+        sender = Sender(defined_sender, MockHandler())
+        stashed = sender.get_stashed_messages()
+        assert len(stashed) == 2
+        assert len(sender.get_stashed_messages()) == 2
+
+        sender.remove_stashed_messages([stashed[0][0]])
+        assert len(sender.get_stashed_messages()) == 1
+
 
 class TestSenderReferences:
     def test_add_reference_to_empty(self):
@@ -126,3 +157,162 @@ class TestSenderReferences:
         refs = sender.get_refs()
         assert sender.action is not None
         assert refs == "foo"
+
+
+class TestSenderStoredReferences:
+    def test_add_reference_is_stored(self):
+        handler = MockReferenceHandler()
+        sender = Sender(defined_sender, handler)
+        sender.add_reference("ref1")
+        sender.add_reference("ref1")
+        assert handler.refs[defined_sender] == ["ref1"]
+
+    def test_validate_ref_uses_handler(self):
+        handler = MockReferenceHandler()
+        handler.add_reference_for_sender(defined_sender, "ref1")
+        sender = Sender(defined_sender, handler)
+        assert sender.validate_ref("ref1") is True
+        assert sender.validate_ref("ref2") is False
+
+    def test_set_action_leaves_stored_references(self):
+        handler = MockReferenceHandler()
+        handler.set_action_for_sender = MagicMock()
+        sender = Sender(defined_sender, handler)
+        sender.add_reference("ref1")
+        sender.set_action("confirm")
+        handler.set_action_for_sender.assert_called_once_with(defined_sender, "confirm")
+
+    def test_clear_references_is_stored(self):
+        handler = MockReferenceHandler()
+        sender = Sender(defined_sender, handler)
+        sender.add_reference("ref1")
+        sender.clear_references()
+        assert defined_sender not in handler.refs
+
+
+class TestSenderAccept:
+    def test_accept_without_a_transactional_handler(self):
+        handler = MockReferenceHandler()
+        sender = Sender(defined_sender, handler)
+        sender.add_reference("ref1")
+
+        assert sender.accept(queue_release=True) == 2
+
+        assert sender.action == "accept"
+        assert handler.actions[defined_sender][0] == "accept"
+        assert defined_sender not in handler.refs
+        assert len(handler.outbox) == 2
+
+    def test_accept_leaves_stash_without_queue_release(self):
+        handler = MockHandler()
+        sender = Sender(defined_sender, handler)
+
+        assert sender.accept() == 0
+
+        assert handler.outbox == []
+        assert len(sender.get_stashed_messages()) == 2
+
+    def test_accept_uses_the_handler_transaction(self):
+        handler = MockHandler()
+        handler.accept_sender = lambda sender, queue_release: None
+        sender = Sender("noone@example.com", handler)
+        sender.action = "confirm"
+
+        assert sender.accept(queue_release=True) is None
+        assert sender.action == "confirm"
+
+    @patch("src.sender.handler_db.get_db_pool")
+    def test_accepted_in_one_transaction(self, mock_get_db_pool):
+        connection = mock_get_db_pool.return_value.connection.return_value.__enter__.return_value
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.rowcount = 1
+        services["sender_keys"] = SenderKeys()
+
+        try:
+            queued = HandlerDb({"db": {}}).accept_sender(defined_sender, queue_release=True)
+        finally:
+            del services["sender_keys"]
+
+        statements = [" ".join(call.args[0].split()) for call in cursor.execute.call_args_list]
+        assert queued == 2
+        assert statements[0].startswith("INSERT INTO senders")
+        assert statements[1].startswith("DELETE FROM sender_refs")
+        assert all("INSERT INTO outbox" in statement for statement in statements[2:])
+        mock_get_db_pool.return_value.connection.assert_called_once()
+        connection.commit.assert_called_once()
+
+    @patch("src.sender.handler_db.get_db_pool")
+    def test_set_action_does_not_write_references(self, mock_get_db_pool):
+        connection = mock_get_db_pool.return_value.connection.return_value.__enter__.return_value
+        cursor = connection.cursor.return_value.__enter__.return_value
+
+        assert HandlerDb({"db": {}}).set_action_for_sender(defined_sender, "accept")
+
+        cursor.execute.assert_called_once()
+        cursor.executemany.assert_not_called()
+        connection.commit.assert_called_once()
+
+
+class TestSenderKeys:
+    def test_defaults_keep_the_address(self):
+        keys = SenderKeys()
+
+        assert keys.key("Someone+tag@Example.com") == "Someone+tag@Example.com"
+        assert keys.key("") == ""
+
+    def test_lowercase(self):
+        assert SenderKeys(lowercase=True).key("Someone@Example.COM") == "someone@example.com"
+
+    def test_separators(self):
+        keys = SenderKeys(separators="+-")
+
+        assert keys.key("someone+tag@example.com") == "someone@example.com"
+        assert keys.key("list-bounces+someone=example.org@lists.example.com") == "list@lists.example.com"
+        # A leading separator is part of the address
+        assert keys.key("+tag@example.com") == "+tag@example.com"
+
+    def test_verp_bounces(self):
+        keys = SenderKeys(separators="+")
+
+        assert keys.key("list-bounces+a=example.org@lists.example.com") == "list-bounces@lists.example.com"
+        assert keys.key("list-bounces+b=example.net@lists.example.com") == "list-bounces@lists.example.com"
+
+    def test_rewrites(self):
+        keys = SenderKeys(lowercase=True, separators="+", rewrites=[(r"prvs=[0-9a-z]+=(.*)", r"\1")])
+
+        assert keys.key("prvs=0123abcd=Someone+tag@example.com") == "someone@example.com"
+        assert keys.key("prvs@example.com") == "prvs@example.com"
+
+    def test_get_sender_uses_the_key(self):
+        services["sender_keys"] = SenderKeys(lowercase=True, separators="+")
+
+        try:
+            with patch("src.sender.get_default_handler", return_value=MockHandler()):
+                sender = get_sender("Someone+tag@example.com")
+        finally:
+            del services["sender_keys"]
+
+        assert sender.email == "someone@example.com"
+        assert sender.address == "Someone+tag@example.com"
+
+    def test_stash_keeps_the_envelope_sender(self):
+        handler = MockHandler()
+        sender = Sender("someone@example.com", handler, address="Someone+tag@example.com")
+        sender.stash_message("foo", ["e@f.g"])
+
+        assert [stash[3] for stash in sender.get_stashed_messages()] == ["Someone+tag@example.com"]
+
+        sender.queue_release()
+
+        assert handler.outbox == [(["e@f.g"], "foo", "Someone+tag@example.com")]
+
+    def test_match_sender(self):
+        assert match_sender() == "sender=%(sender)s"
+
+        services["sender_keys"] = SenderKeys(lowercase=True)
+
+        try:
+            assert match_sender() == "lower(sender)=%(sender)s"
+            assert match_sender("email") == "lower(email)=%(sender)s"
+        finally:
+            del services["sender_keys"]
@@ -0,0 +1,79 @@
+import threading
+
+import anyio
+import pytest
+
+from src.singleflight import SingleFlight
+
+
+class TestSingleFlight:
+    @pytest.mark.asyncio
+    async def test_concurrent_lookups_are_coalesced(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def lookup(value):
+            calls.append(value)
+            started.set()
+            release.wait(5)
+            return value * 2
+
+        async def run():
+            results.append(await flight.run("key", lookup, 21))
+
+        async with anyio.create_task_group() as tasks:
+            tasks.start_soon(run)
+            await anyio.to_thread.run_sync(started.wait, 5)
+            for _ in range(3):
+                tasks.start_soon(run)
+            await anyio.sleep(0.01)
+            release.set()
+
+        assert calls == [21]
+        assert results == [42, 42, 42, 42]
+        assert flight.stats() == {"lookups": 1, "coalesced": 3, "in_flight": 0}
+
+    @pytest.mark.asyncio
+    async def test_different_keys_are_not_coalesced(self):
+        flight = SingleFlight()
+        assert await flight.run("a", lambda: 1) == 1
+        assert await flight.run("b", lambda: 2) == 2
+        assert flight.stats()["coalesced"] == 0
+
+    @pytest.mark.asyncio
+    async def test_completed_lookups_are_not_cached(self):
+        flight = SingleFlight()
+        values = iter([1, 2])
+        assert await flight.run("a", lambda: next(values)) == 1
+        assert await flight.run("a", lambda: next(values)) == 2
+
+    @pytest.mark.asyncio
+    async def test_errors_are_shared(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        errors = []
+
+        def lookup():
+            started.set()
+            release.wait(5)
+            raise ValueError("failed")
+
+        async def run():
+            try:
+                await flight.run("key", lookup)
+            except ValueError as e:
+                errors.append(e)
+
+        async with anyio.create_task_group() as tasks:
+            tasks.start_soon(run)
+            await anyio.to_thread.run_sync(started.wait, 5)
+            tasks.start_soon(run)
+            await anyio.sleep(0.01)
+            release.set()
+
+        assert len(errors) == 2
+        assert flight.stats()["in_flight"] == 0
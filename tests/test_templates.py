@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+from src.templates import TemplateCache, select_template, template_paths
+
+
+@pytest.fixture
+def template(tmp_path):
+    path = tmp_path / "confirm.email.mustache"
+    path.write_text("Hello {{sender_address}}")
+
+    return path
+
+
+def rewrite(path, text):
+    # Make sure the modification time moves on, whatever the resolution
+    stat = path.stat()
+    path.write_text(text)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+class TestTemplateCache:
+    def test_render(self, template):
+        cache = TemplateCache()
+
+        assert cache.render(str(template), {"sender_address": "a@b.com"}) == "Hello a@b.com"
+
+    def test_parsed_once(self, template):
+        cache = TemplateCache()
+
+        assert cache.get(str(template)) is cache.get(str(template))
+
+    def test_reloaded_on_change(self, template):
+        cache = TemplateCache(check_interval=0)
+        cache.get(str(template))
+
+        rewrite(template, "Goodbye {{sender_address}}")
+
+        assert cache.render(str(template), {"sender_address": "a@b.com"}) == "Goodbye a@b.com"
+
+    def test_not_checked_within_interval(self, template):
+        cache = TemplateCache(check_interval=60)
+        cache.get(str(template))
+
+        rewrite(template, "Goodbye {{sender_address}}")
+
+        assert cache.render(str(template), {"sender_address": "a@b.com"}) == "Hello a@b.com"
+
+    def test_kept_if_removed(self, template):
+        cache = TemplateCache(check_interval=0)
+        cache.get(str(template))
+
+        template.unlink()
+
+        assert cache.render(str(template), {"sender_address": "a@b.com"}) == "Hello a@b.com"
+
+    def test_missing(self, tmp_path):
+        with pytest.raises(FileNotFoundError):
+            TemplateCache().get(str(tmp_path / "missing"))
+
+
+class TestSelectTemplate:
+    config = {
+        "mail_template": "/default",
+        "mail_template_variants": {
+            "domains": {"example.org": "/example.org"},
+            "languages": {"fr": "/fr", "pt-br": "/pt-br"},
+        },
+    }
+
+    def test_default(self):
+        assert select_template({}, "list@example.com") == "/etc/postconfirm/confirm.email.mustache"
+        assert select_template(self.config, "list@example.com") == "/default"
+        assert select_template(self.config, "list@example.com", "de") == "/default"
+
+    def test_domain(self):
+        assert select_template(self.config, "list@EXAMPLE.org", "fr") == "/example.org"
+
+    def test_language(self):
+        assert select_template(self.config, "list@example.com", "fr") == "/fr"
+        assert select_template(self.config, "list@example.com", "fr-CA, en") == "/fr"
+        assert select_template(self.config, "list@example.com", "pt-BR") == "/pt-br"
+
+    def test_template_paths(self):
+        assert template_paths(self.config) == ["/default", "/example.org", "/fr", "/pt-br"]
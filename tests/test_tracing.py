@@ -0,0 +1,226 @@
+import json
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import anyio
+import pytest
+
+from src import services
+from src.milter.processor import handle
+from src.tracing import FileExporter, OTLPExporter, Tracer, configure_tracing
+from src.tracing.exporters import otlp_request
+from tests.test_processor import FakeSession
+
+
+class ListExporter:
+    def __init__(self):
+        self.spans = []
+
+    async def export(self, spans):
+        self.spans.extend(spans)
+
+
+class TestTracer:
+    def test_nested_spans(self):
+        tracer = Tracer(ListExporter(), sample_rate=1)
+
+        with tracer.start_trace("session", {"queue_id": "Q1"}) as root:
+            with tracer.span("stage") as child:
+                with tracer.span("sql") as grandchild:
+                    pass
+
+        assert child.trace_id == root.trace_id == grandchild.trace_id
+        assert child.parent_id == root.span_id
+        assert grandchild.parent_id == child.span_id
+        assert root.parent_id is None
+        assert root.attributes == {"queue_id": "Q1"}
+        assert [span.name for span in tracer.queue] == ["sql", "stage", "session"]
+        assert all(span.end >= span.start for span in tracer.queue)
+
+    def test_not_sampled(self):
+        tracer = Tracer(ListExporter(), sample_rate=0.5)
+
+        with patch("src.tracing.tracer.random.random", return_value=0.9):
+            with tracer.start_trace("session") as root:
+                with tracer.span("stage") as child:
+                    pass
+
+        assert root is None and child is None
+        assert not tracer.queue
+
+    def test_span_outside_trace(self):
+        tracer = Tracer(ListExporter(), sample_rate=1)
+
+        with tracer.span("stage") as child:
+            assert child is None
+
+    def test_disabled_without_exporter(self):
+        tracer = Tracer(None, sample_rate=1)
+
+        assert not tracer.enabled
+
+        with tracer.start_trace("session") as root:
+            assert root is None
+
+    def test_error_recorded(self):
+        tracer = Tracer(ListExporter(), sample_rate=1)
+
+        with pytest.raises(ValueError):
+            with tracer.start_trace("session"):
+                raise ValueError("broken")
+
+        assert tracer.queue[0].error == "broken"
+
+    def test_full_queue_drops(self):
+        tracer = Tracer(ListExporter(), sample_rate=1, max_queue=2)
+
+        for _ in range(3):
+            with tracer.start_trace("session"):
+                pass
+
+        assert len(tracer.queue) == 2
+        assert tracer.dropped == 1
+
+    @pytest.mark.asyncio
+    async def test_flush(self):
+        exporter = ListExporter()
+        tracer = Tracer(exporter, sample_rate=1)
+
+        with tracer.start_trace("session"):
+            pass
+
+        await tracer.flush()
+
+        assert [span.name for span in exporter.spans] == ["session"]
+        assert tracer.exported == 1
+        assert not tracer.queue
+
+    @pytest.mark.asyncio
+    async def test_failed_export(self):
+        tracer = Tracer(MagicMock(export=AsyncMock(side_effect=OSError("refused"))), sample_rate=1)
+
+        with tracer.start_trace("session"):
+            pass
+
+        await tracer.flush()
+
+        assert tracer.dropped == 1
+
+
+class TestExporters:
+    def make_spans(self):
+        tracer = Tracer(ListExporter(), sample_rate=1)
+
+        with tracer.start_trace("session", {"queue_id": "Q1", "recipients": 2}):
+            with tracer.span("sql", {"pooled": True}):
+                pass
+
+        return list(tracer.queue)
+
+    def test_otlp_request(self):
+        request = otlp_request(self.make_spans())
+
+        spans = request["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        (sql, session) = spans
+
+        assert sql["parentSpanId"] == session["spanId"]
+        assert "parentSpanId" not in session
+        assert len(session["traceId"]) == 32 and len(session["spanId"]) == 16
+        assert session["attributes"] == [
+            {"key": "queue_id", "value": {"stringValue": "Q1"}},
+            {"key": "recipients", "value": {"intValue": "2"}},
+        ]
+        assert sql["attributes"] == [{"key": "pooled", "value": {"boolValue": True}}]
+        assert session["status"] == {"code": 1}
+
+    @pytest.mark.asyncio
+    async def test_file_exporter(self, tmp_path):
+        path = tmp_path / "traces.json"
+        exporter = FileExporter(str(path))
+
+        await exporter.export(self.make_spans())
+        await exporter.export(self.make_spans())
+
+        lines = path.read_text().splitlines()
+
+        assert len(lines) == 2
+        assert len(json.loads(lines[0])["resourceSpans"][0]["scopeSpans"][0]["spans"]) == 2
+
+    @pytest.mark.asyncio
+    async def test_otlp_exporter(self):
+        received = []
+
+        async def collector(stream):
+            async with stream:
+                request = b""
+                while b"\r\n\r\n" not in request:
+                    request += await stream.receive()
+
+                (headers, body) = request.split(b"\r\n\r\n", 1)
+                length = int(headers.lower().split(b"content-length: ")[1].split(b"\r\n")[0])
+
+                while len(body) < length:
+                    body += await stream.receive()
+
+                received.append((headers.split(b"\r\n")[0], json.loads(body)))
+                await stream.send(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+
+        listener = await anyio.create_tcp_listener(local_host="127.0.0.1")
+        port = listener.extra(anyio.abc.SocketAttribute.local_port)
+
+        async with anyio.create_task_group() as tasks:
+            tasks.start_soon(listener.serve, collector)
+
+            await OTLPExporter(f"http://127.0.0.1:{port}/v1/traces").export(self.make_spans())
+
+            tasks.cancel_scope.cancel()
+
+        assert received[0][0] == b"POST /v1/traces HTTP/1.1"
+        assert "resourceSpans" in received[0][1]
+
+    def test_invalid_endpoint(self):
+        with pytest.raises(ValueError):
+            OTLPExporter("localhost:4318")
+
+    def test_configure(self, tmp_path):
+        tracer = Tracer()
+
+        assert configure_tracing({}, tracer) is None
+
+        app_config = MagicMock()
+        app_config.get.side_effect = {
+            "tracing.file": str(tmp_path / "traces.json"),
+            "tracing.sample_rate": "0.1",
+        }.get
+
+        assert configure_tracing(app_config, tracer) is tracer
+        assert isinstance(tracer.exporter, FileExporter)
+        assert tracer.sample_rate == 0.1
+
+
+class TestSessionTrace:
+    @pytest.fixture(autouse=True)
+    def _setup_services(self):
+        services["app_config"] = {"remail_sender": "postconfirm@example.com"}
+        services["outbox"] = MagicMock(enabled=False)
+        yield
+        del services["app_config"]
+        del services["outbox"]
+
+    @pytest.mark.asyncio
+    @patch("src.milter.processor.resolve_challenge_recipients", new_callable=AsyncMock, return_value=False)
+    async def test_session_spans(self, _):
+        tracer = Tracer(ListExporter(), sample_rate=1)
+
+        with patch("src.tracing.tracer.tracer", tracer):
+            await next(iter(handle.filters))(FakeSession("someone@example.net", ["list@example.org"]))
+
+        spans = {span.name: span for span in tracer.queue}
+        root = spans["milter_session"]
+
+        assert root.attributes == {
+            "postfix.queue_id": "QUEUEID",
+            "postconfirm.verdict": "accept",
+            "postconfirm.path": "no_challenge",
+        }
+        assert spans["recipient_resolution"].parent_id == root.span_id
+        assert spans["envelope"].trace_id == root.trace_id
@@ -1,4 +1,9 @@
+import base64
+import hashlib
+import hmac
 import tempfile
+import time
+from datetime import datetime, timezone
 from unittest.mock import MagicMock
 
 from src.validator.validator import Validator
@@ -62,6 +67,12 @@ class TestValidatorToken:
         token = v.get_token("sender@a.com", "rcpt@b.com", "ref1")
         assert v.validate_token("sender@a.com", token, ["wrong-ref"]) is False
 
+    def test_validate_token_with_lookup(self):
+        v = _make_validator()
+        token = v.get_token("sender@a.com", "rcpt@b.com", "ref1")
+        assert v.validate_token("sender@a.com", token, lambda ref: ref == "ref1") is True
+        assert v.validate_token("sender@a.com", token, lambda ref: False) is False
+
     def test_validate_token_malformed(self):
         v = _make_validator()
         assert v.validate_token("sender@a.com", "no-colons-here", ["ref1"]) is False
@@ -74,3 +85,74 @@ class TestValidatorMissingKeyFile:
         config.__getitem__ = lambda self, k: "/nonexistent/path/to/keyfile"
         v = Validator(config)
         assert v.hash_key == bytes()
+
+
+class TestValidatorKeyring:
+    def _make_keyring(self, tmp_path, grace_period=3600):
+        keys = []
+
+        for (name, since) in (("old", "2026-01-01"), ("current", "2026-06-01T00:00:00+00:00"), ("next", 1893456000)):
+            key_file = tmp_path / name
+            key_file.write_bytes(name.encode())
+            keys.append({"file": str(key_file), "since": since})
+
+        return Validator({"key_file": keys, "key_grace_period": grace_period})
+
+    def test_hash_unchanged(self):
+        v = _make_validator()
+        digest = hmac.new(b"test-secret-key", b"hello", hashlib.sha224).digest()
+        assert v.hash(b"hello") == base64.urlsafe_b64encode(digest).strip(b"=").decode()
+
+    def test_signs_with_newest_in_use(self, tmp_path):
+        v = self._make_keyring(tmp_path)
+        june = datetime(2026, 6, 2, tzinfo=timezone.utc).timestamp()
+
+        assert v.signing_key(june).secret == b"current"
+        assert v.signing_key(0).secret == b"old"
+
+    def test_grace_period(self, tmp_path):
+        v = self._make_keyring(tmp_path)
+        switched = datetime(2026, 6, 1, tzinfo=timezone.utc).timestamp()
+
+        assert [key.secret for key in v.accepted_keys(switched + 60)] == [b"next", b"current", b"old"]
+        assert [key.secret for key in v.accepted_keys(switched + 7200)] == [b"next", b"current"]
+
+    def test_rotation_keeps_outstanding_tokens(self, tmp_path):
+        old_key = tmp_path / "old"
+        old_key.write_bytes(b"old")
+        token = Validator({"key_file": str(old_key)}).get_token("sender@a.com", "rcpt@b.com", "ref1")
+
+        new_key = tmp_path / "new"
+        new_key.write_bytes(b"new")
+        v = Validator({"key_file": [{"file": str(old_key)}, {"file": str(new_key), "since": time.time() - 60}]})
+
+        assert v.validate_token("sender@a.com", token, ["ref1"]) is True
+        assert v.get_token("sender@a.com", "rcpt@b.com", "ref1") != token
+
+        v.grace_period = 0
+        assert v.validate_token("sender@a.com", token, ["ref1"]) is False
+
+    def test_rotation_keeps_outstanding_short_hashes(self, tmp_path):
+        old_key = tmp_path / "old"
+        old_key.write_bytes(b"old")
+        short_hash = Validator({"key_file": str(old_key)}).make_short_hash("sender@a.com", "ref1")
+
+        new_key = tmp_path / "new"
+        new_key.write_bytes(b"new")
+        v = Validator({"key_file": [{"file": str(old_key)}, {"file": str(new_key), "since": time.time() - 60}]})
+
+        assert len(short_hash) == 16
+        assert v.validate_short_hash("sender@a.com", short_hash.upper(), ["ref0", "ref1"]) is True
+        assert v.validate_short_hash("sender@a.com", short_hash, ["ref0"]) is False
+
+    def test_non_ascii_hash(self):
+        v = _make_validator()
+        assert v.validate_hash("sender@a.com", "rcpt@b.com", "ref1", "tampéred") is False
+
+    def test_unreadable_key_skipped(self, tmp_path):
+        key_file = tmp_path / "key"
+        key_file.write_bytes(b"key")
+
+        v = Validator({"key_file": [{"file": str(tmp_path / "missing")}, str(key_file)]})
+
+        assert [key.secret for key in v.keys] == [b"key"]
@@ -0,0 +1,107 @@
+import time
+from unittest.mock import MagicMock, patch
+
+import anyio
+import pytest
+
+from src import Generation, services
+from src.lifecycle import run_warm_up, warm_up
+from src.lifecycle.warmup import read_hot_senders, report_startup, startup_seconds, warmup_seconds
+from src.rules import PatternMatcher
+from src.sender import Sender
+from src.templates import TemplateCache
+from tests.mocks.challenge_handler import MockChallengeHandler
+from tests.mocks.sender_handler import MockHandler, defined_sender
+
+
+@pytest.fixture
+def sender_handler():
+    handler = MockHandler()
+    handler.warm_up = MagicMock()
+    handler.get_action_for_sender = MagicMock(wraps=handler.get_action_for_sender)
+
+    with patch("src.lifecycle.warmup.get_default_handler", return_value=handler):
+        with patch("src.lifecycle.warmup.get_sender") as get_sender:
+            get_sender.side_effect = lambda email: Sender(email, handler)
+            yield handler
+
+
+def make_generation(tmp_path, patterns=None, **config):
+    template = tmp_path / "confirm.email.mustache"
+    template.write_text("Hello {{sender}}")
+
+    return Generation(
+        app_config={"mail_template": str(template), **config},
+        challenge_handlers=[MockChallengeHandler(patterns=patterns or [(r".*@example\.com", "challenge")])],
+        templates=TemplateCache(),
+        patterns=PatternMatcher(),
+    )
+
+
+class TestWarmUp:
+    def test_warm_up(self, tmp_path, sender_handler):
+        generation = make_generation(tmp_path)
+
+        assert warm_up(generation)
+
+        sender_handler.warm_up.assert_called_once()
+        assert list(generation["templates"].templates) == [str(tmp_path / "confirm.email.mustache")]
+
+        for step in ("pools", "patterns", "templates"):
+            assert warmup_seconds.get(step=step) > 0
+
+    def test_generation_pinned(self, tmp_path, sender_handler):
+        generation = make_generation(tmp_path)
+        sender_handler.warm_up.side_effect = lambda: pinned.append(services.pinned.get())
+        pinned = []
+
+        assert warm_up(generation)
+
+        assert pinned == [generation]
+        assert services.pinned.get() is None
+        assert generation.sessions == 0
+
+    def test_hot_senders(self, tmp_path, sender_handler):
+        hot_senders = tmp_path / "hot_senders"
+        hot_senders.write_text(f"# Frequent senders\n{defined_sender}\n\nsomeone@example.org\nlast@example.org\n")
+
+        assert warm_up(make_generation(tmp_path, **{"warmup.hot_senders_limit": 2}), str(hot_senders))
+
+        assert [call.args[0] for call in sender_handler.get_action_for_sender.call_args_list] == [
+            defined_sender, "someone@example.org"
+        ]
+
+    def test_failed_step_skipped(self, tmp_path, sender_handler, caplog):
+        generation = make_generation(tmp_path, patterns=[("(unclosed", "challenge")])
+        generation["app_config"]["mail_template"] = str(tmp_path / "missing")
+
+        assert not warm_up(generation)
+
+        sender_handler.warm_up.assert_called_once()
+        assert "Unable to compile the pattern (unclosed" in caplog.text
+        assert "Warm-up step templates failed" in caplog.text
+
+    def test_read_hot_senders(self, tmp_path):
+        hot_senders = tmp_path / "hot_senders"
+        hot_senders.write_text(" a@example.com \n#b@example.com\nc@example.com\n")
+
+        assert read_hot_senders(str(hot_senders), 10) == ["a@example.com", "c@example.com"]
+
+
+class TestRunWarmUp:
+    @pytest.mark.asyncio
+    async def test_run(self, tmp_path, sender_handler):
+        assert await run_warm_up(make_generation(tmp_path))
+
+    @pytest.mark.asyncio
+    async def test_timeout(self, tmp_path):
+        with patch("src.lifecycle.warmup.warm_up", side_effect=lambda *args: time.sleep(0.5)):
+            with anyio.fail_after(0.4):
+                assert not await run_warm_up(make_generation(tmp_path, **{"warmup.timeout": 0.05}))
+
+
+class TestStartup:
+    def test_report_startup(self):
+        report_startup(0)
+
+        assert startup_seconds.get() > 0
@@ -10,13 +10,36 @@ import psycopg
 
 from src import services
 from src.db import get_db_pool
-from src.sender import get_static_sender
+from src.rules import lint_pattern, normalise_domain, pattern_to_domain
+from src.sender import get_static_sender, make_sender_keys
 
 
 logger = logging.getLogger(__name__)
 
 
 dry_run = False
+convert_patterns = False
+reject_unsafe_patterns = False
+
+
+def check_pattern(pattern: str, list_name: str, line_counter: int, source_name: str) -> bool:
+    """
+    Lints a pattern, reporting any hazards. Returns whether it should be
+    loaded.
+    """
+    hazards = lint_pattern(pattern)
+
+    if hazards:
+        logger.warning("%(verb)s unsafe entry on %(line_counter)d of %(filename)s (%(source)s): %(entry)s -- it has %(hazards)s", {
+            "verb": "Skipping" if reject_unsafe_patterns else "Loading",
+            "line_counter": line_counter,
+            "filename": list_name,
+            "source": source_name,
+            "entry": pattern,
+            "hazards": ", ".join(hazards),
+        })
+
+    return not (hazards and reject_unsafe_patterns)
 
 
 def process_senders(cursor: psycopg.Cursor, app_config: config.Config) -> None:
@@ -74,6 +97,23 @@ def process_senders(cursor: psycopg.Cursor, app_config: config.Config) -> None:
 
             add_pattern_sender_entries(cursor, list_name, action, source_name)
 
+    domain_lists = [
+        ("allowdomainlists", "accept"),
+        ("rejectdomainlists", "reject"),
+        ("discarddomainlists", "discard"),
+    ]
+
+    for config_name, action in domain_lists:
+        for list_name in app_config.get(config_name, []):
+            logger.info("Processing domain list (type: %(type)s; file: %(file_name)s)", {
+                "type": action,
+                "file_name": list_name
+            })
+
+            source_name = basename(list_name)
+
+            add_domain_entries(cursor, list_name, action, source_name, add_sender_entry)
+
 
 def add_email_sender_entries(cursor, list_name: str, action: str, source_name: str) -> None:
     try:
@@ -99,7 +139,16 @@ def add_pattern_sender_entries(cursor, list_name: str, action: str, source_name:
                     stripped_entry = entry.strip()
                     re.compile(stripped_entry)
 
-                    add_sender_entry(cursor, stripped_entry, action, source_name, "P")
+                    domain = pattern_to_domain(stripped_entry) if convert_patterns else None
+
+                    if domain:
+                        logger.debug("Converting pattern %(pattern)s to a rule for the domain %(domain)s", {
+                            "pattern": stripped_entry,
+                            "domain": domain
+                        })
+                        add_sender_entry(cursor, domain, action, source_name, "D")
+                    elif check_pattern(stripped_entry, list_name, line_counter, source_name):
+                        add_sender_entry(cursor, stripped_entry, action, source_name, "P")
                 except re.error as e:
                     logger.warning("Skipping invalid entry on %(line_counter)d of %(filename)s (%(source)s): %(entry)s -- %(reason)s", {
                                         "line_counter": line_counter,
@@ -116,6 +165,40 @@ def add_pattern_sender_entries(cursor, list_name: str, action: str, source_name:
         })
 
 
+def add_domain_entries(cursor, list_name: str, action: str, source_name: str, add_entry) -> None:
+    """
+    Adds a domain rule, with `add_entry`, for each domain in the list.
+    """
+    try:
+        with open(list_name, "r") as f:
+            line_counter = 0
+            for entry in f:
+                line_counter += 1
+
+                stripped_entry = entry.strip()
+
+                if not stripped_entry:
+                    continue
+
+                domain = normalise_domain(stripped_entry)
+
+                if domain:
+                    add_entry(cursor, domain, action, source_name, "D")
+                else:
+                    logger.warning("Skipping invalid entry on %(line_counter)d of %(filename)s (%(source)s): %(entry)s -- not a domain", {
+                                        "line_counter": line_counter,
+                                        "filename": list_name,
+                                        "source": source_name,
+                                        "entry": stripped_entry
+                                    })
+    except (FileNotFoundError, PermissionError) as e:
+        logger.error("Skipping invalid domain list %(filename)s (%(source)s): %(reason)s", {
+            "source": source_name,
+            "filename": list_name,
+            "reason": str(e)
+        })
+
+
 def add_sender_entry(cursor, sender: str, action: str, source_name: str, sender_type: str = "E", reference: str = None) -> None:
     values = {
         "sender": sender,
@@ -181,11 +264,9 @@ def process_cache_directory(cursor: psycopg.Cursor, cache_dir: str) -> None:
             logger.warning("%(filename)s has no valid FROM. Probably an autogenerated message. Skipping", {"filename": str(entry)})
             continue
 
-        if from_email not in senders:
-            this_sender = get_static_sender(from_email, cursor)
-            senders[from_email] = this_sender
-        else:
-            this_sender = senders[from_email]
+        # Senders that share a key share their stash
+        this_sender = get_static_sender(from_email, cursor)
+        this_sender = senders.setdefault(this_sender.email, this_sender)
 
         if not dry_run:
             this_sender.stash_message(message, recipients, reference)
@@ -258,6 +339,22 @@ def process_challenges(cursor: psycopg.Cursor, app_config: config.Config) -> Non
 
             add_pattern_challenge_entries(cursor, list_name, action, source_name)
 
+    domain_lists = [
+        ("challengedomainlists", "challenge"),
+        ("nochallengedomainlists", "ignore"),
+    ]
+
+    for config_name, action in domain_lists:
+        for list_name in app_config.get(config_name, []):
+            logger.info("Processing challenge domain list (type: %(type)s; file: %(file_name)s)", {
+                "type": action,
+                "file_name": list_name
+            })
+
+            source_name = basename(list_name)
+
+            add_domain_entries(cursor, list_name, action, source_name, add_challenge_entry)
+
 
 def add_email_challenge_entries(cursor, list_name: str, action: str, source_name: str) -> None:
     try:
@@ -283,7 +380,16 @@ def add_pattern_challenge_entries(cursor, list_name: str, action: str, source_na
                     stripped_entry = entry.strip()
                     re.compile(stripped_entry)
 
-                    add_challenge_entry(cursor, stripped_entry, action, source_name, "P")
+                    domain = pattern_to_domain(stripped_entry) if convert_patterns else None
+
+                    if domain:
+                        logger.debug("Converting pattern %(pattern)s to a rule for the domain %(domain)s", {
+                            "pattern": stripped_entry,
+                            "domain": domain
+                        })
+                        add_challenge_entry(cursor, domain, action, source_name, "D")
+                    elif check_pattern(stripped_entry, list_name, line_counter, source_name):
+                        add_challenge_entry(cursor, stripped_entry, action, source_name, "P")
                 except re.error as e:
                     logger.warning("Skipping invalid entry on %(line_counter)d of %(filename)s (%(source)s): %(entry)s -- %(reason)s", {
                                         "line_counter": line_counter,
@@ -325,7 +431,7 @@ def add_challenge_entry(cursor, challenge: str, action: str, source_name: str, c
 
 
 def main():
-    global dry_run
+    global dry_run, convert_patterns, reject_unsafe_patterns
 
     parser = argparse.ArgumentParser(
         prog="update_static_lists",
@@ -333,6 +439,10 @@ def main():
     )
     parser.add_argument("-c", "--config-file", default="/etc/postconfirm.cfg", type=argparse.FileType())
     parser.add_argument("-n", "--dry-run", action='store_true', help="Do not actually modify the data")
+    parser.add_argument("--convert-patterns", action='store_true',
+                        help="Load patterns that match a domain and its subdomains as domain rules")
+    parser.add_argument("--reject-unsafe-patterns", action='store_true',
+                        help="Skip patterns that could take too long to match, rather than just reporting them")
     parser.add_argument("--skip-senders")
     parser.add_argument("--skip-in-progress")
     parser.add_argument("--skip-challenges")
@@ -343,11 +453,14 @@ def main():
     app_config = config.Config(args.config_file)
 
     services["app_config"] = app_config
+    services["sender_keys"] = make_sender_keys(app_config)
 
     # Set up the root logger
     logging.basicConfig(level=app_config.get('log.level', logging.WARNING))
 
     dry_run = args.dry_run
+    convert_patterns = args.convert_patterns
+    reject_unsafe_patterns = args.reject_unsafe_patterns
 
     with get_db_pool(app_config["db"], "db").connection() as connection:
         with connection.cursor() as cursor: